@@ -0,0 +1,148 @@
+import argparse
+import itertools
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+from tokenizer import Tokenizer
+from pubmed_processor import PubmedProcessor
+from extract_keywords import KeywordsExtractor
+from find_keywords import KeywordsFinder, find_keywords
+from synthetic_corpus import CorpusGenerator
+
+
+class Benchmark(object):
+    """
+    Times every offline stage of the pipeline on a synthetic corpus and
+    measures its peak python memory usage.
+    """
+
+    def __init__(self, tokenizer, finder, measure_memory=True, repeat=3):
+        self.tokenizer = tokenizer
+        self.finder = finder
+        self.measure_memory = measure_memory
+        self.repeat = repeat
+
+    def stages(self, papers):
+        """
+        Returns (name, function) pairs of the benchmarked stages. Stages run in
+        order, every function gets the result of the previous one.
+        """
+        extractor = KeywordsExtractor()
+        titles = [paper['title'] for res in papers.values() for paper in res['papers'].values()]
+
+        def extract_keywords(processed):
+            extractor.extract_keywords(itertools.chain.from_iterable(
+                info['title'] for res in processed.values() for info in res['papers'].values()), 400)
+            # find_keywords needs processed papers as well.
+            return processed
+
+        return [
+            ('tokenize', lambda _: self.tokenizer.tokenize_batch(titles)),
+            # A new processor every run, so that repeated runs don't just hit
+            # the paper cache of the previous one.
+            ('process', lambda _: PubmedProcessor(self.tokenizer.tokenize).extract_info(papers)),
+            ('extract_keywords', extract_keywords),
+            ('find_keywords', lambda processed: find_keywords(self.finder, processed)),
+        ]
+
+    def run_stage(self, fn, input):
+        """
+        Runs a stage `repeat` times and returns its output, the fastest time
+        and peak memory.
+        """
+        seconds = None
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            output = fn(input)
+            elapsed = time.perf_counter() - start
+            seconds = elapsed if seconds is None else min(seconds, elapsed)
+        peak_memory = None
+        if self.measure_memory:
+            tracemalloc.start()
+            fn(input)
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return output, seconds, peak_memory
+
+    def run(self, papers):
+        num_papers = sum(len(res['papers']) for res in papers.values())
+        results = {}
+        output = None
+        for name, fn in self.stages(papers):
+            output, seconds, peak_memory = self.run_stage(fn, output)
+            results[name] = {
+                'seconds': seconds,
+                'papers_per_second': num_papers / seconds if seconds else None,
+                'peak_memory_bytes': peak_memory,
+            }
+        return {'num_researchers': len(papers), 'num_papers': num_papers, 'stages': results}
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns descriptions of stages that got slower than `tolerance` times their
+    baseline time, for corpus sizes present in both.
+    """
+    baseline_runs = {run['num_researchers']: run for run in baseline['runs']}
+    regressions = []
+    for run in results['runs']:
+        base = baseline_runs.get(run['num_researchers'])
+        if base is None:
+            continue
+        for stage, stats in run['stages'].items():
+            base_stats = base['stages'].get(stage)
+            if base_stats and stats['seconds'] > tolerance * base_stats['seconds']:
+                regressions.append('{} with {} researchers: {:.3f}s, baseline {:.3f}s'.format(
+                    stage, run['num_researchers'], stats['seconds'], base_stats['seconds']))
+    return regressions
+
+
+def print_run(run):
+    print('{} researchers, {} papers'.format(run['num_researchers'], run['num_papers']))
+    for stage, stats in run['stages'].items():
+        memory = '{:.1f}MB'.format(stats['peak_memory_bytes'] / 2**20) if stats['peak_memory_bytes'] is not None else '-'
+        print('  {:<18} {:>8.3f}s {:>12.0f} papers/s {:>10} peak'.format(
+            stage, stats['seconds'], stats['papers_per_second'] or 0, memory))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark offline pipeline stages on synthetic corpora of several sizes')
+    parser.add_argument('--sizes', type=int, nargs='+', help='Numbers of researchers in the benchmarked corpora', default=[50, 200, 1000])
+    parser.add_argument('--repeat', type=int, help='How many times to run every stage, the fastest run is reported', default=3)
+    parser.add_argument('--no-memory', dest='measure_memory', action='store_false', help='Don\'t measure peak memory, which runs every stage a second time', default=True)
+    parser.add_argument('--save', help='Path to a json file where to store results, e.g. to use them as a baseline', default=None)
+    parser.add_argument('--compare', help='Path to a json file with baseline results to compare against', default=None)
+    parser.add_argument('--tolerance', type=float, help='How many times slower than the baseline a stage can get before it is reported as a regression', default=1.5)
+    generator = CorpusGenerator()
+    generator.register_options(parser)
+    tokenizer = Tokenizer()
+    tokenizer.register_options(parser)
+    finder = KeywordsFinder()
+    finder.register_options(parser)
+    args = parser.parse_args()
+    tokenizer.prepare(args)
+    finder.prepare(args)
+
+    benchmark = Benchmark(tokenizer, finder, measure_memory=args.measure_memory, repeat=max(1, args.repeat))
+    results = {'python': sys.version.split()[0], 'platform': platform.platform(), 'runs': []}
+    for size in args.sizes:
+        args.num_researchers = size
+        generator.prepare(args)
+        researchers, papers = generator.generate()
+        run = benchmark.run(papers)
+        print_run(run)
+        results['runs'].append(run)
+
+    if args.save:
+        with open(args.save, 'w') as output:
+            json.dump(results, output, indent=2)
+    if args.compare:
+        with open(args.compare, 'r') as input:
+            regressions = compare(results, json.load(input), args.tolerance)
+        for regression in regressions:
+            print('Regression: ' + regression)
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,130 @@
+import json
+import os
+import logging
+
+CHUNK_SIZE = 1 << 16
+
+
+def is_jsonl(path):
+    return path.endswith('.jsonl')
+
+
+def read_jsonl(path):
+    """
+    Yields records of a jsonl file. A broken last line, left by a crash in the
+    middle of a write, is skipped.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, 'r') as input:
+        for line in input:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                logging.warning('Skipping broken line in {}'.format(path))
+
+
+def load_records(path, value=None):
+    """
+    Reads a dict of records keyed by id from either a json file or a jsonl
+    file written by JsonlWriter.
+
+    @param value for jsonl files, only keep this field of every record.
+    """
+    if not is_jsonl(path):
+        with open(path, 'r') as input:
+            return json.load(input)
+    records = {}
+    for record in read_jsonl(path):
+        id = record.pop('id')
+        records[id] = record[value] if value else record
+    return records
+
+
+def iter_records(path):
+    """
+    Yields (id, record) pairs from either a json file or a jsonl file written
+    by JsonlWriter. jsonl files are read one line at a time, json files have to
+    be loaded as a whole.
+    """
+    if not is_jsonl(path):
+        yield from load_records(path).items()
+        return
+    for record in read_jsonl(path):
+        yield record.pop('id'), record
+
+
+class JsonWriter:
+    """
+    Writes records one by one into a json object keyed by id, without keeping
+    them in memory.
+    """
+
+    def __init__(self, path):
+        self.output = open(path, 'w')
+        self.output.write('{')
+        self.separator = ''
+
+    def write(self, id, record):
+        self.output.write('{}{}: {}'.format(self.separator, json.dumps(id), json.dumps(record)))
+        self.separator = ', '
+
+    def close(self):
+        self.output.write('}')
+        self.output.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def create_writer(path, resume=False):
+    if is_jsonl(path):
+        return JsonlWriter(path, resume=resume)
+    return JsonWriter(path)
+
+
+class JsonlWriter:
+    """
+    Appends records to a jsonl file, one line per record, flushing after every
+    record so that everything written survives a crash.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.done_ids = set()
+        if resume and os.path.exists(path):
+            self._drop_broken_tail()
+            self.done_ids = {record['id'] for record in read_jsonl(path)}
+        self.output = open(path, 'a' if resume else 'w')
+
+    def _drop_broken_tail(self):
+        with open(self.path, 'rb+') as output:
+            size = output.seek(0, os.SEEK_END)
+            end = size
+            while end > 0:
+                start = max(0, end - CHUNK_SIZE)
+                output.seek(start)
+                newline = output.read(end - start).rfind(b'\n')
+                if newline >= 0:
+                    end = start + newline + 1
+                    break
+                end = start
+            if end < size:
+                output.truncate(end)
+
+    def write(self, id, record):
+        self.output.write(json.dumps(dict(record, id=id)) + '\n')
+        self.output.flush()
+        self.done_ids.add(id)
+
+    def close(self):
+        self.output.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
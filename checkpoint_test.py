@@ -0,0 +1,36 @@
+import unittest
+import os
+
+from checkpoint import JsonlWriter, load_records
+
+OUTPUT = 'test_checkpoint.jsonl'
+
+
+class JsonlWriterTest(unittest.TestCase):
+
+    def test_write_and_load(self):
+        with JsonlWriter(OUTPUT) as writer:
+            writer.write('1', {'name': 'A'})
+            writer.write('2', {'name': 'B'})
+
+        self.assertEqual(load_records(OUTPUT), {'1': {'name': 'A'}, '2': {'name': 'B'}})
+        self.assertEqual(load_records(OUTPUT, value='name'), {'1': 'A', '2': 'B'})
+
+    def test_resume_drops_broken_line(self):
+        with JsonlWriter(OUTPUT) as writer:
+            writer.write('1', {'name': 'A'})
+        with open(OUTPUT, 'a') as output:
+            output.write('{"name": "B", "i')
+
+        with JsonlWriter(OUTPUT, resume=True) as writer:
+            self.assertEqual(writer.done_ids, {'1'})
+            writer.write('3', {'name': 'C'})
+
+        self.assertEqual(load_records(OUTPUT, value='name'), {'1': 'A', '3': 'C'})
+
+    def tearDown(self):
+        if os.path.exists(OUTPUT):
+            os.remove(OUTPUT)
+
+if __name__ == '__main__':
+    unittest.main()
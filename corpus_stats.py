@@ -0,0 +1,65 @@
+import json
+import math
+
+import numpy as np
+
+
+class CorpusStats(object):
+    """
+    Document frequencies of keywords over the whole corpus: in how many
+    researchers' papers and in how many papers every keyword appears.
+
+    @param keywords list of keywords the stats were computed for, None for
+        stats saved before it was stored.
+    """
+
+    def __init__(self, num_researchers, num_papers, researcher_df, paper_df, keywords=None):
+        self.num_researchers = num_researchers
+        self.num_papers = num_papers
+        self.researcher_df = researcher_df
+        self.paper_df = paper_df
+        self.keywords = keywords
+
+    @classmethod
+    def from_index(cls, index, num_papers):
+        """
+        Computes stats from a KeywordIndex in a single pass over its postings.
+        """
+        num_keywords = len(index.keywords)
+        researcher_df = np.bincount(index.keyword_indices, minlength=num_keywords)
+        paper_df = np.bincount(index.keyword_indices, weights=index.counts, minlength=num_keywords)
+        return cls(len(index.researcher_ids), num_papers,
+                   {k: int(researcher_df[i]) for i, k in enumerate(index.keywords) if researcher_df[i]},
+                   {k: int(paper_df[i]) for i, k in enumerate(index.keywords) if paper_df[i]},
+                   keywords=list(index.keywords))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as input:
+            return cls(**json.load(input))
+
+    def save(self, path):
+        with open(path, 'w') as output:
+            json.dump({
+                'num_researchers': self.num_researchers,
+                'num_papers': self.num_papers,
+                'researcher_df': self.researcher_df,
+                'paper_df': self.paper_df,
+                'keywords': self.keywords,
+            }, output)
+
+    def matches(self, keywords, num_researchers=None, num_papers=None):
+        """
+        Returns whether the stats were computed for these keywords and, if
+        given, a corpus of this size.
+        """
+        return (self.keywords == list(keywords)
+                and num_researchers in (None, self.num_researchers)
+                and num_papers in (None, self.num_papers))
+
+    def idf(self, keyword):
+        """
+        Smoothed inverse researcher frequency, keywords shared by many
+        researchers get weights close to 1, rare ones get larger weights.
+        """
+        return math.log((1 + self.num_researchers) / (1 + self.researcher_df.get(keyword, 0))) + 1
@@ -0,0 +1,151 @@
+import os
+import re
+import time
+import zlib
+import sqlite3
+import hashlib
+import logging
+
+MAX_FILE_NAME_LEN = 250
+# Share of max_size the cache is shrunk to once it grows over the limit, so that
+# eviction doesn't run on every put.
+EVICTION_TARGET = 0.9
+
+
+class DirectoryCache:
+    """
+    Legacy cache that keeps every url in its own file named after the url.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.max_url_len = MAX_FILE_NAME_LEN - len(self.cache_dir)
+        if not os.path.exists(self.cache_dir):
+            os.mkdir(self.cache_dir)
+
+    def key(self, url):
+        url = re.escape(url).replace('/','\\')
+        if len(url) > self.max_url_len:
+            url = url[len(url)-self.max_url_len:]
+        return os.path.join(self.cache_dir, url)
+
+    def has(self, url):
+        return os.path.exists(self.key(url))
+
+    def get(self, url):
+        if not self.has(url):
+            return None
+        with open(self.key(url), 'r') as url_cache:
+            return url_cache.read()
+
+    def put(self, url, contents):
+        with open(self.key(url), 'w') as url_cache:
+            url_cache.write(contents)
+
+    def close(self):
+        pass
+
+
+class SqliteCache:
+    """
+    Keeps all cached urls in a single sqlite file. Entries are keyed by the
+    sha256 of the url and stored zlib-compressed.
+
+    @param ttl number of seconds after which an entry expires, None to keep
+        entries forever.
+    @param max_size maximal total size of compressed entries in bytes. Once it
+        is exceeded, least recently used entries are evicted. None for no limit.
+    @param legacy_dir directory of a DirectoryCache. Urls missing in the sqlite
+        file are looked up there and copied over, which migrates the old cache
+        as it is being used.
+    """
+
+    def __init__(self, path, ttl=None, max_size=None, legacy_dir=None):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.legacy = DirectoryCache(legacy_dir) if legacy_dir and os.path.isdir(legacy_dir) else None
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS entries (
+            key BLOB PRIMARY KEY,
+            value BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            created REAL NOT NULL,
+            accessed REAL NOT NULL
+        ) WITHOUT ROWID''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+        self.total_size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def key(self, url):
+        return hashlib.sha256(url.encode('utf-8')).digest()
+
+    def is_expired(self, created):
+        return self.ttl is not None and created + self.ttl < time.time()
+
+    def has(self, url):
+        row = self.db.execute('SELECT created FROM entries WHERE key = ?', (self.key(url),)).fetchone()
+        if row is not None:
+            return not self.is_expired(row[0])
+        return self.legacy is not None and self.legacy.has(url)
+
+    def get(self, url):
+        key = self.key(url)
+        row = self.db.execute('SELECT value, created FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return self._migrate(url)
+        value, created = row
+        if self.is_expired(created):
+            return None
+        self.db.execute('UPDATE entries SET accessed = ? WHERE key = ?', (time.time(), key))
+        return zlib.decompress(value).decode('utf-8')
+
+    def put(self, url, contents):
+        value = zlib.compress(contents.encode('utf-8'))
+        now = time.time()
+        key = self.key(url)
+        row = self.db.execute('SELECT size FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            self.total_size -= row[0]
+        self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)', (key, value, len(value), now, now))
+        self.total_size += len(value)
+        if self.max_size is not None and self.total_size > self.max_size:
+            self.evict(int(self.max_size * EVICTION_TARGET))
+
+    def evict(self, target_size):
+        """
+        Removes expired and then least recently used entries until the cache
+        is not larger than `target_size` bytes.
+        """
+        if self.ttl is not None:
+            self.db.execute('DELETE FROM entries WHERE created < ?', (time.time() - self.ttl,))
+            self.total_size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        evicted = []
+        for key, size in self.db.execute('SELECT key, size FROM entries ORDER BY accessed'):
+            if self.total_size <= target_size:
+                break
+            evicted.append((key,))
+            self.total_size -= size
+        self.db.executemany('DELETE FROM entries WHERE key = ?', evicted)
+        logging.info('Evicted {} cache entries'.format(len(evicted)))
+
+    def _migrate(self, url):
+        if self.legacy is None:
+            return None
+        contents = self.legacy.get(url)
+        if contents is not None:
+            self.put(url, contents)
+        return contents
+
+    def close(self):
+        self.db.close()
+
+
+def create_cache(args):
+    if args.downloader_cache is None:
+        return None
+    if args.cache_backend == 'files':
+        return DirectoryCache(args.downloader_cache)
+    max_size = args.cache_max_mb * 1024 * 1024 if args.cache_max_mb else None
+    return SqliteCache(args.downloader_cache, ttl=args.cache_ttl, max_size=max_size, legacy_dir=args.legacy_cache_dir)
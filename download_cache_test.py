@@ -0,0 +1,66 @@
+import unittest
+import os
+import shutil
+
+from download_cache import DirectoryCache, SqliteCache
+
+CACHE_FILE = 'test_download_cache.sqlite'
+LEGACY_DIR = 'test_legacy_cache'
+
+
+class SqliteCacheTest(unittest.TestCase):
+
+    def test_put_get(self):
+        cache = SqliteCache(CACHE_FILE)
+        cache.put('url1', 'page1')
+
+        self.assertTrue(cache.has('url1'))
+        self.assertFalse(cache.has('url2'))
+        self.assertEqual(cache.get('url1'), 'page1')
+        self.assertIsNone(cache.get('url2'))
+
+    def test_long_urls_dont_collide(self):
+        cache = SqliteCache(CACHE_FILE)
+        prefix = 'x' * 1000
+        cache.put('a' + prefix, 'page1')
+        cache.put('b' + prefix, 'page2')
+
+        self.assertEqual(cache.get('a' + prefix), 'page1')
+        self.assertEqual(cache.get('b' + prefix), 'page2')
+
+    def test_ttl(self):
+        cache = SqliteCache(CACHE_FILE, ttl=-1)
+        cache.put('url1', 'page1')
+
+        self.assertFalse(cache.has('url1'))
+        self.assertIsNone(cache.get('url1'))
+
+    def test_evicts_least_recently_used(self):
+        cache = SqliteCache(CACHE_FILE)
+        cache.put('url1', 'page1')
+        cache.put('url2', 'page2')
+        cache.get('url1')
+        cache.max_size = cache.total_size * 1.2
+        cache.put('url3', 'page3')
+
+        self.assertTrue(cache.has('url1'))
+        self.assertFalse(cache.has('url2'))
+        self.assertTrue(cache.has('url3'))
+
+    def test_migrates_legacy_cache(self):
+        DirectoryCache(LEGACY_DIR).put('url1', 'page1')
+        cache = SqliteCache(CACHE_FILE, legacy_dir=LEGACY_DIR)
+
+        self.assertEqual(cache.get('url1'), 'page1')
+        shutil.rmtree(LEGACY_DIR)
+        self.assertEqual(cache.get('url1'), 'page1')
+
+    def tearDown(self):
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(CACHE_FILE + suffix):
+                os.remove(CACHE_FILE + suffix)
+        if os.path.exists(LEGACY_DIR):
+            shutil.rmtree(LEGACY_DIR)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,148 +1,413 @@
 import aiohttp
-from aiohttp_retry import RetryClient
+from aiohttp_retry import RetryClient, ExponentialRetry
 import asyncio
-import os
-import re
-import heapq
-from datetime import datetime, timedelta
+import concurrent.futures
+import contextlib
+import itertools
 import logging
 
-MAX_FILE_NAME_LEN = 250
-ONE_SEC = timedelta(seconds=1)
+from rate_limiter import RateLimiter, parse_retry_after
+from download_cache import create_cache
+from metrics import Metrics
+
+# Attempts of the http client itself on server errors and dropped connections.
+MAX_ATTEMPTS = 2
 
 class DefaultArgs:
     qps = 100
-    downloader_cache_dir = 'cache'
-
-class DownloadHistory:
-
-    def __init__(self):
-        self.records = []
+    max_in_flight = 100
+    burst = 1
+    downloader_cache = 'cache.sqlite'
+    cache_backend = 'sqlite'
+    cache_ttl = None
+    cache_max_mb = None
+    legacy_cache_dir = 'cache'
+    connections = 100
+    connections_per_host = 0
+    keepalive = 30
+    dns_cache_ttl = 300
+    parse_workers = 0
+    parse_executor = 'thread'
+    throttled_attempts = 0
 
-    def oldest_record(self):
-        return self.records[0]
+def parse_page(parser, url, page):
+    """
+    Runs a parser on a downloaded page and returns (result, whether it
+    succeeded). Pages that fail to parse are treated like pages that failed
+    to download, their result is None.
+    """
+    try:
+        return parser(url, page), True
+    except Exception as err:
+        logging.error('Failed to parse {}: {}'.format(url, err))
+        return None, False
 
-    def remote_old_records(self, t: datetime):
-        while len(self.records) > 0 and self.oldest_record() < t:
-            heapq.heappop(self.records)
+class Throttled(Exception):
 
-    def add_record(self, t: datetime):
-        heapq.heappush(self.records, t)
-
-    def __len__(self):
-        return len(self.records)
+    def __init__(self, retry_after=None):
+        super().__init__('Throttled, retry after {}'.format(retry_after))
+        self.retry_after = retry_after
 
 class Downloader(object):
 
-    def __init__(self, http_client_factory = RetryClient):
-        self.cache_dir = None
+    def __init__(self, http_client_factory = None, trace_configs = None):
+        self._cache = None
+        self.cache_args = None
+        self.trace_configs = trace_configs
+        # Disabled unless replaced by a prepared Metrics instance.
+        self.metrics = Metrics()
+        self.session = None
+        self.executor = None
         self.download_paused = False
-        self.http_client_factory = http_client_factory
+        # Function of a url, true for pages that change over time and must
+        # always be downloaded. They are still written to the cache.
+        self.skip_cache = None
+        self.http_client_factory = http_client_factory or self.create_retry_client
         self.prepare(DefaultArgs())
         self.args_registered = False
-        self.download_history = DownloadHistory()
         self.semaphore = None
 
     def register_options(self, argparser):
-        argparser.add_argument('--cache', dest='downloader_cache_dir', default=DefaultArgs.downloader_cache_dir,
-                                help='Path to the folder where downloaded urls will be cached. To disable cache, delete the folder.')
-        argparser.add_argument('--qps', type=int, default=DefaultArgs.qps, help='Limit the number of concurrent requests sent to the server')
+        argparser.add_argument('--cache', dest='downloader_cache', default=DefaultArgs.downloader_cache,
+                                help='Path to the sqlite file (or folder, for the files backend) where downloaded urls will be cached.')
+        argparser.add_argument('--cache_backend', choices=['sqlite', 'files'], default=DefaultArgs.cache_backend,
+                                help='How to store the cache: a single sqlite file or one file per url.')
+        argparser.add_argument('--cache_ttl', type=float, default=DefaultArgs.cache_ttl,
+                                help='Number of seconds after which cached urls are downloaded again. By default cache never expires.')
+        argparser.add_argument('--cache_max_mb', type=float, default=DefaultArgs.cache_max_mb,
+                                help='Maximal size of the sqlite cache in megabytes. Least recently used urls are evicted once it is exceeded.')
+        argparser.add_argument('--legacy_cache', dest='legacy_cache_dir', default=DefaultArgs.legacy_cache_dir,
+                                help='Folder of the old one-file-per-url cache. Urls found there are moved into the sqlite cache when requested.')
+        argparser.add_argument('--qps', type=float, default=DefaultArgs.qps, help='Limit the number of requests per second sent to each host')
+        argparser.add_argument('--max_in_flight', type=int, default=DefaultArgs.max_in_flight, help='Limit the number of concurrent requests')
+        argparser.add_argument('--connections', type=int, default=DefaultArgs.connections, help='Maximal number of open connections, 0 for no limit')
+        argparser.add_argument('--connections_per_host', type=int, default=DefaultArgs.connections_per_host, help='Maximal number of open connections to a single host, 0 for no limit')
+        argparser.add_argument('--keepalive', type=float, default=DefaultArgs.keepalive, help='Number of seconds to keep idle connections open')
+        argparser.add_argument('--dns_cache_ttl', type=int, default=DefaultArgs.dns_cache_ttl, help='Number of seconds to cache resolved host names')
+        argparser.add_argument('--parse_workers', type=int, default=DefaultArgs.parse_workers,
+                               help='Number of threads or processes that parse downloaded pages, so that parsing doesn\'t hold up downloads. 0 to parse in between downloads.')
+        argparser.add_argument('--parse_executor', choices=['thread', 'process'], default=DefaultArgs.parse_executor,
+                               help='Parse pages in threads, enough for lxml which releases the GIL, or in processes')
+        argparser.add_argument('--throttled_attempts', type=int, default=DefaultArgs.throttled_attempts,
+                               help='How many times to request a url that keeps getting throttled before giving up on it, 0 to keep retrying behind the rate limiter until it succeeds')
+        argparser.add_argument('--burst', type=int, default=DefaultArgs.burst, help='How many requests can be sent to a host at once before the qps limit kicks in')
+
+    def create_retry_client(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.connections,
+            limit_per_host=self.connections_per_host,
+            keepalive_timeout=self.keepalive,
+            ttl_dns_cache=self.dns_cache_ttl)
+        retry_options = ExponentialRetry(attempts=MAX_ATTEMPTS, exceptions={aiohttp.ClientError})
+        trace_configs = list(self.trace_configs or [])
+        if self.metrics.enabled:
+            trace_configs.append(self.metrics_trace_config())
+        return RetryClient(connector=connector, retry_options=retry_options,
+                           headers={'Accept-Encoding': 'gzip, deflate'}, trace_configs=trace_configs or None)
+
+    def metrics_trace_config(self):
+        """
+        Counts attempts of the http client, including the ones it retries on
+        its own after server errors and dropped connections.
+        """
+        async def on_request_start(session, context, params):
+            self.metrics.inc('http_attempts_total')
+            if (context.trace_request_ctx or {}).get('current_attempt', 1) > 1:
+                self.metrics.inc('http_retries_total')
+
+        async def on_request_exception(session, context, params):
+            self.metrics.inc('http_errors_total', error=type(params.exception).__name__)
+
+        config = aiohttp.TraceConfig()
+        config.on_request_start.append(on_request_start)
+        config.on_request_exception.append(on_request_exception)
+        return config
 
     def create_session(self):
         return self.http_client_factory()
 
+    def create_executor(self):
+        if not self.parse_workers:
+            return None
+        if self.parse_executor == 'process':
+            return concurrent.futures.ProcessPoolExecutor(self.parse_workers)
+        return concurrent.futures.ThreadPoolExecutor(self.parse_workers)
+
+    async def open(self):
+        """
+        Opens a session and a parse executor that are reused by all following
+        downloads until close is called. Without it, every download_all call
+        opens its own.
+        """
+        if self.session is None:
+            session = self.create_session()
+            self.session = await session.__aenter__()
+        if self.executor is None:
+            self.executor = self.create_executor()
+
+    async def close(self):
+        if self.session is not None:
+            session, self.session = self.session, None
+            await session.__aexit__(None, None, None)
+        if self.executor is not None:
+            executor, self.executor = self.executor, None
+            executor.shutdown()
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    def session_context(self):
+        if self.session is not None:
+            return contextlib.nullcontext(self.session)
+        return self.create_session()
+
+    @contextlib.contextmanager
+    def executor_context(self):
+        if self.executor is not None:
+            yield self.executor
+            return
+        executor = self.create_executor()
+        try:
+            yield executor
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
     def prepare(self, args):
         self.qps = args.qps
-        self.cache_dir = args.downloader_cache_dir
-        self.max_url_len = MAX_FILE_NAME_LEN - len(self.cache_dir)
-        if not os.path.exists(self.cache_dir):
-            os.mkdir(self.cache_dir)
+        self.max_in_flight = args.max_in_flight
+        self.connections = args.connections
+        self.connections_per_host = args.connections_per_host
+        self.keepalive = args.keepalive
+        self.dns_cache_ttl = args.dns_cache_ttl
+        self.parse_workers = args.parse_workers
+        self.parse_executor = args.parse_executor
+        self.throttled_attempts = args.throttled_attempts
+        self.rate_limiter = RateLimiter(args.qps, args.burst)
+        self.semaphore = None
+        if self._cache is not None:
+            self._cache.close()
+            self._cache = None
+        # Opened on first use, so that creating a downloader doesn't create
+        # the cache file.
+        self.cache_args = args
         self.args_registered = True
 
+    @property
+    def cache(self):
+        if self._cache is None and self.cache_args.downloader_cache is not None:
+            self._cache = create_cache(self.cache_args)
+        return self._cache
+
     def use_cache(self):
-        return self.cache_dir is not None
+        return self.cache_args.downloader_cache is not None
 
-    def cache_key(self, url):
-        assert self.use_cache()
-        url = re.escape(url).replace('/','\\')
-        if len(url) > self.max_url_len:
-            url = url[len(url)-self.max_url_len:]
-        return os.path.join(self.cache_dir, url)
+    def is_cacheable(self, url):
+        return self.use_cache() and not (self.skip_cache and self.skip_cache(url))
 
     def has_cache(self, url):
-        return self.use_cache() and os.path.exists(self.cache_key(url))
+        return self.is_cacheable(url) and self.cache.has(url)
 
     def get_cache(self, url):
-        with open(self.cache_key(url), 'r') as url_cache:
-            return url_cache.read()
+        if not self.is_cacheable(url):
+            return None
+        with self.metrics.timer('cache_seconds', operation='get'):
+            contents = self.cache.get(url)
+        self.metrics.inc('cache_requests_total', result='miss' if contents is None else 'hit')
+        return contents
 
     def put_cache(self, url, contents):
         if not contents:
             return
-        with open(self.cache_key(url), 'w') as url_cache:
-            url_cache.write(contents)
+        with self.metrics.timer('cache_seconds', operation='put'):
+            self.cache.put(url, contents)
+        self.metrics.inc('cache_writes_total')
 
     async def try_to_download(self, session, url):
         async with self.semaphore:
-            curr_time = datetime.now()
-            self.download_history.remote_old_records(curr_time-ONE_SEC)
-            if len(self.download_history) >= self.qps:
-                sleep_time = self.download_history.oldest_record() + ONE_SEC - curr_time
-                await asyncio.sleep(sleep_time.total_seconds())
-            self.download_history.add_record(datetime.now())
+            await self.rate_limiter.acquire(url)
             logging.info('Downloading {}'.format(url))
-            async with session.get(url, retry_attempts=2) as res:
-                if res.status == 429:
-                    logging.warning('Service returned status 429, trying to recover. Consider adjusting download throttle')
-                    await asyncio.sleep(1)
-                    return None
-                elif not res.status == 200:
-                    logging.warning('Error fetching {}, staus={}'.format(url, res.status))
-                    return None
-                return await res.text()
-
+            with self.metrics.timer('http_request_seconds'):
+                async with session.get(url) as res:
+                    self.metrics.inc('http_responses_total', status=res.status)
+                    if res.status == 429:
+                        raise Throttled(parse_retry_after(res.headers.get('Retry-After')))
+                    elif not res.status == 200:
+                        logging.warning('Error fetching {}, staus={}'.format(url, res.status))
+                        return None
+                    self.rate_limiter.on_success(url)
+                    contents = await res.text()
+                    # Length of the decoded page, compressed transfers are smaller.
+                    self.metrics.inc('http_response_characters_total', len(contents))
+                    return contents
 
     async def download(self, session, url, result_queue):
         try:
-            contents = await self.try_to_download(session, url)
+            # Every attempt waits for the rate limiter again, which throttled
+            # responses slow down and pause for Retry-After.
+            for attempt in itertools.count(1):
+                try:
+                    contents = await self.try_to_download(session, url)
+                    break
+                except Throttled as throttled:
+                    self.rate_limiter.on_throttled(url, throttled.retry_after)
+                    if attempt == self.throttled_attempts:
+                        logging.error('Failed to download {}. Throttled {} times'.format(url, attempt))
+                        self.metrics.inc('downloads_failed_total', reason='throttled')
+                        contents = None
+                        break
             if self.use_cache():
                 self.put_cache(url, contents)
             logging.info('Download finished for {}'.format(url))
             await result_queue.put((url, contents))
         except aiohttp.ServerDisconnectedError as err:
             logging.error('Failed to download {}. Repeated server disconnected error'.format(url))
+            self.metrics.inc('downloads_failed_total', reason='disconnected')
             await result_queue.put((url, None))
 
     async def download_or_cache(self, session, url, result_queue):
-        if self.has_cache(url):
+        contents = self.get_cache(url)
+        if contents is not None:
             logging.info('Found cache entry for {}'.format(url))
-            await result_queue.put((url, self.get_cache(url)))
+            await result_queue.put((url, contents))
             return
         await self.download(session, url, result_queue)
 
-    async def download_all(self, urls, callback):
+    async def stream(self, urls):
         """
-        asynchronously downloads urls from the given list and forwars results to
-        the callback function
+        asynchronously downloads urls and yields (url, page) pairs as soon as
+        they are ready, in no particular order.
 
-        @param consumer_fn function accepting two parameters: url and the
-            downloaded page.
+        Urls may be any iterable or async iterable, it is consumed lazily: at
+        most `max_in_flight` urls are being downloaded and at most
+        `max_in_flight` results wait for the caller at any time, so memory
+        doesn't depend on the number of urls. To stop early, break out of the
+        loop and close the generator, e.g. with `contextlib.aclosing`.
         """
         if self.semaphore is None:
-            self.semaphore = asyncio.Semaphore(self.qps)
+            self.semaphore = asyncio.Semaphore(self.max_in_flight)
         if not self.args_registered:
             logging.warning('Downloader.prepare was not called')
-        results_queue = asyncio.Queue()
+        urls_queue = asyncio.Queue(maxsize=self.max_in_flight)
+        results_queue = asyncio.Queue(maxsize=self.max_in_flight)
+        done = object()
+        errors = []
 
-        async def consumer():
+        async def worker(session):
             while True:
-                url, page = await results_queue.get()
-                await callback(url, page)
-                results_queue.task_done()
-
-        async with self.create_session() as download_session:
-            downloaders = [asyncio.create_task(self.download_or_cache(download_session, url, results_queue)) for url in urls]
-            consumer_task = asyncio.create_task(consumer())
-            await asyncio.gather(*downloaders)
-            await results_queue.join()
-            consumer_task.cancel()
+                url = await urls_queue.get()
+                try:
+                    await self.download_or_cache(session, url, results_queue)
+                except Exception as err:
+                    logging.error('Failed to download {}: {}'.format(url, err))
+                    self.metrics.inc('downloads_failed_total', reason='error')
+                    await results_queue.put((url, None))
+                finally:
+                    urls_queue.task_done()
+
+        async def producer():
+            try:
+                if hasattr(urls, '__aiter__'):
+                    async for url in urls:
+                        await urls_queue.put(url)
+                else:
+                    for url in urls:
+                        await urls_queue.put(url)
+                await urls_queue.join()
+            except Exception as err:
+                errors.append(err)
+            await results_queue.put(done)
+
+        async with self.session_context() as download_session:
+            tasks = [asyncio.create_task(worker(download_session)) for _ in range(self.max_in_flight)]
+            tasks.append(asyncio.create_task(producer()))
+            try:
+                while True:
+                    result = await results_queue.get()
+                    if result is done:
+                        break
+                    yield result
+                if errors:
+                    raise errors[0]
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+    def parse(self, parser, url, page, stage):
+        parsed, ok = parse_page(parser, url, page)
+        if not ok:
+            self.metrics.inc('parse_errors_total', stage=stage)
+        return parsed
+
+    async def download_all(self, urls, callback, parser=None, stage='pages'):
+        """
+        asynchronously downloads urls from the given list and forwars results to
+        the callback function
+
+        @param consumer_fn function accepting two parameters: url and the
+            downloaded page.
+        @param parser function accepting url and the downloaded page, whose
+            result is passed to the callback instead of the page. With
+            parse_workers, it runs in a thread or process pool while downloads
+            go on, so it must not touch state shared with the callback, and has
+            to be picklable for the process pool. At most 2 * parse_workers
+            pages are being parsed at once, further downloads wait for them.
+        @param stage label of the parse_errors_total metric counting pages
+            the parser failed on.
+        """
+        with self.executor_context() as executor:
+            if parser is None or executor is None:
+                async for url, page in self.stream(urls):
+                    await callback(url, self.parse(parser, url, page, stage) if parser else page)
+                return
+            loop = asyncio.get_running_loop()
+            slots = asyncio.Semaphore(2 * self.parse_workers)
+            tasks = set()
+
+            async def parse_and_callback(url, page):
+                try:
+                    with self.metrics.timer('parse_seconds'):
+                        parsed, ok = await loop.run_in_executor(executor, parse_page, parser, url, page)
+                    if not ok:
+                        self.metrics.inc('parse_errors_total', stage=stage)
+                    await callback(url, parsed)
+                finally:
+                    slots.release()
+
+            # Set to the first error of a callback. Callers may be waiting for
+            # that callback to schedule further urls, so it stops the
+            # downloads rather than waiting for them to end.
+            failed = loop.create_future()
+
+            def on_task_done(task):
+                tasks.discard(task)
+                if not task.cancelled() and task.exception() is not None and not failed.done():
+                    failed.set_exception(task.exception())
+
+            async def parse_all():
+                async for url, page in self.stream(urls):
+                    # Stop taking results while all slots are busy, which in
+                    # turn stops downloads once the results queue fills up.
+                    await slots.acquire()
+                    task = asyncio.create_task(parse_and_callback(url, page))
+                    tasks.add(task)
+                    task.add_done_callback(on_task_done)
+                while tasks:
+                    await asyncio.wait(list(tasks))
+
+            parsing = asyncio.create_task(parse_all())
+            try:
+                await asyncio.wait([parsing, failed], return_when=asyncio.FIRST_COMPLETED)
+                if failed.done():
+                    failed.result()
+                parsing.result()
+            finally:
+                parsing.cancel()
+                for task in list(tasks):
+                    task.cancel()
+                if not failed.done():
+                    failed.cancel()
@@ -1,17 +1,19 @@
 import unittest
 import asyncio
-import shutil
+import contextlib
 import os
 from datetime import datetime, timedelta
 
 from downloader import Downloader
+from metrics import Metrics
 
 
 class RequestStub:
 
-    def __init__(self, page):
+    def __init__(self, page, status=200, headers={}):
         self.page = page
-        self.status = 200
+        self.status = status
+        self.headers = headers
 
     async def text(self):
         return self.page
@@ -50,6 +52,19 @@ class HttpClientStub():
     async def __aexit__(self, *args, **kwargs):
         pass
 
+class ThrottlingHttpClientStub(HttpClientStub):
+
+    def __init__(self, num_throttled):
+        super().__init__()
+        self.num_throttled = num_throttled
+
+    def get(self, url, **kwargs):
+        if self.num_throttled > 0:
+            self.num_throttled -= 1
+            self.calls.append(url)
+            return RequestStub(None, status=429, headers={'Retry-After': '0'})
+        return super().get(url, **kwargs)
+
 class ConsumerStub:
 
     def __init__(self):
@@ -63,8 +78,21 @@ class ConsumerStub:
 
 class ArgsStub:
 
-    downloader_cache_dir = 'test_cache'
+    downloader_cache = 'test_cache.sqlite'
+    cache_backend = 'sqlite'
+    cache_ttl = None
+    cache_max_mb = None
+    legacy_cache_dir = None
+    connections = 10
+    connections_per_host = 0
+    keepalive = 30
+    dns_cache_ttl = 300
+    parse_workers = 0
+    parse_executor = 'thread'
+    throttled_attempts = 0
     qps = 10
+    max_in_flight = 10
+    burst = 1
 
 class DownloaderTest(unittest.TestCase):
 
@@ -107,10 +135,149 @@ class DownloaderTest(unittest.TestCase):
         self.assertLess(actual_duration, expected_duration + delta)
         self.assertGreater(actual_duration, expected_duration - delta)
 
+    def test_throttled_urls_are_retried(self):
+        http_client = ThrottlingHttpClientStub(num_throttled=2)
+        downloader = Downloader(http_client_factory=lambda: http_client)
+        args = ArgsStub()
+        args.max_in_flight = 1
+        downloader.prepare(args)
+        consumer = ConsumerStub()
+        urls = list(http_client.get_data().keys())
+
+        asyncio.run(downloader.download_all(urls, consumer))
+
+        # Verify that no page was lost and that the rate was reduced
+        self.assertEqual(consumer.get_data(), http_client.get_data())
+        self.assertEqual(len(http_client.get_calls()), len(urls) + 2)
+        self.assertLess(downloader.rate_limiter.bucket(urls[0]).rate, args.qps)
+
+    def test_throttled_attempts(self):
+        for throttled_attempts, num_throttled, expected_failures in [(0, 8, 0), (3, 3, 1)]:
+            http_client = ThrottlingHttpClientStub(num_throttled=num_throttled)
+            downloader = Downloader(http_client_factory=lambda: http_client)
+            args = ArgsStub()
+            args.qps = 1000
+            args.max_in_flight = 1
+            args.throttled_attempts = throttled_attempts
+            args.downloader_cache = None
+            downloader.prepare(args)
+            consumer = ConsumerStub()
+            urls = list(http_client.get_data().keys())
+
+            asyncio.run(downloader.download_all(urls, consumer))
+
+            # By default urls are retried for as long as they are throttled.
+            failed = [url for url, page in consumer.get_data().items() if page is None]
+            self.assertEqual(len(failed), expected_failures)
+
+    def test_callback_errors_are_raised(self):
+        http_client = HttpClientStub()
+        downloader = Downloader(http_client_factory=lambda: http_client)
+        args = ArgsStub()
+        args.downloader_cache = None
+        args.qps = 1000
+        args.parse_workers = 2
+        downloader.prepare(args)
+
+        async def urls():
+            for url in http_client.get_data():
+                yield url
+            # Like the crawler, waits for callbacks to schedule more urls.
+            await asyncio.Event().wait()
+
+        async def callback(url, page):
+            if url == 'url1':
+                raise ValueError(url)
+
+        with self.assertRaises(ValueError):
+            asyncio.run(asyncio.wait_for(downloader.download_all(urls(), callback, parser=lambda url, page: page), 5))
+
+    def test_cache_is_opened_on_first_use(self):
+        downloader = Downloader(http_client_factory=HttpClientStub)
+        downloader.prepare(ArgsStub())
+        self.assertFalse(os.path.exists(ArgsStub.downloader_cache))
+
+        downloader.put_cache('url1', 'page1')
+
+        self.assertTrue(os.path.exists(ArgsStub.downloader_cache))
+        self.assertEqual(downloader.get_cache('url1'), 'page1')
+
+    def test_session_is_reused(self):
+        http_client = HttpClientStub()
+        sessions = []
+        def factory():
+            sessions.append(http_client)
+            return http_client
+        downloader = Downloader(http_client_factory=factory)
+        downloader.prepare(ArgsStub())
+        consumer = ConsumerStub()
+
+        async def download():
+            async with downloader:
+                await downloader.download_all(['url1'], consumer)
+                await downloader.download_all(['url2'], consumer)
+
+        asyncio.run(download())
+
+        self.assertEqual(len(sessions), 1)
+        self.assertEqual(len(consumer.get_data()), 2)
+        self.assertIsNone(downloader.session)
+
+    def test_stream(self):
+        http_client = HttpClientStub()
+        downloader = Downloader(http_client_factory=lambda: http_client)
+        downloader.prepare(ArgsStub())
+        urls = list(http_client.get_data().keys())
+
+        async def lazy_urls():
+            for url in urls:
+                yield url
+
+        async def collect():
+            return {url: page async for url, page in downloader.stream(lazy_urls())}
+
+        self.assertEqual(asyncio.run(collect()), http_client.get_data())
+
+    def test_stream_stops_early(self):
+        http_client = HttpClientStub()
+        downloader = Downloader(http_client_factory=lambda: http_client)
+        args = ArgsStub()
+        args.max_in_flight = 1
+        downloader.prepare(args)
+        urls = ('url{}'.format(i % 3 + 1) for i in range(1000))
+
+        async def first():
+            async with contextlib.aclosing(downloader.stream(urls)) as results:
+                async for result in results:
+                    return result
+
+        self.assertEqual(asyncio.run(first()), ('url1', 'page1'))
+        # Only a bounded window of urls was taken from the generator
+        self.assertLess(len(http_client.get_calls()), 5)
+
+    def test_metrics(self):
+        http_client = ThrottlingHttpClientStub(num_throttled=1)
+        downloader = Downloader(http_client_factory=lambda: http_client)
+        args = ArgsStub()
+        args.max_in_flight = 1
+        downloader.prepare(args)
+        downloader.metrics = Metrics(enabled=True)
+        urls = list(http_client.get_data().keys())
+
+        asyncio.run(downloader.download_all(urls, ConsumerStub()))
+        asyncio.run(downloader.download_all(urls, ConsumerStub()))
+
+        counters = {(c['name'], tuple(c['labels'].values())): c['value'] for c in downloader.metrics.snapshot()['counters']}
+        self.assertEqual(counters[('http_responses_total', (429,))], 1)
+        self.assertEqual(counters[('http_responses_total', (200,))], len(urls))
+        self.assertEqual(counters[('cache_requests_total', ('miss',))], len(urls))
+        self.assertEqual(counters[('cache_requests_total', ('hit',))], len(urls))
+        self.assertEqual(counters[('http_response_characters_total', ())], sum(map(len, http_client.get_data().values())))
 
     def tearDown(self):
-        if os.path.exists(ArgsStub.downloader_cache_dir):
-            shutil.rmtree(ArgsStub.downloader_cache_dir)
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(ArgsStub.downloader_cache + suffix):
+                os.remove(ArgsStub.downloader_cache + suffix)
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,49 +1,94 @@
 import argparse
-import json
-import traceback
-import itertools
-
-from nltk.probability import FreqDist
 
 from tokenizer import Tokenizer
 from pubmed_processor import PubmedProcessor
+from heavy_hitters import ExactCounter, SpaceSaving
+from checkpoint import iter_records
+from metrics import Metrics
 
 class KeywordsExtractor(object):
 
-    def is_redundant(self, cand, keywords):
-        # TODO: this can be a performance bottleneck
-        for k in keywords:
-            if cand in k and not cand is k:
-                return True
-        return False
-
-    def extract_keywords(self, tokens, num=10, remove_redundant=True):
-        freqs = FreqDist(tokens)
-        freqs = [(key, freq*len(key.split(' '))) for key, freq in freqs.items()]
-        freqs = sorted(freqs, key=lambda word_freq: -word_freq[1])
-        keywords, freqs = zip(*freqs)
-        if num:
-            keywords = keywords[:num]
+    def contained_phrases(self, keywords):
+        """
+        Returns all phrases that are a proper part of some keyword, on token
+        boundaries. Keywords are short, so this is linear in their number.
+        """
+        contained = set()
+        for keyword in keywords:
+            tokens = keyword.split(' ')
+            for n in range(1, len(tokens)):
+                for i in range(len(tokens)-n+1):
+                    contained.add(' '.join(tokens[i:i+n]))
+        return contained
+
+    def remove_redundant(self, keywords):
+        """
+        Removes keywords that are contained in a longer keyword, e.g. 'stress'
+        if there is 'oxidative stress', but not 'age' because of 'aging'.
+        """
+        contained = self.contained_phrases(keywords)
+        return [keyword for keyword in keywords if keyword not in contained]
+
+    def counter(self, capacity=None):
+        """
+        Returns a counter of keyword candidates. With a capacity, it is a
+        Space-Saving sketch that never holds more than `capacity` candidates,
+        otherwise all candidates are counted exactly.
+        """
+        return SpaceSaving(capacity) if capacity else ExactCounter()
+
+    def count(self, counter, tokens):
+        """
+        Adds tokens to the counter. Every occurrence of a phrase counts as
+        many times as it has words, so that longer phrases are preferred.
+        """
+        for token in tokens:
+            counter.add(token, token.count(' ') + 1)
+
+    def select_keywords(self, counter, num=10, remove_redundant=True):
+        keywords = tuple(keyword for keyword, freq in counter.top(num or None))
         if remove_redundant:
-            keywords = [keyword for keyword in keywords if not self.is_redundant(keyword, keywords)]
+            keywords = self.remove_redundant(keywords)
         return keywords
 
+    def extract_keywords(self, tokens, num=10, remove_redundant=True, capacity=None):
+        """
+        Returns the `num` most frequent phrases of a (possibly lazy) iterable of
+        tokens.
+
+        @param capacity maximal number of distinct candidates kept in memory.
+            By default all candidates are counted exactly.
+        """
+        counter = self.counter(capacity)
+        self.count(counter, tokens)
+        return self.select_keywords(counter, num, remove_redundant)
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Compute potential keywords from a set of papers')
-    parser.add_argument('--in', dest='input', help='Path to file containing crawled paper titles', default='papers.json')
+    parser.add_argument('--in', dest='input', help='Path to the json or jsonl file containing crawled papers', default='papers.json')
     parser.add_argument('--out', dest='output', help='Path to the file where to store keywords', default='aging_keywords.txt')
     parser.add_argument('--num', dest='num', type=int, help='Number of keyword candidates to produce', default=400)
+    parser.add_argument('--capacity', dest='capacity', type=int, help='Maximal number of distinct candidates to keep in memory. Counts of frequent candidates are then approximate. By default all candidates are counted exactly.', default=None)
     tokenizer = Tokenizer()
     tokenizer.register_options(parser)
+    metrics = Metrics()
+    metrics.register_options(parser)
     args = parser.parse_args()
     tokenizer.prepare(args)
+    metrics.prepare(args)
     extractor = KeywordsExtractor()
-    with open(args.input, 'r') as input, open(args.output, 'w') as output:
-        papers = json.load(input)
-        processor = PubmedProcessor(papers, tokenizer.tokenize)
-        title_keywords = extractor.extract_keywords(itertools.chain.from_iterable(processor.extract_title_tokens().values()), args.num, remove_redundant=True)
-        mesh_keywords = extractor.extract_keywords(itertools.chain.from_iterable(processor.extract_mesh_tokens().values()), args.num, remove_redundant=False)
+    processor = PubmedProcessor(tokenizer.tokenize)
+    title_counter = extractor.counter(args.capacity)
+    mesh_counter = extractor.counter(args.capacity)
+    with metrics, metrics.stage('extract_keywords'):
+        for info in processor.iter_paper_info(iter_records(args.input)):
+            extractor.count(title_counter, info['title'])
+            extractor.count(mesh_counter, info['meshes'])
+            metrics.inc('papers_processed_total')
+        title_keywords = extractor.select_keywords(title_counter, args.num, remove_redundant=True)
+        mesh_keywords = extractor.select_keywords(mesh_counter, args.num, remove_redundant=False)
+    with open(args.output, 'w') as output:
         output.write('### Keywords extracted from titles\n')
         output.write('\n'.join(title_keywords))
         output.write('\n### Mesh-keywords\n')
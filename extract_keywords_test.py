@@ -0,0 +1,50 @@
+import unittest
+import random
+
+from extract_keywords import KeywordsExtractor
+from heavy_hitters import SpaceSaving
+
+
+class ExtractKeywordsTest(unittest.TestCase):
+
+    def test_remove_redundant(self):
+        extractor = KeywordsExtractor()
+
+        keywords = extractor.remove_redundant(['oxidative stress', 'stress', 'age', 'aging', 'c elegans lifespan', 'elegans'])
+
+        self.assertEqual(keywords, ['oxidative stress', 'age', 'aging', 'c elegans lifespan'])
+
+    def test_extract_keywords(self):
+        extractor = KeywordsExtractor()
+        tokens = ['aging', 'aging', 'aging', 'mice', 'aging mice', 'aging mice', 'stress']
+
+        self.assertEqual(extractor.extract_keywords(tokens, num=2), ['aging mice'])
+        self.assertEqual(extractor.extract_keywords(tokens, num=2, remove_redundant=False), ('aging mice', 'aging'))
+
+    def test_extract_keywords_bounded_memory(self):
+        extractor = KeywordsExtractor()
+        rand = random.Random(0)
+        frequent = ['aging'] * 300 + ['oxidative stress'] * 200 + ['mice'] * 150
+        rare = ['rare{}'.format(i) for i in range(2000)]
+        tokens = frequent + rare
+        rand.shuffle(tokens)
+
+        keywords = extractor.extract_keywords(iter(tokens), num=3, remove_redundant=False, capacity=50)
+
+        self.assertEqual(keywords, ('oxidative stress', 'aging', 'mice'))
+
+    def test_space_saving_error_bound(self):
+        sketch = SpaceSaving(10)
+        rand = random.Random(0)
+        items = [rand.randint(0, 100) for _ in range(5000)]
+        for item in items:
+            sketch.add(item)
+
+        self.assertLessEqual(len(sketch.counts), 10)
+        for item, count in sketch.counts.items():
+            self.assertGreaterEqual(count, items.count(item))
+            self.assertLessEqual(count - sketch.error(item), items.count(item))
+            self.assertLessEqual(sketch.error(item), sketch.max_error())
+
+if __name__ == '__main__':
+    unittest.main()
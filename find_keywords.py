@@ -1,11 +1,21 @@
-import json
 import argparse
-import nltk
 import itertools
-from nltk.probability import FreqDist
+import os
+import numpy as np
+from collections import Counter
 
 from tokenizer import Tokenizer
 from pubmed_processor import PubmedProcessor
+from checkpoint import load_records
+from ngrams import NgramEncoder, ngram_hashes_csr, phrase_hashes_csr
+from paper_columns import PaperColumns, is_columnar, default_vocabulary_path
+from keyword_index import KeywordIndex
+from corpus_stats import CorpusStats
+from phrase_matcher import PhraseMatcher
+from metrics import Metrics
+
+# Number of papers whose n-grams are hashed at once by columnar_index.
+COLUMNAR_CHUNK_SIZE = 10000
 
 
 class KeywordsFinder(object):
@@ -27,7 +37,13 @@ class KeywordsFinder(object):
         Given a dict of paper tokens returns a list of keywords that appear in
         at least `keyword_threshold` papers.
         """
-        keyword_counts = [(k, self.count_appearances(k, tokens)) for k in self.keywords_list]
+        return self.select_keywords((k, self.count_appearances(k, tokens)) for k in self.keywords_list)
+
+    def select_keywords(self, keyword_counts):
+        """
+        Given (keyword, number of papers) pairs returns keywords that appear in
+        at least `keyword_threshold` papers, most frequent first.
+        """
         keyword_counts = [(k, num) for (k, num) in keyword_counts if num >= self.keyword_threshold]
         keyword_counts = sorted(keyword_counts, key=lambda kw_count: -kw_count[1])
         if len(keyword_counts) == 0:
@@ -35,15 +51,247 @@ class KeywordsFinder(object):
         keywords, counts = zip(*keyword_counts)
         return keywords
 
-def find_keywords(finder, papers, max_num_keywords=5):
-    paper_tokens = {res_id:
-                    {paper_id:
-                        set(info['title'] + info['meshes'])
-                        for paper_id, info in res_info['papers'].items()
-                    } for res_id, res_info in papers.items()
-                  }
-    keywords = {res_id: finder.keywords(tokens_dict)[:max_num_keywords]
-                    for (res_id, tokens_dict) in paper_tokens.items()}
+    def index(self, papers):
+        """
+        Builds a KeywordIndex of processed papers in a single pass over their
+        tokens. Paper info objects shared by several researchers, see
+        PubmedProcessor, are only scanned once.
+        """
+        keyword_index = {}
+        for i, k in enumerate(self.keywords_list):
+            keyword_index.setdefault(k, i)
+        found_in_paper = {}
+        researcher_indices, keyword_indices = [], []
+        for r, res_info in enumerate(papers.values()):
+            for info in res_info['papers'].values():
+                # Papers outlive this loop, so their ids are never reused.
+                found = found_in_paper.get(id(info))
+                if found is None:
+                    found = found_in_paper[id(info)] = [
+                        k for k in map(keyword_index.get, set(info['title'] + info['meshes'])) if k is not None]
+                researcher_indices.extend([r] * len(found))
+                keyword_indices.extend(found)
+        return KeywordIndex(self.keywords_list, papers.keys(), researcher_indices, keyword_indices)
+
+    def keyword_keys(self, encoder):
+        """
+        Returns sorted hashes of keyword phrases and the keyword index of every
+        hash, see NgramEncoder.phrase_key.
+        """
+        keys = {}
+        for i, k in enumerate(self.keywords_list):
+            key = encoder.phrase_key(k)
+            if key is not None:
+                keys.setdefault(key, i)
+        sorted_keys = np.array(sorted(keys.keys()), dtype=np.uint64)
+        key_keywords = np.array([keys[key] for key in sorted_keys.tolist()], dtype=np.int64)
+        return sorted_keys, key_keywords
+
+    def encoded_index(self, papers, encoder, max_n):
+        """
+        Builds a KeywordIndex of papers processed with a vocabulary.
+        """
+        sorted_keys, key_keywords = self.keyword_keys(encoder)
+        researcher_indices, keyword_indices = [], []
+        for r, res_info in enumerate(papers.values()):
+            found = np.concatenate([encoder.paper_keys(info, max_n) for info in res_info['papers'].values()]
+                                   + [np.array([], dtype=np.uint64)])
+            positions = np.searchsorted(sorted_keys, found)
+            known = positions < len(sorted_keys)
+            known[known] = sorted_keys[positions[known]] == found[known]
+            keyword_indices.append(key_keywords[positions[known]])
+            researcher_indices.append(np.full(np.count_nonzero(known), r))
+        return KeywordIndex(self.keywords_list, papers.keys(),
+                            np.concatenate(researcher_indices + [np.array([], dtype=np.int64)]),
+                            np.concatenate(keyword_indices + [np.array([], dtype=np.int64)]))
+
+    def columnar_index(self, columns, encoder, max_n, chunk_size=COLUMNAR_CHUNK_SIZE):
+        """
+        Builds a KeywordIndex of PaperColumns. Title n-grams and meshes are
+        hashed with a few numpy operations straight from the memory-mapped
+        columns, `chunk_size` papers at a time to bound memory, and every
+        paper is looked at once however many researchers list it.
+        """
+        sorted_keys, key_keywords = self.keyword_keys(encoder)
+        title_offsets, mesh_offsets = columns.offsets('title_tokens'), columns.offsets('meshes')
+        phrase_offsets = columns.offsets('mesh_tokens')
+        paper_rows, keyword_indices = [np.array([], dtype=np.int64)], [np.array([], dtype=np.int64)]
+        for start in range(0, len(title_offsets) - 1, chunk_size):
+            end = min(start + chunk_size, len(title_offsets) - 1)
+            titles = title_offsets[start:end+1]
+            title_rows, title_keys = ngram_hashes_csr(
+                columns.column('title_tokens')[titles[0]:titles[-1]], titles - titles[0], max_n)
+            meshes = phrase_offsets[mesh_offsets[start]:mesh_offsets[end]+1]
+            mesh_keys = phrase_hashes_csr(columns.column('mesh_tokens')[meshes[0]:meshes[-1]], meshes - meshes[0])
+            mesh_rows = np.repeat(np.arange(end - start), np.diff(mesh_offsets[start:end+1]))
+            rows, found = np.concatenate([title_rows, mesh_rows]), np.concatenate([title_keys, mesh_keys])
+            positions = np.searchsorted(sorted_keys, found)
+            known = positions < len(sorted_keys)
+            known[known] = sorted_keys[positions[known]] == found[known]
+            paper_rows.append(rows[known] + start)
+            keyword_indices.append(key_keywords[positions[known]])
+        return self.columnar_postings(columns, np.concatenate(paper_rows), np.concatenate(keyword_indices))
+
+    def columnar_matcher_index(self, columns, encoder):
+        """
+        Same as matcher_index for PaperColumns.
+        """
+        matcher = PhraseMatcher([encoder.known_phrase(k) or () for k in self.keywords_list])
+        rows, keyword_indices = [], []
+        for p in range(len(columns.offsets('title_tokens')) - 1):
+            found = set(matcher.match(columns.row('title_tokens', p).tolist()))
+            found.update(matcher.match_whole(columns.row('mesh_tokens', m).tolist()) for m in columns.phrases('meshes', p))
+            found.discard(None)
+            rows.extend([p] * len(found))
+            keyword_indices.extend(found)
+        return self.columnar_postings(columns, rows, keyword_indices)
+
+    def columnar_postings(self, columns, paper_rows, keyword_indices):
+        """
+        Turns (paper row, keyword index) pairs of PaperColumns into a
+        KeywordIndex, with one posting for every researcher listing the paper.
+        """
+        num_keywords = max(1, len(self.keywords_list))
+        codes = np.unique(np.asarray(paper_rows, dtype=np.int64) * num_keywords + np.asarray(keyword_indices, dtype=np.int64))
+        paper_rows, keyword_indices = codes // num_keywords, codes % num_keywords
+        # Keywords of the paper in row p are keyword_indices[starts[p]:starts[p]+counts[p]].
+        num_paper_rows = len(columns.offsets('title_tokens')) - 1
+        starts = np.searchsorted(paper_rows, np.arange(num_paper_rows))
+        counts = np.searchsorted(paper_rows, np.arange(num_paper_rows), side='right') - starts
+        listed = columns.column('researcher_papers')
+        researchers = np.repeat(np.arange(columns.num_researchers), np.diff(columns.offsets('researcher_papers')))
+        listed_counts = counts[listed]
+        first = np.cumsum(listed_counts) - listed_counts
+        postings = np.repeat(starts[listed] - first, listed_counts) + np.arange(int(listed_counts.sum()))
+        return KeywordIndex(self.keywords_list, columns.researcher_ids,
+                            np.repeat(researchers, listed_counts), keyword_indices[postings])
+
+    def matcher_index(self, papers, encoder=None):
+        """
+        Builds a KeywordIndex by scanning single title tokens with a
+        PhraseMatcher compiled from the keywords, instead of looking keywords up
+        among precomputed n-grams. Keywords of any length can be found. Meshes
+        still have to be equal to a keyword to match it.
+
+        @param encoder NgramEncoder, if papers were processed with a vocabulary.
+        """
+        if encoder is None:
+            phrases = [k.split(' ') if k else () for k in self.keywords_list]
+            # Single tokens come first in processed titles, followed by n-grams
+            # which always contain a space.
+            title_tokens = lambda title: itertools.takewhile(lambda token: ' ' not in token, title)
+            mesh_tokens = lambda mesh: mesh.split(' ')
+        else:
+            phrases = [encoder.known_phrase(k) or () for k in self.keywords_list]
+            title_tokens = mesh_tokens = lambda tokens: tokens
+        matcher = PhraseMatcher(phrases)
+        found_in_paper = {}
+        researcher_indices, keyword_indices = [], []
+        for r, res_info in enumerate(papers.values()):
+            for info in res_info['papers'].values():
+                found = found_in_paper.get(id(info))
+                if found is None:
+                    found = set(matcher.match(title_tokens(info['title'])))
+                    found.update(matcher.match_whole(mesh_tokens(mesh)) for mesh in info['meshes'])
+                    found.discard(None)
+                    found_in_paper[id(info)] = found
+                researcher_indices.extend([r] * len(found))
+                keyword_indices.extend(found)
+        return KeywordIndex(self.keywords_list, papers.keys(), researcher_indices, keyword_indices)
+
+def num_papers(papers):
+    return sum(len(res_info['papers']) for res_info in papers.values())
+
+def corpus_stats(index, num_papers, path=None):
+    """
+    Loads corpus stats from `path` if it exists and was computed for the same
+    keywords and corpus size, otherwise computes them from the index and
+    saves them to `path`.
+    """
+    if path and os.path.exists(path):
+        stats = CorpusStats.load(path)
+        if stats.matches(index.keywords, len(index.researcher_ids), num_papers):
+            return stats
+        print('Recomputing stale corpus stats in {}'.format(path))
+    stats = CorpusStats.from_index(index, num_papers)
+    if path:
+        stats.save(path)
+    return stats
+
+def top_keywords(finder, index, papers, max_num_keywords, rank='count', stats_path=None, stats=None):
+    weights = None
+    if rank == 'tfidf':
+        stats = stats or corpus_stats(index, num_papers(papers), stats_path)
+        weights = [stats.idf(k) for k in finder.keywords_list]
+    return index.top_keywords(finder.keyword_threshold, max_num_keywords, weights)
+
+def find_keywords(finder, papers, max_num_keywords=5, rank='count', stats_path=None, match='ngrams', stats=None):
+    """
+    @param match 'ngrams' to look keywords up among title n-grams stored by
+        pubmed_processor.py, 'automaton' to scan title tokens with a
+        PhraseMatcher, which also finds keywords longer than the n-grams.
+    @param rank 'count' to rank keywords of a researcher by the number of
+        papers they appear in, 'tfidf' to also down-weight keywords common to
+        many researchers.
+    @param stats_path file to load corpus stats from, or to save them to if it
+        doesn't exist yet.
+    @param stats already loaded CorpusStats, e.g. to rank a few researchers at
+        a time against stats of the whole corpus.
+    """
+    index = build_index(finder, papers, match)
+    keywords = top_keywords(finder, index, papers, max_num_keywords, rank, stats_path, stats)
+    return _format_keywords(papers, keywords)
+
+def build_index(finder, papers, match='ngrams'):
+    return finder.matcher_index(papers) if match == 'automaton' else finder.index(papers)
+
+def find_keywords_in_state(finder, state, max_num_keywords=5, rank='count'):
+    """
+    Same as find_keywords for keyword counts accumulated in a KeywordState by
+    incremental runs. No paper is looked at, and corpus stats for
+    --rank tfidf are computed from the counts as well.
+    """
+    index = state.index(finder.keywords_list)
+    stats = CorpusStats.from_index(index, state.num_papers()) if rank == 'tfidf' else None
+    keywords = top_keywords(finder, index, state.researchers, max_num_keywords, rank, stats=stats)
+    return _format_keywords(state.researchers, keywords)
+
+def find_keywords_encoded(finder, papers, encoder, max_n=None, max_num_keywords=5, rank='count', stats_path=None, match='ngrams', stats=None):
+    """
+    Same as find_keywords for papers processed with a vocabulary. Title
+    n-grams and keywords are compared as hashes of token ids, keywords are
+    turned back into strings only in the result.
+
+    @param max_n length of the longest title phrase to consider, by default
+        the length of the longest keyword.
+    """
+    if match == 'automaton':
+        index = finder.matcher_index(papers, encoder)
+    else:
+        if max_n is None:
+            max_n = max(len(k.split(' ')) for k in finder.keywords_list)
+        index = finder.encoded_index(papers, encoder, max_n)
+    keywords = top_keywords(finder, index, papers, max_num_keywords, rank, stats_path, stats)
+    return _format_keywords(papers, keywords)
+
+def find_keywords_columnar(finder, columns, encoder, max_n=None, max_num_keywords=5, rank='count', stats_path=None, match='ngrams', stats=None):
+    """
+    Same as find_keywords_encoded for PaperColumns, which are queried in
+    place instead of being loaded.
+    """
+    if match == 'automaton':
+        index = finder.columnar_matcher_index(columns, encoder)
+    else:
+        if max_n is None:
+            max_n = max(len(k.split(' ')) for k in finder.keywords_list)
+        index = finder.columnar_index(columns, encoder, max_n)
+    if rank == 'tfidf' and stats is None:
+        stats = corpus_stats(index, columns.num_papers, stats_path)
+    keywords = top_keywords(finder, index, None, max_num_keywords, rank, stats=stats)
+    names = {id: {'researcher': name} for id, name in columns.researcher_names().items()}
+    return _format_keywords(names, keywords)
+
+def _format_keywords(papers, keywords):
     # remove potential duplicates.
     keywords = {id: list(set(kw)) for id, kw in keywords.items()}
     keywords = {
@@ -52,43 +300,79 @@ def find_keywords(finder, papers, max_num_keywords=5):
     }
     return keywords
 
+def format_keyword(keyword):
+    # Mesh headings like 'aging, premature' read better as 'premature aging'.
+    if ', ' in keyword:
+        p1, p2 = keyword.split(', ')
+        return p2 + ' ' + p1
+    return keyword
+
+def csv_line(id, researcher_keywords):
+    return ';'.join([id, researcher_keywords['researcher'], ';',
+                     '; '.join([format_keyword(kw) for kw in researcher_keywords['keywords']])])
+
 def filter_generics(finder, keywords, unique_threshold = 10):
+    """
+    Removes keywords assigned to more than `unique_threshold` percent of
+    researchers.
+    """
     num_researchers = len([id for id, v in keywords.items() if len(v['keywords']) > 0])
     unique_th = unique_threshold * num_researchers // 100
-    merged_keywords = list( itertools.chain.from_iterable(v['keywords'] for v in keywords.values()))
-    generics = [kw for kw in finder.keywords_list if merged_keywords.count(kw) > unique_th]
+    counts = Counter(itertools.chain.from_iterable(v['keywords'] for v in keywords.values()))
+    generics = {kw for kw in finder.keywords_list if counts[kw] > unique_th}
     print('Found generics:')
-    print(generics)
-    return [kw for kw in keywords if kw not in set(generics)]
+    print(sorted(generics))
+    return {
+        id: dict(v, keywords=[kw for kw in v['keywords'] if kw not in generics])
+        for id, v in keywords.items()
+    }
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Find keywords in a set of papers')
-    parser.add_argument('--in', dest='input', help='Path to the json file containing crawled papers', default='processed_papers.json')
+    parser.add_argument('--in', dest='input', help='Path to the json, jsonl or .cols file containing processed papers', default='processed_papers.json')
     parser.add_argument('--out', dest='output', help='Path to the csv file where to store found keywords', default='keywords.csv')
     parser.add_argument('--max_keywords', dest='max_keywords', type=int, help='Maximum number of keywords to assign a researcher', default=5)
+    parser.add_argument('--vocabulary', help='Vocabulary file written by pubmed_processor.py, if papers were processed with one. For .cols files, the .vocab file next to them by default.', default=None)
+    parser.add_argument('--rank', choices=['count', 'tfidf'], help='Rank keywords of a researcher by the number of papers they appear in, or by tf-idf to down-weight keywords common to many researchers', default='count')
+    parser.add_argument('--stats', dest='stats_path', help='Corpus stats file used by --rank tfidf. Computed and saved there if it doesn\'t exist yet.', default=None)
+    parser.add_argument('--match', choices=['ngrams', 'automaton'], help='Look keywords up among title n-grams, or scan titles token by token for keywords of any length. For the latter, papers can be processed with --ngrams 1.', default='ngrams')
+    parser.add_argument('--ngrams', type=int, help='With --vocabulary, longest title phrase to match. By default the length of the longest keyword.', default=None)
+    parser.add_argument('--filter_generics', dest='generics_threshold', type=int, help='Drop keywords assigned to more than this percent of researchers. Nothing is dropped by default.', default=None)
 
     tokenizer = Tokenizer()
     tokenizer.register_options(parser)
     finder = KeywordsFinder()
     finder.register_options(parser)
+    metrics = Metrics()
+    metrics.register_options(parser)
 
     args = parser.parse_args()
     finder.prepare(args)
     tokenizer.prepare(args)
+    metrics.prepare(args)
 
-    def format(k):
-        if ', ' in k:
-            p1, p2 = k.split(', ')
-            return p2 + ' ' + p1
-        return k
-
-    with open(args.input, 'r') as input, \
-         open(args.output, 'w') as output:
-        papers = json.load(input)
-        keywords = find_keywords(finder, papers, max_num_keywords=args.max_keywords)
-        keywords_csv = [
-            ';'.join([id, k['researcher'], ';', '; '.join([format(kw) for kw in k['keywords']])])
-            for id, k in keywords.items()
-        ]
+    with metrics, open(args.output, 'w') as output:
+        with metrics.stage('load'):
+            papers = PaperColumns.open(args.input) if is_columnar(args.input) else load_records(args.input)
+        if is_columnar(args.input):
+            metrics.inc('researchers_total', papers.num_researchers)
+        else:
+            metrics.inc('researchers_total', len(papers))
+        with metrics.stage('find_keywords'):
+            if is_columnar(args.input):
+                encoder = NgramEncoder.load(args.vocabulary or default_vocabulary_path(args.input))
+                keywords = find_keywords_columnar(finder, papers, encoder,
+                                                  max_n=args.ngrams, max_num_keywords=args.max_keywords,
+                                                  rank=args.rank, stats_path=args.stats_path, match=args.match)
+            elif args.vocabulary:
+                keywords = find_keywords_encoded(finder, papers, NgramEncoder.load(args.vocabulary),
+                                                 max_n=args.ngrams, max_num_keywords=args.max_keywords,
+                                                 rank=args.rank, stats_path=args.stats_path, match=args.match)
+            else:
+                keywords = find_keywords(finder, papers, max_num_keywords=args.max_keywords,
+                                         rank=args.rank, stats_path=args.stats_path, match=args.match)
+        if args.generics_threshold is not None:
+            keywords = filter_generics(finder, keywords, args.generics_threshold)
+        keywords_csv = [csv_line(id, k) for id, k in keywords.items()]
         output.write('\n'.join(keywords_csv))
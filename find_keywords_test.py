@@ -1,6 +1,14 @@
 import unittest
+import os
 
-from find_keywords import KeywordsFinder
+import random
+
+from corpus_stats import CorpusStats
+from find_keywords import KeywordsFinder, find_keywords, find_keywords_encoded, filter_generics
+from ngrams import NgramEncoder
+
+STATS = 'test_stats.json'
+VOCABULARY = 'test_papers.vocab'
 
 
 class FindKeywordsTest(unittest.TestCase):
@@ -33,5 +41,140 @@ class FindKeywordsTest(unittest.TestCase):
 
         self.assertEqual(finder.keywords({1: ['kw1', 'kw2'], 2: ['kw2']}), ('kw2', 'kw1'))
 
+    def test_index_matches_keywords(self):
+        finder = KeywordsFinder()
+        finder.keywords_list = ['kw{}'.format(i) for i in range(20)]
+        finder.keyword_threshold = 2
+        rand = random.Random(0)
+        words = finder.keywords_list + ['other{}'.format(i) for i in range(20)]
+        papers = {
+            res_id: {'researcher': res_id, 'papers': {
+                paper_id: {'title': rand.sample(words, 5), 'meshes': rand.sample(words, 2), 'other': []}
+                for paper_id in range(rand.randint(0, 8))
+            }}
+            for res_id in range(30)
+        }
+
+        top_keywords = finder.index(papers).top_keywords(finder.keyword_threshold, 3)
+        matched_keywords = finder.matcher_index(papers).top_keywords(finder.keyword_threshold, 3)
+
+        for res_id, res_info in papers.items():
+            tokens = {paper_id: set(info['title'] + info['meshes']) for paper_id, info in res_info['papers'].items()}
+            self.assertEqual(top_keywords[res_id], finder.keywords(tokens)[:3])
+            self.assertEqual(matched_keywords[res_id], finder.keywords(tokens)[:3])
+
+    def test_find_long_keywords(self):
+        finder = KeywordsFinder()
+        finder.keywords_list = ['dietary restriction extends lifespan', 'lifespan']
+        finder.keyword_threshold = 1
+        papers = {'1': {'researcher': 'A', 'papers': {
+            '1': {'title': ['dietary', 'restriction', 'extends', 'lifespan', 'dietary restriction'], 'meshes': [], 'other': []},
+        }}}
+
+        by_ngrams = find_keywords(finder, papers)
+        by_automaton = find_keywords(finder, papers, match='automaton')
+
+        self.assertEqual(by_ngrams['1']['keywords'], ['lifespan'])
+        self.assertEqual(sorted(by_automaton['1']['keywords']), ['dietary restriction extends lifespan', 'lifespan'])
+
+    def test_find_keywords_tfidf(self):
+        finder = KeywordsFinder()
+        finder.keywords_list = ['aging', 'autophagy']
+        finder.keyword_threshold = 1
+        paper = lambda *tokens: {'title': list(tokens), 'meshes': [], 'other': []}
+        papers = {
+            '1': {'researcher': 'A', 'papers': {'1': paper('aging', 'autophagy'), '2': paper('autophagy', 'aging')}},
+            '2': {'researcher': 'B', 'papers': {'1': paper('aging')}},
+            '3': {'researcher': 'C', 'papers': {'1': paper('aging')}},
+        }
+
+        by_count = find_keywords(finder, papers, max_num_keywords=1)
+        by_tfidf = find_keywords(finder, papers, max_num_keywords=1, rank='tfidf')
+
+        self.assertEqual(by_count['1']['keywords'], ['aging'])
+        self.assertEqual(by_tfidf['1']['keywords'], ['autophagy'])
+
+    def test_stale_stats_are_recomputed(self):
+        finder = KeywordsFinder()
+        finder.keywords_list = ['aging', 'autophagy']
+        finder.keyword_threshold = 1
+        papers = {'1': {'researcher': 'A', 'papers': {'1': {'title': ['aging'], 'meshes': [], 'other': []}}}}
+        try:
+            CorpusStats(100, 1000, {'aging': 100}, {'aging': 1000}, keywords=['aging']).save(STATS)
+            find_keywords(finder, papers, rank='tfidf', stats_path=STATS)
+            stats = CorpusStats.load(STATS)
+            self.assertEqual((stats.keywords, stats.num_researchers, stats.num_papers), (['aging', 'autophagy'], 1, 1))
+
+            # Stats of the same keywords and corpus are reused.
+            CorpusStats(1, 1, {'autophagy': 1}, {'autophagy': 1}, keywords=['aging', 'autophagy']).save(STATS)
+            find_keywords(finder, papers, rank='tfidf', stats_path=STATS)
+            self.assertEqual(CorpusStats.load(STATS).researcher_df, {'autophagy': 1})
+        finally:
+            os.remove(STATS)
+
+    def test_filter_generics(self):
+        finder = KeywordsFinder()
+        finder.keywords_list = ['aging', 'autophagy']
+        keywords = {str(i): {'researcher': str(i), 'keywords': ['aging']} for i in range(10)}
+        keywords['0']['keywords'].append('autophagy')
+
+        filtered = filter_generics(finder, keywords, unique_threshold=50)
+
+        self.assertEqual(filtered['0']['keywords'], ['autophagy'])
+        self.assertEqual(filtered['1']['keywords'], [])
+
+    def test_find_keywords_encoded(self):
+        finder = KeywordsFinder()
+        finder.keywords_list = ['oxidative stress', 'aging', 'stress aging mice', 'caloric restriction', 'unknown word', '']
+        finder.keyword_threshold = 1
+        unigrams = {
+            '1': {'researcher': 'A', 'papers': {
+                '1': {'title': ['oxidative', 'stress', 'aging', 'mice'], 'meshes': ['caloric restriction'], 'other': []},
+                '2': {'title': ['aging', 'aging'], 'meshes': [], 'other': []},
+            }},
+            '2': {'researcher': 'B', 'papers': {}},
+        }
+        with_ngrams = {
+            '1': {'researcher': 'A', 'papers': {
+                '1': {'title': ['oxidative', 'stress', 'aging', 'mice', 'oxidative stress', 'stress aging', 'aging mice',
+                                'oxidative stress aging', 'stress aging mice'],
+                      'meshes': ['caloric restriction'], 'other': []},
+                '2': {'title': ['aging', 'aging', 'aging aging'], 'meshes': [], 'other': []},
+            }},
+            '2': {'researcher': 'B', 'papers': {}},
+        }
+        encoder = NgramEncoder()
+        encoded = {id: encoder.encode_researcher(res) for id, res in unigrams.items()}
+
+        expected = find_keywords(finder, with_ngrams)
+        actual = find_keywords_encoded(finder, encoded, encoder)
+        matched = find_keywords(finder, with_ngrams, match='automaton')
+        matched_encoded = find_keywords_encoded(finder, encoded, encoder, match='automaton')
+
+        for result in [actual, matched, matched_encoded]:
+            self.assertEqual({id: sorted(k['keywords']) for id, k in result.items()},
+                             {id: sorted(k['keywords']) for id, k in expected.items()})
+        self.assertEqual(sorted(actual['1']['keywords']), ['aging', 'caloric restriction', 'oxidative stress', 'stress aging mice'])
+
+    def test_vocabulary_round_trip(self):
+        encoder = NgramEncoder()
+        papers = {
+            '1': {'title': [], 'meshes': ['insulin\nresistance', 'aging'], 'other': ['a\r\nb']},
+            '2': {'title': ['autophagy', 'resistance'], 'meshes': [], 'other': []},
+        }
+        encoded = encoder.encode_researcher({'researcher': 'A', 'papers': papers})
+        encoder.save(VOCABULARY)
+
+        loaded = NgramEncoder.load(VOCABULARY)
+
+        self.assertEqual(loaded.vocabulary.tokens, encoder.vocabulary.tokens)
+        title = encoded['papers']['2']['title']
+        self.assertEqual([loaded.vocabulary.token(id) for id in title], ['autophagy', 'resistance'])
+
+    def tearDown(self):
+        for path in [STATS, VOCABULARY]:
+            if os.path.exists(path):
+                os.remove(path)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,83 @@
+import heapq
+from collections import Counter
+
+
+class ExactCounter(object):
+    """
+    Counts every item exactly. Memory grows with the number of distinct items.
+    """
+
+    def __init__(self):
+        self.counts = Counter()
+
+    def add(self, item, weight=1):
+        self.counts[item] += weight
+
+    def top(self, k=None):
+        """
+        Returns up to k (item, count) pairs with the largest counts, largest
+        first. Ties keep the order in which items were first seen.
+        """
+        return sorted(self.counts.items(), key=lambda item_count: -item_count[1])[:k]
+
+
+class SpaceSaving(object):
+    """
+    Space-Saving heavy hitters sketch that keeps at most `capacity` counters.
+    When a new item arrives and all counters are taken, the item with the
+    smallest count is replaced and the new one inherits its count.
+
+    Counts are never underestimated and overestimated by at most
+    total_weight / capacity, so every item heavier than that is guaranteed to
+    be tracked.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.total_weight = 0
+        # Heap of (count, item) entries. Entries become stale when the item's
+        # count changes, they are skipped when popped and dropped when the heap
+        # is rebuilt.
+        self.heap = []
+
+    def add(self, item, weight=1):
+        self.total_weight += weight
+        if item in self.counts:
+            self.counts[item] += weight
+        elif len(self.counts) < self.capacity:
+            self.counts[item] = weight
+            self.errors[item] = 0
+        else:
+            min_item, min_count = self._pop_min()
+            del self.counts[min_item]
+            del self.errors[min_item]
+            self.counts[item] = min_count + weight
+            self.errors[item] = min_count
+        heapq.heappush(self.heap, (self.counts[item], item))
+        if len(self.heap) > 4 * self.capacity:
+            self.heap = [(count, item) for item, count in self.counts.items()]
+            heapq.heapify(self.heap)
+
+    def _pop_min(self):
+        while True:
+            count, item = heapq.heappop(self.heap)
+            if self.counts.get(item) == count:
+                return item, count
+
+    def error(self, item):
+        """
+        Returns by how much the count of an item may be overestimated.
+        """
+        return self.errors.get(item, self.max_error())
+
+    def max_error(self):
+        return self.total_weight / self.capacity if self.capacity else 0
+
+    def top(self, k=None):
+        """
+        Returns up to k (item, count) pairs with the largest estimated counts,
+        largest first.
+        """
+        return heapq.nlargest(k if k is not None else len(self.counts), self.counts.items(), key=lambda item_count: item_count[1])
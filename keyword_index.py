@@ -0,0 +1,76 @@
+import numpy as np
+
+
+class KeywordIndex(object):
+    """
+    Sparse researcher x keyword matrix that holds in how many papers of every
+    researcher each keyword appears. It is stored as three parallel arrays
+    (researcher index, keyword index, count) sorted by researcher, so that
+    queries for all researchers are answered with a few numpy operations.
+
+    @param keywords list of keywords, their position defines keyword indices.
+    @param researcher_ids list of researcher ids, their position defines
+        researcher indices.
+    @param researcher_indices, keyword_indices postings: one (researcher,
+        keyword) pair for every paper of the researcher that contains the
+        keyword.
+    """
+
+    def __init__(self, keywords, researcher_ids, researcher_indices, keyword_indices):
+        self.keywords = list(keywords)
+        self.researcher_ids = list(researcher_ids)
+        num_keywords = max(1, len(self.keywords))
+        codes = np.asarray(researcher_indices, dtype=np.int64) * num_keywords + np.asarray(keyword_indices, dtype=np.int64)
+        codes, self.counts = np.unique(codes, return_counts=True)
+        self.researcher_indices = codes // num_keywords
+        self.keyword_indices = codes % num_keywords
+
+    @classmethod
+    def from_counts(cls, keywords, researcher_ids, researcher_indices, keyword_indices, counts):
+        """
+        Builds an index from (researcher, keyword, count) triples instead of
+        one posting per paper. Counts of repeated pairs are added up.
+        """
+        index = cls(keywords, researcher_ids, [], [])
+        num_keywords = max(1, len(index.keywords))
+        codes = np.asarray(researcher_indices, dtype=np.int64) * num_keywords + np.asarray(keyword_indices, dtype=np.int64)
+        codes, inverse = np.unique(codes, return_inverse=True)
+        index.counts = np.bincount(inverse, weights=np.asarray(counts, dtype=np.int64), minlength=len(codes)).astype(np.int64)
+        index.researcher_indices = codes // num_keywords
+        index.keyword_indices = codes % num_keywords
+        return index
+
+    def _rows(self, researcher_indices):
+        return np.searchsorted(researcher_indices, np.arange(len(self.researcher_ids)+1))
+
+    def counts_for(self, researcher_id):
+        """
+        Returns a dict of keyword counts of a single researcher.
+        """
+        rows = self._rows(self.researcher_indices)
+        i = self.researcher_ids.index(researcher_id)
+        return {self.keywords[k]: int(c) for k, c in zip(
+            self.keyword_indices[rows[i]:rows[i+1]], self.counts[rows[i]:rows[i+1]])}
+
+    def top_keywords(self, threshold, k=None, weights=None):
+        """
+        Returns a dict from researcher id to a tuple of up to k keywords that
+        appear in at least `threshold` of their papers, most frequent first.
+        Ties keep the order of the keywords list.
+
+        @param weights optional array with a weight for every keyword. If
+            given, keywords are ranked by count * weight instead of count.
+        """
+        mask = self.counts >= threshold
+        researchers = self.researcher_indices[mask]
+        keywords = self.keyword_indices[mask]
+        scores = self.counts[mask]
+        if weights is not None:
+            scores = scores * np.asarray(weights)[keywords]
+        order = np.lexsort((keywords, -scores, researchers))
+        researchers, keywords = researchers[order], keywords[order]
+        rows = self._rows(researchers)
+        return {
+            res_id: tuple(self.keywords[kw] for kw in keywords[rows[i]:rows[i+1]][:k])
+            for i, res_id in enumerate(self.researcher_ids)
+        }
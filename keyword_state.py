@@ -0,0 +1,96 @@
+import json
+import os
+
+from keyword_index import KeywordIndex
+
+
+class KeywordState(object):
+    """
+    What incremental runs remember about every researcher: the date of the
+    last complete crawl, the ids of papers already counted, and in how many of
+    those papers every keyword appears. Keyword counts are additive, so new
+    papers are counted on their own and added to the stored counts.
+
+    Stored as a json object with the 'keywords' the counts are for, and
+    'researchers' keyed by researcher id, every value a dict with
+    'researcher', 'last_seen', 'paper_ids' and 'counts'.
+    """
+
+    def __init__(self, researchers=None, keywords=None):
+        self.researchers = researchers or {}
+        self.keywords = keywords
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads the state from `path`, or returns an empty state if there is no
+        such file yet.
+        """
+        if not os.path.exists(path):
+            return cls()
+        with open(path, 'r') as input:
+            state = json.load(input)
+        if 'researchers' not in state or 'keywords' not in state:
+            # Written before keywords were stored, they are unknown.
+            return cls(state)
+        return cls(state['researchers'], state['keywords'])
+
+    def save(self, path):
+        # Written next to the target and renamed, so a crash never leaves a
+        # half-written state behind.
+        with open(path + '.tmp', 'w') as output:
+            json.dump({'keywords': self.keywords, 'researchers': self.researchers}, output)
+        os.replace(path + '.tmp', path)
+
+    def matches(self, keywords):
+        """
+        Returns whether the counts were made for these keywords. Counts of
+        other keywords can't be updated, papers counted before are not kept.
+        """
+        return self.keywords == list(keywords)
+
+    def last_seen(self, researcher_id):
+        return self.researchers.get(researcher_id, {}).get('last_seen')
+
+    def known_paper_ids(self, researcher_id):
+        return set(self.researchers.get(researcher_id, {}).get('paper_ids', ()))
+
+    def update(self, researcher_id, name, paper_ids, counts, last_seen=None):
+        """
+        Adds keyword counts of new papers to a researcher.
+
+        @param paper_ids ids of the papers the counts come from. They are
+            skipped by following runs.
+        @param last_seen date of this crawl, if all new papers of the researcher
+            were crawled. Otherwise the previous date is kept, so that the next
+            run asks for the missing papers again.
+        """
+        state = self.researchers.setdefault(researcher_id, {'last_seen': None, 'paper_ids': [], 'counts': {}})
+        state['researcher'] = name
+        known = set(state['paper_ids'])
+        state['paper_ids'].extend(id for id in paper_ids if id not in known)
+        for keyword, count in counts.items():
+            state['counts'][keyword] = state['counts'].get(keyword, 0) + count
+        if last_seen is not None:
+            state['last_seen'] = last_seen
+
+    def num_papers(self):
+        return sum(len(state['paper_ids']) for state in self.researchers.values())
+
+    def index(self, keywords):
+        """
+        Builds a KeywordIndex from the stored counts, without looking at a
+        single paper.
+        """
+        keyword_index = {}
+        for i, k in enumerate(keywords):
+            keyword_index.setdefault(k, i)
+        researcher_indices, keyword_indices, counts = [], [], []
+        for r, state in enumerate(self.researchers.values()):
+            for keyword, count in state['counts'].items():
+                k = keyword_index.get(keyword)
+                if k is not None:
+                    researcher_indices.append(r)
+                    keyword_indices.append(k)
+                    counts.append(count)
+        return KeywordIndex.from_counts(keywords, self.researchers.keys(), researcher_indices, keyword_indices, counts)
@@ -0,0 +1,129 @@
+import argparse
+import asyncio
+import time
+from collections import Counter
+
+import aiohttp
+
+from downloader import Downloader
+from metrics import Metrics
+from mock_server import MockServer
+from pubmed_crawler import PubmedCrawler, PAPER_LIST_URL_PATTERN, PAPER_DETAILS_URL_PATTERN
+from synthetic_corpus import CorpusGenerator
+from whoswho_crawler import WhoswhoCrawler
+
+EUTILS_URL = 'https://eutils.ncbi.nlm.nih.gov'
+
+
+class RequestTracer(object):
+    """
+    Records client-side latency and status of every http request attempt
+    made by the retry client.
+    """
+
+    def __init__(self):
+        self.latencies = []
+        self.attempts = Counter()
+        self.statuses = Counter()
+
+    def trace_config(self):
+        config = aiohttp.TraceConfig()
+        config.on_request_start.append(self.on_request_start)
+        config.on_request_end.append(self.on_request_end)
+        config.on_request_exception.append(self.on_request_exception)
+        return config
+
+    async def on_request_start(self, session, context, params):
+        context.start = time.perf_counter()
+        self.attempts[str(params.url)] += 1
+
+    async def on_request_end(self, session, context, params):
+        self.latencies.append(time.perf_counter() - context.start)
+        self.statuses[params.response.status] += 1
+
+    async def on_request_exception(self, session, context, params):
+        self.latencies.append(time.perf_counter() - context.start)
+        self.statuses[type(params.exception).__name__] += 1
+
+    def percentile(self, p):
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))]
+
+
+async def run(args, researchers, papers, metrics=None):
+    server = MockServer()
+    server.prepare(args, researchers, papers)
+    base_url = await server.start()
+    tracer = RequestTracer()
+    try:
+        start = time.perf_counter()
+        whoswho = WhoswhoCrawler(Downloader(trace_configs=[tracer.trace_config()]))
+        if metrics is not None:
+            whoswho.downloader.metrics = metrics
+        whoswho.URL_PATTERN = base_url + '/people.php?page={}'
+        crawled_researchers = await whoswho.crawl(args, len(researchers))
+
+        pubmed = PubmedCrawler()
+        pubmed.downloader = Downloader(trace_configs=[tracer.trace_config()])
+        pubmed.paper_list_url_pattern = PAPER_LIST_URL_PATTERN.replace(EUTILS_URL, base_url)
+        pubmed.paper_details_url_pattern = PAPER_DETAILS_URL_PATTERN.replace(EUTILS_URL, base_url)
+        pubmed.prepare(args)
+        if metrics is not None:
+            pubmed.downloader.metrics = metrics
+        crawled_papers = await pubmed.crawl({str(id): name for id, name in crawled_researchers.items()})
+        seconds = time.perf_counter() - start
+    finally:
+        await server.stop()
+
+    expected_papers = sum(min(len(res['paper_ids']), args.max_papers) for res in papers.values())
+    num_requests = sum(tracer.attempts.values())
+    return {
+        'seconds': seconds,
+        'requests': num_requests,
+        'requests_per_second': num_requests / seconds,
+        'latency_p50': tracer.percentile(50),
+        'latency_p95': tracer.percentile(95),
+        'latency_p99': tracer.percentile(99),
+        # aiohttp silently resends requests dropped on reused connections, so
+        # retries are counted on the server side.
+        'retries': server.stats['requests'] - len(tracer.attempts),
+        'statuses': dict(tracer.statuses),
+        'server': dict(server.stats),
+        'researchers_expected': len(researchers),
+        'researchers_crawled': len(crawled_researchers),
+        'papers_expected': expected_papers,
+        'papers_crawled': sum(len(res['papers']) for res in crawled_papers.values()),
+    }
+
+
+def print_report(report):
+    print('{requests} requests in {seconds:.2f}s, {requests_per_second:.1f} requests/s'.format(**report))
+    print('Latency p50 {:.1f}ms, p95 {:.1f}ms, p99 {:.1f}ms'.format(
+        *(1000 * (report[key] or 0) for key in ('latency_p50', 'latency_p95', 'latency_p99'))))
+    print('Retried requests: {}'.format(report['retries']))
+    print('Responses: {}'.format(report['statuses']))
+    print('Server: {}'.format(report['server']))
+    print('Researchers: {researchers_crawled} of {researchers_expected} crawled'.format(**report))
+    print('Papers: {papers_crawled} of {papers_expected} crawled'.format(**report))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Crawl a synthetic corpus from a local mock server that injects latency, throttling and failures')
+    parser.add_argument('--keywords', dest='aging_keywords', help='Keywords to sprinkle into titles', default='filtered_aging_keywords.txt')
+    generator = CorpusGenerator()
+    generator.register_options(parser)
+    server = MockServer()
+    server.register_options(parser)
+    # Options of both crawlers and their downloader.
+    PubmedCrawler().register_options(parser)
+    metrics = Metrics()
+    metrics.register_options(parser)
+    args = parser.parse_args()
+    # The cache would hide the server.
+    args.downloader_cache = None
+    generator.prepare(args)
+    metrics.prepare(args)
+    with metrics:
+        print_report(asyncio.run(run(args, *generator.generate(), metrics=metrics)))
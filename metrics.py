@@ -0,0 +1,204 @@
+import contextlib
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+
+# Upper bounds, in seconds, of latency histogram buckets.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+DEFAULT_INTERVAL = 60
+
+
+def metric_key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels) + '}'
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        Returns the upper bound of the bucket containing the q-th quantile.
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank and count:
+                return bound
+        return float('inf') if self.count else None
+
+    def snapshot(self):
+        return {
+            'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'], self.counts)),
+            'sum': self.sum,
+            'count': self.count,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+        }
+
+
+class Metrics(object):
+    """
+    Counters, latency histograms and stage timers of a run. Disabled by
+    default, then every method returns right away, so instrumented code pays
+    a single attribute check.
+
+    Snapshots are written to the --metrics file at the end of a run and every
+    --metrics_interval seconds while it runs, as json or, if the file ends with
+    .prom, in the Prometheus text format.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.path = None
+        self.interval = DEFAULT_INTERVAL
+        self.reset()
+
+    def register_options(self, argparser):
+        argparser.add_argument('--metrics', dest='metrics_path', default=None,
+                               help='Path to a .json or .prom file where to dump metrics of the run. Metrics are not collected by default.')
+        argparser.add_argument('--metrics_interval', type=float, default=DEFAULT_INTERVAL,
+                               help='Number of seconds between metric dumps during the run, 0 to only dump at the end')
+
+    def prepare(self, args):
+        self.path = args.metrics_path
+        self.interval = args.metrics_interval
+        self.enabled = self.path is not None
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+        self.stop_event = None
+        self.thread = None
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = metric_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = metric_key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def _timer(self, name, labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timer(self, name, **labels):
+        """
+        Context manager observing its duration in the `name` histogram.
+        """
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._timer(name, labels)
+
+    def stage(self, name):
+        """
+        Context manager timing a pipeline stage.
+        """
+        return self.timer('stage_seconds', stage=name)
+
+    def snapshot(self):
+        with self.lock:
+            counters = list(self.counters.items())
+            histograms = [(key, histogram.snapshot()) for key, histogram in self.histograms.items()]
+        return {
+            'timestamp': time.time(),
+            'uptime_seconds': time.time() - self.started,
+            'counters': [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in counters],
+            'histograms': [{'name': name, 'labels': dict(labels), **histogram} for (name, labels), histogram in histograms],
+        }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self):
+        snapshot = self.snapshot()
+        lines = []
+        for counter in sorted(snapshot['counters'], key=lambda c: c['name']):
+            lines.append('{}{} {}'.format(counter['name'], format_labels(counter['labels'].items()), counter['value']))
+        for histogram in sorted(snapshot['histograms'], key=lambda h: h['name']):
+            name, labels = histogram['name'], histogram['labels'].items()
+            cumulative = 0
+            for bound, count in histogram['buckets'].items():
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(name, format_labels(labels, [('le', bound)]), cumulative))
+            lines.append('{}_sum{} {}'.format(name, format_labels(labels), histogram['sum']))
+            lines.append('{}_count{} {}'.format(name, format_labels(labels), histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path=None):
+        path = path or self.path
+        if not self.enabled or path is None:
+            return
+        contents = self.to_prometheus() if path.endswith('.prom') else self.to_json()
+        # Written next to the target and renamed, so readers never see a partial dump.
+        with open(path + '.tmp', 'w') as output:
+            output.write(contents)
+        os.replace(path + '.tmp', path)
+
+    def start(self):
+        """
+        Starts dumping metrics every `interval` seconds from a background thread.
+        """
+        if not self.enabled or not self.interval or self.thread is not None:
+            return
+        self.stop_event = threading.Event()
+
+        def dump_periodically():
+            while not self.stop_event.wait(self.interval):
+                self.dump()
+
+        self.thread = threading.Thread(target=dump_periodically, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops periodic dumps and writes the final snapshot.
+        """
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+        self.dump()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
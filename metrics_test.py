@@ -0,0 +1,60 @@
+import unittest
+import json
+import os
+
+from metrics import Metrics
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_disabled(self):
+        metrics = Metrics()
+        metrics.inc('requests_total')
+        with metrics.stage('crawl'):
+            pass
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['counters'], [])
+        self.assertEqual(snapshot['histograms'], [])
+
+    def test_counters_and_histograms(self):
+        metrics = Metrics(enabled=True)
+        metrics.inc('requests_total', status=200)
+        metrics.inc('requests_total', 2, status=200)
+        metrics.inc('requests_total', status=429)
+        for latency in [0.001, 0.02, 0.02, 3]:
+            metrics.observe('latency_seconds', latency)
+        snapshot = metrics.snapshot()
+
+        counters = {c['labels']['status']: c['value'] for c in snapshot['counters']}
+        self.assertEqual(counters, {200: 3, 429: 1})
+        histogram = snapshot['histograms'][0]
+        self.assertEqual(histogram['count'], 4)
+        self.assertAlmostEqual(histogram['sum'], 3.041)
+        self.assertEqual(histogram['p50'], 0.025)
+        self.assertEqual(histogram['p99'], 5)
+
+    def test_prometheus(self):
+        metrics = Metrics(enabled=True)
+        metrics.inc('requests_total', status=200)
+        metrics.observe('latency_seconds', 0.02)
+        lines = metrics.to_prometheus().split('\n')
+
+        self.assertIn('requests_total{status="200"} 1', lines)
+        self.assertIn('latency_seconds_bucket{le="0.01"} 0', lines)
+        self.assertIn('latency_seconds_bucket{le="0.025"} 1', lines)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 1', lines)
+        self.assertIn('latency_seconds_count 1', lines)
+
+    def test_dump(self):
+        metrics = Metrics(enabled=True)
+        metrics.inc('requests_total')
+        metrics.dump('test_metrics.json')
+        with open('test_metrics.json') as input:
+            self.assertEqual(json.load(input)['counters'][0]['value'], 1)
+
+    def tearDown(self):
+        if os.path.exists('test_metrics.json'):
+            os.remove('test_metrics.json')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+import argparse
+import asyncio
+import html
+import json
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+
+from synthetic_corpus import CorpusGenerator
+
+RESEARCHERS_PER_PAGE = 50
+
+
+class MockServer(object):
+    """
+    Local stand-in for whoswho.senescence.info and the pubmed E-utilities.
+    Serves people pages, esearch json and efetch xml for a synthetic corpus,
+    and injects latency, 429 responses, server errors and disconnects.
+    """
+
+    def register_options(self, argparser):
+        argparser.add_argument('--latency_ms', type=float, help='Median response latency in milliseconds', default=50)
+        argparser.add_argument('--latency_sigma', type=float, help='Sigma of the lognormal latency distribution, 0 for a constant latency', default=0.5)
+        argparser.add_argument('--quota', type=int, help='Requests per second served before responding with 429, 0 for no limit', default=10)
+        argparser.add_argument('--error_rate', type=float, help='Share of requests answered with status 500', default=0.0)
+        argparser.add_argument('--disconnect_rate', type=float, help='Share of requests for which the connection is dropped', default=0.0)
+
+    def prepare(self, args, researchers, papers):
+        self.latency_ms = args.latency_ms
+        self.latency_sigma = args.latency_sigma
+        self.quota = args.quota
+        self.error_rate = args.error_rate
+        self.disconnect_rate = args.disconnect_rate
+        self.random = random.Random(args.seed)
+        self.researchers = researchers
+        self.papers = papers
+        self.researcher_for_term = {}
+        for id, name in researchers.items():
+            surname, first_name = name.split(', ')
+            self.researcher_for_term['{} {} aging'.format(first_name, surname)] = id
+        self.all_papers = {
+            paper_id: paper for res in papers.values() for paper_id, paper in res['papers'].items()
+        }
+        self.stats = Counter()
+        self.window = None
+        self.window_count = 0
+
+    def app(self):
+        app = web.Application(middlewares=[self.inject_faults])
+        app.router.add_get('/people.php', self.people)
+        app.router.add_get('/entrez/eutils/esearch.fcgi', self.esearch)
+        app.router.add_get('/entrez/eutils/efetch.fcgi', self.efetch)
+        return app
+
+    async def start(self, host='127.0.0.1', port=0):
+        """
+        Starts serving and returns the base url of the server.
+        """
+        self.runner = web.AppRunner(self.app())
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        return 'http://{}:{}'.format(host, port)
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    def over_quota(self):
+        window = int(time.monotonic())
+        if window != self.window:
+            self.window = window
+            self.window_count = 0
+        self.window_count += 1
+        return self.quota and self.window_count > self.quota
+
+    @web.middleware
+    async def inject_faults(self, request, handler):
+        self.stats['requests'] += 1
+        if self.over_quota():
+            self.stats['throttled'] += 1
+            return web.Response(status=429, headers={'Retry-After': '1'})
+        latency = self.latency_ms / 1000
+        if self.latency_sigma:
+            latency *= self.random.lognormvariate(0, self.latency_sigma)
+        await asyncio.sleep(latency)
+        if self.random.random() < self.disconnect_rate:
+            self.stats['disconnected'] += 1
+            request.transport.close()
+            return web.Response(status=500)
+        if self.random.random() < self.error_rate:
+            self.stats['errors'] += 1
+            return web.Response(status=500)
+        return await handler(request)
+
+    async def people(self, request):
+        page = int(request.query.get('page', 1))
+        ids = list(self.researchers.keys())[(page-1)*RESEARCHERS_PER_PAGE:page*RESEARCHERS_PER_PAGE]
+        items = ''.join('<li><h2><a>{}</a></h2></li>'.format(html.escape(self.researchers[id])) for id in ids)
+        body = '<html><body><div id="content"><div><div></div><div><ul>{}</ul></div></div></div></body></html>'.format(items)
+        return web.Response(text=body, content_type='text/html')
+
+    async def esearch(self, request):
+        id = self.researcher_for_term.get(request.query.get('term', ''))
+        paper_ids = self.papers[id]['paper_ids'] if id is not None else []
+        retstart = int(request.query.get('retstart', 0))
+        retmax = int(request.query.get('retmax', 20))
+        body = {'esearchresult': {'count': str(len(paper_ids)), 'idlist': paper_ids[retstart:retstart+retmax]}}
+        return web.Response(text=json.dumps(body), content_type='application/json')
+
+    def article_xml(self, paper_id, paper):
+        meshes = ''.join('<MeshHeading><DescriptorName>{}</DescriptorName></MeshHeading>'.format(html.escape(mesh))
+                         for mesh in paper['meshes'])
+        keywords = ''.join('<Keyword>{}</Keyword>'.format(html.escape(kw)) for kw in paper['keywords'])
+        return ('<PubmedArticle><MedlineCitation><PMID Version="1">{}</PMID>'
+                '<Article><ArticleTitle>{}</ArticleTitle></Article>'
+                '<MeshHeadingList>{}</MeshHeadingList><KeywordList>{}</KeywordList>'
+                '</MedlineCitation></PubmedArticle>').format(paper_id, html.escape(paper['title']), meshes, keywords)
+
+    async def efetch(self, request):
+        paper_ids = request.query.get('id', '').split(',')
+        articles = ''.join(self.article_xml(id, self.all_papers[id]) for id in paper_ids if id in self.all_papers)
+        body = '<?xml version="1.0" ?><PubmedArticleSet>{}</PubmedArticleSet>'.format(articles)
+        return web.Response(text=body, content_type='text/xml')
+
+
+async def serve(server, host, port):
+    print('Serving on {}'.format(await server.start(host, port)))
+    while True:
+        await asyncio.sleep(3600)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a synthetic corpus through mock whoswho and pubmed endpoints')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--keywords', dest='aging_keywords', help='Keywords to sprinkle into titles', default='filtered_aging_keywords.txt')
+    generator = CorpusGenerator()
+    generator.register_options(parser)
+    server = MockServer()
+    server.register_options(parser)
+    args = parser.parse_args()
+    generator.prepare(args)
+    server.prepare(args, *generator.generate())
+    asyncio.run(serve(server, args.host, args.port))
@@ -0,0 +1,145 @@
+import json
+
+import numpy as np
+
+from tokenizer import Vocabulary
+
+# Multiplier of the polynomial hash that packs an n-gram of token ids into a
+# single uint64 (the 64-bit FNV prime). Collisions are possible, but with a
+# vocabulary of realistic size their probability is negligible.
+HASH_MULTIPLIER = 1099511628211
+HASH_MODULUS = 2**64
+
+
+def ngram_hashes(ids, max_n):
+    """
+    Returns hashes of all n-grams of the given token ids for n from 1 to
+    max_n, as a uint64 numpy array.
+    """
+    ids = np.asarray(ids, dtype=np.uint64) + np.uint64(1)
+    hashes = [ids]
+    current = ids
+    for n in range(2, max_n+1):
+        if len(current) <= 1:
+            break
+        current = current[:-1] * np.uint64(HASH_MULTIPLIER) + ids[n-1:]
+        hashes.append(current)
+    return np.concatenate(hashes)
+
+
+def ngram_hashes_csr(ids, offsets, max_n):
+    """
+    Same as ngram_hashes for many token sequences stored back to back, the
+    i-th one being ids[offsets[i]:offsets[i+1]]. N-grams never cross from one
+    sequence into the next.
+
+    Returns (sequence index of every hash, hashes) numpy arrays.
+    """
+    ids = np.asarray(ids, dtype=np.uint64) + np.uint64(1)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    rows = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    all_rows, hashes = [rows], [ids]
+    current = ids
+    for n in range(2, max_n+1):
+        if len(current) <= 1:
+            break
+        current = current[:-1] * np.uint64(HASH_MULTIPLIER) + ids[n-1:]
+        within = rows[:len(current)] == rows[n-1:]
+        all_rows.append(rows[:len(current)][within])
+        hashes.append(current[within])
+    return np.concatenate(all_rows), np.concatenate(hashes)
+
+
+def phrase_hashes_csr(ids, offsets):
+    """
+    Returns phrase_hash of every sequence of token ids stored back to back,
+    see ngram_hashes_csr, as a uint64 numpy array.
+    """
+    ids = np.asarray(ids, dtype=np.uint64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    starts, lengths = offsets[:-1], np.diff(offsets)
+    hashes = np.zeros(len(lengths), dtype=np.uint64)
+    for i in range(int(lengths.max(initial=0))):
+        live = lengths > i
+        hashes[live] = hashes[live] * np.uint64(HASH_MULTIPLIER) + ids[starts[live] + i] + np.uint64(1)
+    return hashes
+
+
+def phrase_hash(ids):
+    """
+    Returns the hash of a single n-gram, equal to its entry in ngram_hashes.
+    """
+    h = 0
+    for id in ids:
+        h = (h * HASH_MULTIPLIER + id + 1) % HASH_MODULUS
+    return h
+
+
+class NgramEncoder(object):
+    """
+    Encodes tokens and phrases of processed papers as vocabulary ids, and
+    keyword phrases as n-gram hashes that can be matched against them.
+    """
+
+    def __init__(self, vocabulary=None):
+        self.vocabulary = vocabulary if vocabulary is not None else Vocabulary()
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as input:
+            return cls(Vocabulary(json.load(input)))
+
+    def save(self, path):
+        # A json list rather than a token per line, meshes and keywords may
+        # contain line breaks.
+        with open(path, 'w') as output:
+            json.dump(self.vocabulary.tokens, output)
+
+    def encode_tokens(self, tokens):
+        return [self.vocabulary.id(token) for token in tokens]
+
+    def encode_phrase(self, phrase):
+        return self.encode_tokens(phrase.split(' '))
+
+    def decode_phrase(self, ids):
+        return ' '.join(self.vocabulary.token(id) for id in ids)
+
+    def encode_researcher(self, res):
+        """
+        Encodes a researcher produced by PubmedProcessor with max_ngram=1.
+        """
+        return {
+            'researcher': res['researcher'],
+            'papers': {
+                paper_id: {
+                    'title': self.encode_tokens(info['title']),
+                    'meshes': [self.encode_phrase(mesh) for mesh in info['meshes']],
+                    'other': [self.encode_phrase(kw) for kw in info['other']],
+                }
+                for paper_id, info in res['papers'].items()
+            }
+        }
+
+    def known_phrase(self, phrase):
+        """
+        Returns ids of the words of a keyword phrase, or None if some of its
+        words never occur in the vocabulary and so it can't match anything.
+        """
+        words = phrase.split(' ')
+        if not all(word in self.vocabulary for word in words):
+            return None
+        return self.encode_tokens(words)
+
+    def phrase_key(self, phrase):
+        """
+        Returns the hash of a keyword phrase, or None if it can't match anything.
+        """
+        ids = self.known_phrase(phrase)
+        return phrase_hash(ids) if ids is not None else None
+
+    def paper_keys(self, info, max_n):
+        """
+        Returns unique hashes of all title n-grams and meshes of a paper.
+        """
+        meshes = np.array([phrase_hash(mesh) for mesh in info['meshes']], dtype=np.uint64)
+        return np.unique(np.concatenate([ngram_hashes(info['title'], max_n), meshes]))
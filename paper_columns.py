@@ -0,0 +1,209 @@
+import json
+import mmap
+import os
+import struct
+from array import array
+
+import numpy as np
+
+COLUMNAR_EXTENSION = '.cols'
+MAGIC = b'PAPERCOLS1\n'
+# Every array starts at a multiple of this many bytes, so that it can be
+# viewed in place with its own dtype.
+ALIGNMENT = 8
+
+
+def is_columnar(path):
+    return path.endswith(COLUMNAR_EXTENSION)
+
+
+def default_vocabulary_path(path):
+    return path + '.vocab'
+
+
+class ColumnarWriter(object):
+    """
+    Writes researchers processed with a vocabulary, see
+    NgramEncoder.encode_researcher, into a single binary file that
+    PaperColumns reads without parsing it.
+
+    Papers are stored once even if several researchers list them, and every
+    list is stored as CSR-style columns: an offsets array with one entry per
+    row plus one, and a flat values array. Rows of
+    - researcher_papers are researchers, values are paper rows,
+    - title_tokens are papers, values are token ids,
+    - mesh_tokens and other_tokens are phrases, values are token ids.
+    Phrases of a paper are consecutive rows, given by offsets of meshes and
+    others, which have a row per paper and no values of their own.
+    Researcher ids, names and paper ids are stored as utf-8 bytes.
+
+    Columns are collected in compact arrays and written when the writer is
+    closed, next to the target and renamed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.paper_rows = {}
+        self.columns = {}
+        for name in ['researcher_ids', 'researcher_names', 'paper_ids']:
+            self.columns[name] = (array('q', [0]), bytearray())
+        for name in ['meshes', 'others']:
+            self.columns[name] = (array('q', [0]), None)
+        for name in ['researcher_papers', 'title_tokens', 'mesh_tokens', 'other_tokens']:
+            self.columns[name] = (array('q', [0]), array('i'))
+
+    def _append(self, name, values):
+        offsets, column = self.columns[name]
+        column.extend(values)
+        offsets.append(len(column))
+
+    def _append_string(self, name, value):
+        self._append(name, value.encode('utf-8'))
+
+    def _append_phrases(self, name, tokens_name, phrases):
+        for phrase in phrases:
+            self._append(tokens_name, phrase)
+        self.columns[name][0].append(len(self.columns[tokens_name][0]) - 1)
+
+    def _paper_row(self, paper_id, info):
+        row = self.paper_rows.get(paper_id)
+        if row is None:
+            row = self.paper_rows[paper_id] = len(self.paper_rows)
+            self._append_string('paper_ids', paper_id)
+            self._append('title_tokens', info['title'])
+            self._append_phrases('meshes', 'mesh_tokens', info['meshes'])
+            self._append_phrases('others', 'other_tokens', info['other'])
+        return row
+
+    def write(self, id, record):
+        self._append_string('researcher_ids', id)
+        self._append_string('researcher_names', record['researcher'])
+        self._append('researcher_papers', [self._paper_row(paper_id, info) for paper_id, info in record['papers'].items()])
+
+    def close(self):
+        arrays = []
+        for name, (offsets, column) in self.columns.items():
+            arrays.append((name + '.offsets', '<i8', offsets))
+            if column is not None:
+                arrays.append((name, '|u1' if isinstance(column, bytearray) else '<i4', column))
+        header, position = {}, 0
+        for name, dtype, values in arrays:
+            header[name] = {'dtype': dtype, 'offset': position, 'length': len(values)}
+            position += -(-len(values) * np.dtype(dtype).itemsize // ALIGNMENT) * ALIGNMENT
+        header = json.dumps(header).encode('utf-8')
+        # Data starts aligned right after the magic, the header length and the header.
+        start = -(-(len(MAGIC) + 8 + len(header)) // ALIGNMENT) * ALIGNMENT
+        try:
+            with open(self.path + '.tmp', 'wb') as output:
+                output.write(MAGIC + struct.pack('<Q', len(header)) + header)
+                output.write(b'\0' * (start - output.tell()))
+                for name, dtype, values in arrays:
+                    data = np.asarray(values, dtype=dtype).tobytes()
+                    output.write(data + b'\0' * (-len(data) % ALIGNMENT))
+        except BaseException:
+            os.remove(self.path + '.tmp')
+            raise
+        os.replace(self.path + '.tmp', self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        # An interrupted run keeps the previous file rather than replacing it
+        # with a truncated one.
+        if exc_type is None:
+            self.close()
+
+
+class PaperColumns(object):
+    """
+    Processed papers written by ColumnarWriter. The file is memory-mapped
+    and every column is a numpy view into it, so opening it only parses a
+    small header and pages are read as queries touch them.
+    """
+
+    def __init__(self, buffer):
+        if bytes(buffer[:len(MAGIC)]) != MAGIC:
+            raise ValueError('Not a processed papers columns file')
+        header_length, = struct.unpack('<Q', buffer[len(MAGIC):len(MAGIC)+8])
+        header_end = len(MAGIC) + 8 + header_length
+        header = json.loads(bytes(buffer[len(MAGIC)+8:header_end]).decode('utf-8'))
+        start = -(-header_end // ALIGNMENT) * ALIGNMENT
+        self.buffer = buffer
+        self.arrays = {
+            name: np.frombuffer(buffer, dtype=spec['dtype'], count=spec['length'], offset=start + spec['offset'])
+            for name, spec in header.items()
+        }
+        self._researcher_ids = None
+
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as input:
+            # The mapping stays valid after the file is closed.
+            return cls(mmap.mmap(input.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def offsets(self, name):
+        return self.arrays[name + '.offsets']
+
+    def column(self, name):
+        return self.arrays[name]
+
+    def row(self, name, i):
+        offsets = self.offsets(name)
+        return self.arrays[name][offsets[i]:offsets[i+1]]
+
+    def phrases(self, name, i):
+        """
+        Returns row numbers of phrases of the i-th paper, name being 'meshes'
+        or 'others'.
+        """
+        offsets = self.offsets(name)
+        return range(offsets[i], offsets[i+1])
+
+    def string(self, name, i):
+        return self.row(name, i).tobytes().decode('utf-8')
+
+    def strings(self, name):
+        return [self.string(name, i) for i in range(len(self.offsets(name)) - 1)]
+
+    @property
+    def num_researchers(self):
+        return len(self.offsets('researcher_papers')) - 1
+
+    @property
+    def num_papers(self):
+        """
+        Number of papers of all researchers, papers listed by several
+        researchers are counted once for each of them.
+        """
+        return len(self.column('researcher_papers'))
+
+    @property
+    def researcher_ids(self):
+        if self._researcher_ids is None:
+            self._researcher_ids = self.strings('researcher_ids')
+        return self._researcher_ids
+
+    def researcher_names(self):
+        return dict(zip(self.researcher_ids, self.strings('researcher_names')))
+
+    def paper_info(self, paper_row):
+        """
+        Returns a paper in the format of NgramEncoder.encode_researcher.
+        """
+        phrases = lambda name, tokens_name: [self.row(tokens_name, i).tolist() for i in self.phrases(name, paper_row)]
+        return {
+            'title': self.row('title_tokens', paper_row).tolist(),
+            'meshes': phrases('meshes', 'mesh_tokens'),
+            'other': phrases('others', 'other_tokens'),
+        }
+
+    def researchers(self):
+        """
+        Yields (researcher_id, researcher) pairs in the format of
+        NgramEncoder.encode_researcher.
+        """
+        names = self.strings('researcher_names')
+        for i, id in enumerate(self.researcher_ids):
+            yield id, {'researcher': names[i], 'papers': {
+                self.string('paper_ids', p): self.paper_info(p) for p in self.row('researcher_papers', i)}}
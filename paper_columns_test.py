@@ -0,0 +1,75 @@
+import unittest
+import os
+
+from find_keywords import KeywordsFinder, find_keywords_encoded, find_keywords_columnar
+from ngrams import NgramEncoder
+from paper_columns import ColumnarWriter, PaperColumns
+
+OUTPUT = 'test_papers.cols'
+
+
+class PaperColumnsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.encoder = NgramEncoder()
+        shared = {'title': ['stress', 'aging', 'mice'], 'meshes': ['caloric restriction', 'aging'], 'other': ['ros']}
+        processed = {
+            '1': {'researcher': 'A', 'papers': {
+                '10': {'title': ['oxidative', 'stress', 'aging'], 'meshes': [], 'other': []},
+                '11': shared,
+            }},
+            '2': {'researcher': 'B', 'papers': {}},
+            '3': {'researcher': 'C', 'papers': {'11': shared, '12': {'title': [], 'meshes': ['aging'], 'other': []}}},
+        }
+        self.encoded = {id: self.encoder.encode_researcher(res) for id, res in processed.items()}
+
+    def write(self):
+        with ColumnarWriter(OUTPUT) as writer:
+            for id, res in self.encoded.items():
+                writer.write(id, res)
+        return PaperColumns.open(OUTPUT)
+
+    def test_write_and_read(self):
+        columns = self.write()
+
+        self.assertEqual(dict(columns.researchers()), self.encoded)
+        self.assertEqual(columns.researcher_names(), {'1': 'A', '2': 'B', '3': 'C'})
+        self.assertEqual(columns.num_papers, 4)
+        # The shared paper is stored once.
+        self.assertEqual(columns.strings('paper_ids'), ['10', '11', '12'])
+
+    def test_interrupted_write_keeps_previous_file(self):
+        self.write()
+        with self.assertRaises(KeyError):
+            with ColumnarWriter(OUTPUT) as writer:
+                writer.write('4', {'researcher': 'D', 'papers': {}})
+                writer.write('5', {})
+
+        self.assertEqual(dict(PaperColumns.open(OUTPUT).researchers()), self.encoded)
+        self.assertFalse(os.path.exists(OUTPUT + '.tmp'))
+
+    def test_find_keywords(self):
+        finder = KeywordsFinder()
+        finder.keywords_list = ['oxidative stress', 'aging', 'stress aging mice', 'caloric restriction', 'unknown word', '']
+        finder.keyword_threshold = 1
+        columns = self.write()
+
+        for match in ['ngrams', 'automaton']:
+            for rank in ['count', 'tfidf']:
+                expected = find_keywords_encoded(finder, self.encoded, self.encoder, match=match, rank=rank)
+                actual = find_keywords_columnar(finder, columns, self.encoder, match=match, rank=rank)
+                self.assertEqual({id: sorted(k['keywords']) for id, k in actual.items()},
+                                 {id: sorted(k['keywords']) for id, k in expected.items()})
+        self.assertEqual(sorted(actual['3']['keywords']), ['aging', 'caloric restriction', 'stress aging mice'])
+        # Papers hashed one at a time give the same counts.
+        whole, chunked = finder.columnar_index(columns, self.encoder, 3), finder.columnar_index(columns, self.encoder, 3, chunk_size=1)
+        for researcher_id in columns.researcher_ids:
+            self.assertEqual(chunked.counts_for(researcher_id), whole.counts_for(researcher_id))
+        self.assertEqual(whole.counts_for('1'), {'oxidative stress': 1, 'aging': 2, 'stress aging mice': 1, 'caloric restriction': 1})
+
+    def tearDown(self):
+        if os.path.exists(OUTPUT):
+            os.remove(OUTPUT)
+
+if __name__ == '__main__':
+    unittest.main()
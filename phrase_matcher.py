@@ -0,0 +1,63 @@
+from collections import deque
+
+
+class PhraseMatcher(object):
+    """
+    Aho-Corasick automaton over tokens. It is compiled once from a list of
+    phrases, each a sequence of tokens, and then finds all occurrences of all
+    phrases in a token sequence in a single linear pass, whatever the length
+    of the phrases. Repeated phrases are only reported under their first index.
+    """
+
+    def __init__(self, phrases):
+        self.phrases = [tuple(phrase) for phrase in phrases]
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [()]
+        self.phrase_index = {}
+        for i, phrase in enumerate(self.phrases):
+            if not phrase or phrase in self.phrase_index:
+                continue
+            self.phrase_index[phrase] = i
+            state = 0
+            for token in phrase:
+                next_state = self.goto[state].get(token)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][token] = next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(())
+                state = next_state
+            self.output[state] += (i,)
+        self._link()
+
+    def _link(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for token, next_state in self.goto[state].items():
+                fail = self.fail[state]
+                while fail and token not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(token, 0)
+                self.output[next_state] += self.output[self.fail[next_state]]
+                queue.append(next_state)
+
+    def match(self, tokens):
+        """
+        Yields indices of phrases found in tokens, once per occurrence.
+        """
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        for token in tokens:
+            while state and token not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(token, 0)
+            yield from output[state]
+
+    def match_whole(self, tokens):
+        """
+        Returns the index of the phrase equal to tokens, or None.
+        """
+        return self.phrase_index.get(tuple(tokens))
@@ -0,0 +1,32 @@
+import unittest
+import random
+
+from phrase_matcher import PhraseMatcher
+
+
+class PhraseMatcherTest(unittest.TestCase):
+
+    def test_match(self):
+        matcher = PhraseMatcher([['oxidative', 'stress'], ['stress'], ['aging', 'mice'], ['stress']])
+
+        found = list(matcher.match(['oxidative', 'stress', 'in', 'aging', 'mice', 'stress']))
+
+        self.assertEqual(sorted(found), [0, 1, 1, 2])
+        self.assertEqual(matcher.match_whole(['aging', 'mice']), 2)
+        self.assertIsNone(matcher.match_whole(['aging']))
+
+    def test_same_matches_as_brute_force(self):
+        rand = random.Random(0)
+        for _ in range(500):
+            phrases = [tuple(rand.choice('abc') for _ in range(rand.randint(1, 5))) for _ in range(rand.randint(1, 8))]
+            tokens = [rand.choice('abcd') for _ in range(rand.randint(0, 30))]
+            matcher = PhraseMatcher(phrases)
+
+            expected = [i for i, phrase in enumerate(phrases) if phrases.index(phrase) == i
+                        for start in range(len(tokens)-len(phrase)+1)
+                        if tuple(tokens[start:start+len(phrase)]) == phrase]
+
+            self.assertEqual(sorted(matcher.match(tokens)), sorted(expected))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,198 @@
+import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import datetime
+from collections import deque
+
+from checkpoint import create_writer, is_jsonl
+from corpus_stats import CorpusStats
+from find_keywords import KeywordsFinder, find_keywords, find_keywords_in_state, build_index, csv_line
+from keyword_state import KeywordState
+from metrics import Metrics
+from pubmed_crawler import PubmedCrawler, setup_logging
+from pubmed_processor import PubmedProcessor
+from tokenizer import Tokenizer
+from whoswho_crawler import WhoswhoCrawler
+
+# Crawled researchers waiting to be processed at most. Beyond that, no new
+# downloads start until processing catches up.
+MAX_PENDING_RESEARCHERS = 100
+
+
+class Pipeline(object):
+    """
+    Runs whoswho_crawler.py, pubmed_crawler.py, pubmed_processor.py and
+    find_keywords.py as a single process. Every researcher is tokenized and
+    assigned keywords as soon as their papers are crawled, in a thread while
+    papers of other researchers are still downloading, and nothing is written
+    to disk in between unless asked to.
+
+    Keywords are ranked one researcher at a time, except for --rank tfidf
+    without existing --stats: corpus stats need all researchers, so processed
+    papers are kept until the crawl is over.
+
+    With --state, runs are incremental: only papers added to pubmed since the
+    previous run are crawled, their keyword counts are added to the state, and
+    keywords of all researchers are ranked from the state at the end.
+    """
+
+    def __init__(self):
+        self.pubmed_crawler = PubmedCrawler()
+        self.whoswho_crawler = WhoswhoCrawler(self.pubmed_crawler.downloader)
+        self.tokenizer = Tokenizer()
+        self.finder = KeywordsFinder()
+        self.metrics = Metrics()
+
+    def register_options(self, argparser):
+        argparser.add_argument('--num', type=int, dest='num_researchers', help='How many researchers to download', default=50)
+        argparser.add_argument('--out', dest='output', help='Path to the csv file where to store found keywords', default='keywords.csv')
+        argparser.add_argument('--researchers_out', help='Also store crawled researchers in this json or jsonl file', default=None)
+        argparser.add_argument('--papers_out', help='Also store crawled papers in this json or jsonl file', default=None)
+        argparser.add_argument('--processed_out', help='Also store processed papers in this json or jsonl file', default=None)
+        argparser.add_argument('--ngrams', type=int, help='Length of the longest title phrase matched against keywords', default=3)
+        argparser.add_argument('--max_keywords', type=int, help='Maximum number of keywords to assign a researcher', default=5)
+        argparser.add_argument('--rank', choices=['count', 'tfidf'], help='Rank keywords of a researcher by the number of papers they appear in, or by tf-idf', default='count')
+        argparser.add_argument('--stats', dest='stats_path', help='Corpus stats file used by --rank tfidf. Computed and saved there at the end of the run if it doesn\'t exist yet.', default=None)
+        argparser.add_argument('--state', help='Path to a json file with keyword counts of previous runs. Only new papers are crawled and added to it, keywords.csv is then written from it.', default=None)
+        argparser.add_argument('--save_state_every', type=int, help='Save --state after this many crawled researchers, so that an interrupted run keeps their papers', default=100)
+        argparser.add_argument('--match', choices=['ngrams', 'automaton'], help='Look keywords up among title n-grams, or scan titles token by token for keywords of any length', default='ngrams')
+        self.pubmed_crawler.register_options(argparser)
+        self.tokenizer.register_options(argparser)
+        self.finder.register_options(argparser)
+        self.metrics.register_options(argparser)
+
+    def prepare(self, args):
+        self.args = args
+        self.pubmed_crawler.prepare(args)
+        self.tokenizer.prepare(args)
+        self.finder.prepare(args)
+        self.metrics.prepare(args)
+        self.pubmed_crawler.downloader.metrics = self.metrics
+        self.processor = PubmedProcessor(self.tokenizer.tokenize, max_ngram=args.ngrams)
+        self.state = KeywordState.load(args.state) if args.state else None
+        if self.state is not None and not self.state.matches(self.finder.keywords_list):
+            # Everything is crawled and counted again.
+            if self.state.researchers:
+                print('Recounting all papers, keywords changed since the previous run')
+            self.state = KeywordState(keywords=list(self.finder.keywords_list))
+        self.state_updates = 0
+        self.today = datetime.date.today().strftime('%Y/%m/%d')
+        self.stats = None
+        if args.rank == 'tfidf' and args.stats_path and self.state is None:
+            with contextlib.suppress(FileNotFoundError):
+                self.stats = CorpusStats.load(args.stats_path)
+            # The corpus isn't known before the crawl, only keywords can be
+            # checked. Stale stats are recomputed at the end of the run.
+            if self.stats is not None and not self.stats.matches(self.finder.keywords_list):
+                self.stats = None
+        # Researchers waiting for corpus stats, see the class docstring.
+        self.deferred = {} if args.rank == 'tfidf' and self.stats is None and self.state is None else None
+
+    def find_keywords(self, papers, stats=None):
+        return find_keywords(self.finder, papers, max_num_keywords=self.args.max_keywords, rank=self.args.rank,
+                             stats_path=self.args.stats_path, match=self.args.match, stats=stats)
+
+    def write_keywords(self, keywords):
+        for id, k in keywords.items():
+            self.output.write(csv_line(id, k) + '\n')
+        # The crawler counts researchers_done_total itself.
+        self.metrics.inc('researchers_written_total', len(keywords))
+
+    def on_researcher_done(self, researcher_id, record):
+        # Whether the crawl is complete can only be told right now, processing
+        # happens later in the executor.
+        complete = self.pubmed_crawler.is_complete(researcher_id, record)
+        self.pending.append(self.executor.submit(self.process_researcher, researcher_id, record, complete))
+        while self.pending and self.pending[0].done():
+            self.pending.popleft().result()
+
+    async def wait_until_ready(self):
+        """
+        Holds the crawl back while too many researchers wait to be processed.
+        Downloads in flight go on meanwhile.
+        """
+        while len(self.pending) > MAX_PENDING_RESEARCHERS:
+            await asyncio.wrap_future(self.pending.popleft())
+
+    async def wait_for_processing(self):
+        while self.pending:
+            await asyncio.wrap_future(self.pending.popleft())
+
+    def process_researcher(self, researcher_id, record, complete):
+        """
+        Tokenizes a crawled researcher and finds their keywords. Runs in a
+        single thread, so writers and the state are never used concurrently.
+        """
+        if self.papers_writer is not None:
+            self.papers_writer.write(researcher_id, record)
+        with self.metrics.stage('process'):
+            processed = self.processor.extract_info_per_researcher(record)
+        if self.processed_writer is not None:
+            self.processed_writer.write(researcher_id, processed)
+        if self.state is not None:
+            self.update_state(researcher_id, record, processed, complete)
+            return
+        if self.deferred is not None:
+            self.deferred[researcher_id] = processed
+            return
+        with self.metrics.stage('find_keywords'):
+            self.write_keywords(self.find_keywords({researcher_id: processed}, self.stats))
+
+    def update_state(self, researcher_id, record, processed, complete):
+        with self.metrics.stage('find_keywords'):
+            counts = build_index(self.finder, {researcher_id: processed}, self.args.match).counts_for(researcher_id)
+        self.state.update(researcher_id, record['researcher'], list(record['papers'].keys()), counts,
+                          last_seen=self.today if complete else None)
+        self.state_updates += 1
+        if self.state_updates % self.args.save_state_every == 0:
+            self.state.save(self.args.state)
+
+    async def run(self):
+        args = self.args
+        with contextlib.ExitStack() as stack:
+            self.output = stack.enter_context(open(args.output, 'w'))
+            self.papers_writer = stack.enter_context(create_writer(args.papers_out)) if args.papers_out else None
+            self.processed_writer = stack.enter_context(create_writer(args.processed_out)) if args.processed_out else None
+            stack.enter_context(self.metrics)
+            # Exited first, so that pending researchers are processed before
+            # the writers close.
+            self.executor = stack.enter_context(concurrent.futures.ThreadPoolExecutor(max_workers=1))
+            self.pending = deque()
+
+            researchers = await self.whoswho_crawler.crawl(args, args.num_researchers)
+            researchers = {str(id): name for id, name in researchers.items()}
+            if args.researchers_out:
+                with create_writer(args.researchers_out) as writer:
+                    for id, name in researchers.items():
+                        # Same formats as whoswho_crawler.py writes.
+                        writer.write(id, {'name': name} if is_jsonl(args.researchers_out) else name)
+
+            self.pubmed_crawler.on_researcher_done = self.on_researcher_done
+            self.pubmed_crawler.wait_until_ready = self.wait_until_ready
+            if self.state is not None:
+                await self.pubmed_crawler.crawl(
+                    researchers,
+                    since={id: self.state.last_seen(id) for id in researchers},
+                    known_paper_ids={id: self.state.known_paper_ids(id) for id in researchers})
+                await self.wait_for_processing()
+                self.state.save(args.state)
+                with self.metrics.stage('find_keywords'):
+                    self.write_keywords(find_keywords_in_state(self.finder, self.state, self.args.max_keywords, self.args.rank))
+                return
+            await self.pubmed_crawler.crawl(researchers)
+            await self.wait_for_processing()
+
+            if self.deferred is not None:
+                with self.metrics.stage('find_keywords'):
+                    self.write_keywords(self.find_keywords(self.deferred))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Crawl researchers and their papers and find their keywords in a single run')
+    pipeline = Pipeline()
+    pipeline.register_options(parser)
+    args = parser.parse_args()
+    pipeline.prepare(args)
+    setup_logging()
+    asyncio.run(pipeline.run())
@@ -0,0 +1,208 @@
+import unittest
+import unittest.mock
+import argparse
+import asyncio
+import json
+import os
+import threading
+
+from downloader import Downloader
+from downloader_test import HttpClientStub
+from pubmed_crawler_test import article, article_set
+from pipeline import Pipeline
+from pubmed_crawler import DATE_FILTER_PATTERN
+from keyword_state import KeywordState
+
+PEOPLE_PAGE = ('<html><body><div id="content"><div><div></div><div><ul>'
+               '<li><h2><a>Smith, Anna</a></h2></li><li><h2><a>Kim, Li</a></h2></li>'
+               '</ul></div></div></div></body></html>')
+
+
+class PipelineTest(unittest.TestCase):
+
+    def create_pipeline(self, *options, keywords='oxidative stress\nautophagy\nlongevity'):
+        with open('test_keywords.txt', 'w') as output:
+            output.write(keywords)
+        pipeline = Pipeline()
+        parser = argparse.ArgumentParser()
+        pipeline.register_options(parser)
+        args = parser.parse_args(['--num', '2', '--out', 'test_keywords.csv', '--keywords', 'test_keywords.txt',
+                                  '--cache', 'test_cache.sqlite', '--threshold', '1'] + list(options))
+        http_client = HttpClientStub()
+        downloader = Downloader(http_client_factory=lambda: http_client)
+        pipeline.pubmed_crawler.downloader = pipeline.whoswho_crawler.downloader = downloader
+        pipeline.prepare(args)
+        crawler = pipeline.pubmed_crawler
+        http_client.fake_pages = {
+            pipeline.whoswho_crawler.page_url(0): PEOPLE_PAGE,
+            crawler.paper_list_url('Smith, Anna'): json.dumps({'esearchresult': {'idlist': ['1', '2']}}),
+            crawler.paper_list_url('Kim, Li'): json.dumps({'esearchresult': {'idlist': ['2', '3']}}),
+            crawler.paper_details_url(['1', '2', '3']): article_set(
+                article('1', 'Oxidative stress in mice'),
+                article('2', 'Autophagy in yeast'),
+                article('3', 'Longevity of worms')),
+        }
+        return pipeline, http_client
+
+    def read_keywords(self):
+        with open('test_keywords.csv') as input:
+            lines = [line.split(';') for line in input.read().split('\n') if line]
+        return {name: set(kw.strip() for kw in keywords if kw.strip()) for id, name, _, _, *keywords in lines}
+
+    def test_run(self):
+        pipeline, http_client = self.create_pipeline('--processed_out', 'test_processed.jsonl')
+
+        asyncio.run(pipeline.run())
+
+        self.assertEqual(self.read_keywords(), {
+            'Smith, Anna': {'oxidative stress', 'autophagy'},
+            'Kim, Li': {'autophagy', 'longevity'},
+        })
+        # Every page was downloaded once, the shared paper in a single batch.
+        self.assertEqual(len(http_client.get_calls()), 4)
+        with open('test_processed.jsonl') as processed:
+            self.assertEqual(len(processed.readlines()), 2)
+
+    def test_researchers_are_processed_in_a_thread(self):
+        pipeline, http_client = self.create_pipeline('--metrics', 'test_metrics.json', '--metrics_interval', '0')
+        threads = set()
+        process_researcher = pipeline.process_researcher
+        def record_thread(*args):
+            threads.add(threading.current_thread())
+            process_researcher(*args)
+        pipeline.process_researcher = record_thread
+
+        asyncio.run(pipeline.run())
+
+        self.assertEqual(len(self.read_keywords()), 2)
+        self.assertEqual(len(threads), 1)
+        self.assertNotIn(threading.main_thread(), threads)
+        counters = {c['name']: c['value'] for c in pipeline.metrics.snapshot()['counters'] if not c['labels']}
+        self.assertEqual(counters['researchers_done_total'], 2)
+        self.assertEqual(counters['researchers_written_total'], 2)
+
+    def test_crawl_waits_for_processing_without_blocking(self):
+        pipeline, http_client = self.create_pipeline()
+        released, waited = threading.Event(), []
+        process_researcher = pipeline.process_researcher
+        def wait_for_release(*args):
+            waited.append(released.wait(5))
+            process_researcher(*args)
+        pipeline.process_researcher = wait_for_release
+
+        async def run():
+            async def release():
+                # Only runs if the event loop isn't blocked by the crawl
+                # waiting for processing.
+                await asyncio.sleep(0.1)
+                released.set()
+            await asyncio.gather(pipeline.run(), release())
+
+        with unittest.mock.patch('pipeline.MAX_PENDING_RESEARCHERS', 0):
+            asyncio.run(run())
+
+        self.assertEqual(waited, [True, True])
+        self.assertEqual(len(self.read_keywords()), 2)
+
+    def test_tfidf_without_stats(self):
+        pipeline, http_client = self.create_pipeline('--rank', 'tfidf', '--max_keywords', '1')
+
+        asyncio.run(pipeline.run())
+
+        # Corpus stats are computed at the end of the crawl. autophagy is shared
+        # by both researchers, so it loses to their own keywords.
+        self.assertEqual(self.read_keywords(), {
+            'Smith, Anna': {'oxidative stress'},
+            'Kim, Li': {'longevity'},
+        })
+
+    def test_incremental(self):
+        pipeline, http_client = self.create_pipeline('--state', 'test_state.json')
+        asyncio.run(pipeline.run())
+
+        pipeline, http_client = self.create_pipeline('--state', 'test_state.json')
+        crawler = pipeline.pubmed_crawler
+        since = DATE_FILTER_PATTERN.format(pipeline.today)
+        http_client.fake_pages = {
+            pipeline.whoswho_crawler.page_url(0): PEOPLE_PAGE,
+            crawler.paper_list_url('Smith, Anna') + since: json.dumps({'esearchresult': {'idlist': ['2', '4']}}),
+            crawler.paper_list_url('Kim, Li') + since: json.dumps({'esearchresult': {'idlist': []}}),
+            crawler.paper_details_url(['4']): article_set(article('4', 'Longevity and oxidative stress')),
+        }
+        asyncio.run(pipeline.run())
+
+        # Only the new paper was downloaded, and added to the stored counts. The
+        # people page comes from the cache.
+        self.assertEqual(http_client.get_calls()[-1], crawler.paper_details_url(['4']))
+        self.assertEqual(len(http_client.get_calls()), 3)
+        self.assertEqual(self.read_keywords(), {
+            'Smith, Anna': {'oxidative stress', 'autophagy', 'longevity'},
+            'Kim, Li': {'autophagy', 'longevity'},
+        })
+        state = KeywordState.load('test_state.json')
+        self.assertEqual(state.researchers['0']['counts'], {'oxidative stress': 2, 'autophagy': 1, 'longevity': 1})
+        self.assertEqual(sorted(state.researchers['0']['paper_ids']), ['1', '2', '4'])
+        self.assertEqual(state.last_seen('1'), pipeline.today)
+
+    def test_state_is_recounted_when_keywords_change(self):
+        pipeline, http_client = self.create_pipeline('--state', 'test_state.json')
+        asyncio.run(pipeline.run())
+
+        pipeline, http_client = self.create_pipeline('--state', 'test_state.json', keywords='autophagy\nyeast\nmice')
+        asyncio.run(pipeline.run())
+
+        # Lists are not filtered by date, and all papers are counted again,
+        # details coming from the cache.
+        crawler = pipeline.pubmed_crawler
+        self.assertEqual(sorted(http_client.get_calls()), sorted([crawler.paper_list_url('Smith, Anna'), crawler.paper_list_url('Kim, Li')]))
+        self.assertEqual(self.read_keywords(), {
+            'Smith, Anna': {'autophagy', 'yeast', 'mice'},
+            'Kim, Li': {'autophagy', 'yeast'},
+        })
+        state = KeywordState.load('test_state.json')
+        self.assertEqual(state.keywords, ['autophagy', 'yeast', 'mice'])
+        self.assertEqual(state.researchers['0']['counts'], {'autophagy': 1, 'yeast': 1, 'mice': 1})
+
+    def test_incremental_lists_are_not_cached(self):
+        pipeline, http_client = self.create_pipeline('--state', 'test_state.json')
+        asyncio.run(pipeline.run())
+
+        # Two more runs on the same day, a paper is added in between.
+        fake_pages = {}
+        for new_ids in [[], ['4']]:
+            pipeline, http_client = self.create_pipeline('--state', 'test_state.json')
+            crawler = pipeline.pubmed_crawler
+            since = DATE_FILTER_PATTERN.format(pipeline.today)
+            fake_pages.update({
+                pipeline.whoswho_crawler.page_url(0): PEOPLE_PAGE,
+                crawler.paper_list_url('Smith, Anna') + since: json.dumps({'esearchresult': {'idlist': []}}),
+                crawler.paper_list_url('Kim, Li') + since: json.dumps({'esearchresult': {'idlist': new_ids}}),
+                crawler.paper_details_url(['4']): article_set(article('4', 'Oxidative stress of worms')),
+            })
+            http_client.fake_pages = fake_pages
+            asyncio.run(pipeline.run())
+
+        self.assertEqual(self.read_keywords()['Kim, Li'], {'oxidative stress', 'autophagy', 'longevity'})
+
+    def test_state_is_saved_while_crawling(self):
+        pipeline, http_client = self.create_pipeline('--state', 'test_state.json', '--save_state_every', '1')
+        process_researcher = pipeline.process_researcher
+        def crash_after_first(researcher_id, record, complete):
+            if os.path.exists('test_state.json'):
+                raise KeyboardInterrupt()
+            process_researcher(researcher_id, record, complete)
+        pipeline.process_researcher = crash_after_first
+
+        with self.assertRaises(KeyboardInterrupt):
+            asyncio.run(pipeline.run())
+
+        self.assertEqual(len(KeywordState.load('test_state.json').researchers), 1)
+
+    def tearDown(self):
+        for path in ['test_keywords.txt', 'test_keywords.csv', 'test_processed.jsonl', 'test_state.json', 'test_state.json.tmp', 'test_metrics.json',
+                     'test_cache.sqlite', 'test_cache.sqlite-wal', 'test_cache.sqlite-shm']:
+            if os.path.exists(path):
+                os.remove(path)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,16 +3,28 @@ import argparse
 import asyncio
 import os
 import logging
-from lxml import html
+from lxml import html, etree
 from downloader import Downloader
+from checkpoint import JsonlWriter, is_jsonl, load_records
+from metrics import Metrics
 import xmltodict
 import traceback
+from io import BytesIO
+from collections import defaultdict, deque, OrderedDict
 from tqdm import tqdm
 
 LOGS_DIR = 'logs'
 LOG_FILE = 'logs/pubmed.log'
-PAPER_LIST_URL_PATTERN = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi?db=pubmed&tool=github.com/melkonyan/whoswho_keywords&email=sasha.melkonyan+crawler@gmail.com&retmax=300&term={name}%20{surname}%20aging&format=json&{api_key}'
+PAPER_LIST_URL_PATTERN = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi?db=pubmed&tool=github.com/melkonyan/whoswho_keywords&email=sasha.melkonyan+crawler@gmail.com&retmax={retmax}&term={name}%20{surname}%20aging&format=json&{api_key}'
 PAPER_DETAILS_URL_PATTERN = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?db=pubmed&id={id}&tool=github.com/melkonyan/whoswho_keywords&email=sasha.melkonyan+crawler@gmail.com&format=xml&{api_key}'
+DEFAULT_BATCH_SIZE = 200
+DEFAULT_PAGE_SIZE = 300
+DEFAULT_MAX_PAPERS = 1000
+# Papers fetched while lists are still downloading whose records are kept, for
+# researchers whose lists list them later.
+DEFAULT_MAX_FETCHED_PAPERS = 100000
+# Appended to paper list urls to only list papers added to pubmed since a date.
+DATE_FILTER_PATTERN = '&datetype=edat&mindate={}&maxdate=3000'
 
 
 def setup_logging():
@@ -21,19 +33,123 @@ def setup_logging():
     with open(LOG_FILE, 'w'): pass
     logging.basicConfig(filename=LOG_FILE, filemode='w', level=logging.INFO)
 
+def iter_articles(contents):
+    """
+    Streams PubmedArticle elements of an efetch response. Every element is
+    freed as soon as the caller moves on to the next one.
+    """
+    for _, article in etree.iterparse(BytesIO(contents.encode('utf-8')), tag='PubmedArticle'):
+        yield article
+        article.clear()
+        while article.getprevious() is not None:
+            del article.getparent()[0]
+
+
+def article_xml(article):
+    """
+    Returns xml of a single article, wrapped into its own PubmedArticleSet
+    so it looks exactly like a response to a single-id request.
+    """
+    return '<PubmedArticleSet>{}</PubmedArticleSet>'.format(etree.tostring(article, encoding='unicode'))
+
+
+def paper_record(article):
+    """
+    Extracts the fields used by PubmedProcessor from a PubmedArticle.
+    """
+    medline = article.find('MedlineCitation')
+    title = medline.find('Article/ArticleTitle')
+    return {
+        'title': ''.join(title.itertext()) if title is not None else '',
+        'meshes': [''.join(mesh.itertext()) for mesh in medline.iterfind('MeshHeadingList/MeshHeading/DescriptorName')],
+        'keywords': [''.join(kw.itertext()) for kw in medline.iterfind('KeywordList/Keyword')],
+    }
+
+
+class PubmedPageParser(object):
+    """
+    Parses esearch and efetch responses. It keeps no crawler state, so that
+    the downloader can run it in its parse executor, and is picklable for
+    process pools.
+
+    Pages are parsed into (result, number of parse errors) pairs. Paper lists
+    are parsed into the 'esearchresult' dict, or None if it can't be parsed.
+    Paper details are parsed into a list of (paper id, paper, xml of the
+    article or None) tuples, holding every article that parsed even if
+    others in the batch didn't.
+
+    @param list_url_prefix urls starting with it are paper lists.
+    @param keep_xml whether to return xml of every article, for the cache.
+    """
+
+    def __init__(self, list_url_prefix, raw_xml=False, keep_xml=False):
+        self.list_url_prefix = list_url_prefix
+        self.raw_xml = raw_xml
+        self.keep_xml = keep_xml
+
+    def __call__(self, url, contents):
+        if contents is None:
+            return None
+        if url.startswith(self.list_url_prefix):
+            try:
+                return json.loads(contents).get('esearchresult', {}), 0
+            except Exception as err:
+                logging.error('Failed to parse paper list {}: {}'.format(url, err))
+                return None, 1
+        articles, errors = [], 0
+        try:
+            for article in iter_articles(contents):
+                try:
+                    articles.append(self.parse_article(article))
+                except Exception as err:
+                    logging.error('Failed to parse an article of {}: {}'.format(url, err))
+                    errors += 1
+        except Exception as err:
+            # Malformed xml, articles before the broken spot are kept.
+            logging.error('Failed to parse {}: {}'.format(url, err))
+            errors += 1
+        return articles, errors
+
+    def parse_article(self, article):
+        xml = article_xml(article) if self.keep_xml or self.raw_xml else None
+        paper = xmltodict.parse(xml) if self.raw_xml else paper_record(article)
+        return article.findtext('MedlineCitation/PMID'), paper, xml if self.keep_xml else None
+
+
 class PubmedCrawler(object):
 
     def __init__(self, downloader=Downloader()):
         self.downloader = Downloader()
+        self.paper_list_url_pattern = PAPER_LIST_URL_PATTERN
+        self.paper_details_url_pattern = PAPER_DETAILS_URL_PATTERN
+        # Called with (researcher_id, record) as soon as all papers of a
+        # researcher are crawled. The record is then dropped from self.papers.
+        self.on_researcher_done = None
+        # Awaited before every url is handed to the downloader, so that slow
+        # consumers of on_researcher_done can hold the crawl back.
+        self.wait_until_ready = None
+        self.max_fetched_papers = DEFAULT_MAX_FETCHED_PAPERS
 
     def register_options(self, argparser):
         argparser.add_argument('--no-details', dest='fetch_details', action='store_false', help='Only parse list of paper ids for each researcher, dont download each paper contents.', default=True)
+        argparser.add_argument('--batch_size', type=int, default=DEFAULT_BATCH_SIZE,
+                               help='How many paper ids to request in a single efetch call. Set to 1 to download every paper separately.')
+        argparser.add_argument('--page_size', type=int, default=DEFAULT_PAGE_SIZE,
+                               help='How many paper ids to request in a single esearch call. Further pages of prolific researchers are requested concurrently.')
+        argparser.add_argument('--max_papers', type=int, default=DEFAULT_MAX_PAPERS,
+                               help='Maximal number of most recent papers to crawl for a single researcher.')
+        argparser.add_argument('--raw_xml', action='store_true', default=False,
+                               help='Store the whole efetch xml of every paper instead of just its title, mesh headings and keywords.')
         argparser.add_argument('--api_key', help='Pubmed API key. For more details on how to get one, see https://ncbiinsights.ncbi.nlm.nih.gov/2017/11/02/new-api-keys-for-the-e-utilities', default=None)
         self.downloader.register_options(argparser)
 
     def prepare(self, args):
         self.api_key = args.api_key
         self.fetch_details = args.fetch_details
+        self.batch_size = max(1, args.batch_size)
+        self.page_size = max(1, args.page_size)
+        self.max_papers = args.max_papers
+        self.raw_xml = args.raw_xml
         self.downloader.prepare(args)
 
     def format_name(self, name):
@@ -43,79 +159,347 @@ class PubmedCrawler(object):
     def format_api_key(self):
         return 'api_key='+self.api_key if self.api_key else ''
 
-    async def parse_details(self, url, contents):
-        if contents is None:
-            return
-        try:
-            d = xmltodict.parse(contents)
-            paper_id = d['PubmedArticleSet']['PubmedArticle']['MedlineCitation']['PMID']['#text']
-            researcher_id = self.researcher_id_for_paper[paper_id]
-            self.papers[researcher_id]['papers'][paper_id] = d
-        except Exception as ex:
-            print('Failed to parse url {}'.format(url))
-            traceback.print_exc()
+    def paper_list_url(self, name, since=None, start=0):
+        """
+        Returns the url of a page of up to `page_size` paper ids of a
+        researcher, most recent first.
 
-    async def parse_papers(self, url, contents):
-        if contents is None:
-            return
-        print('Parsing {}'.format(url))
+        @param since date in the YYYY/MM/DD format. If given, only papers added
+            to pubmed on that day or later are listed.
+        @param start position of the first id of the page.
+        """
+        retmax = min(self.page_size, self.max_papers - start)
+        url = self.paper_list_url_pattern.format(api_key=self.format_api_key(), retmax=retmax, **self.format_name(name))
+        if since:
+            url += DATE_FILTER_PATTERN.format(since)
+        if start:
+            url += '&retstart={}'.format(start)
+        return url
+
+    def paper_details_url(self, paper_ids):
+        return self.paper_details_url_pattern.format(api_key=self.format_api_key(), id=','.join(paper_ids))
+
+    async def parse_details(self, url, articles):
+        parsed = set()
+        for paper_id, paper, xml in articles or ():
+            paper_url = self.paper_details_url([paper_id])
+            if xml is not None and paper_url != url:
+                # Cache every paper on its own, so that it can be reused
+                # regardless of which batch it ends up in next time.
+                self.downloader.put_cache(paper_url, xml)
+            for researcher_id in self.researcher_ids_for_paper[paper_id]:
+                if researcher_id in self.papers:
+                    self.papers[researcher_id]['papers'][paper_id] = paper
+            if self.pending_list_pages:
+                # Researchers whose lists are still downloading may have
+                # this paper too. Records of the most recent papers are kept
+                # for them, older ones only by id, and fetched again.
+                self.fetched_paper_ids.add(paper_id)
+                self.fetched_papers[paper_id] = paper
+                self.fetched_papers.move_to_end(paper_id)
+                if len(self.fetched_papers) > self.max_fetched_papers:
+                    self.fetched_papers.popitem(last=False)
+            parsed.add(paper_id)
+            self.progress.update(1)
+            self.downloader.metrics.inc('papers_parsed_total')
+        for paper_id in self.paper_ids_for_url.pop(url, []):
+            if paper_id not in parsed:
+                self.failed_papers.add(paper_id)
+            for researcher_id in self.researcher_ids_for_paper[paper_id]:
+                pending = self.pending_papers.get(researcher_id)
+                if pending is not None:
+                    pending.discard(paper_id)
+                    self.maybe_done(researcher_id)
+
+    def maybe_done(self, researcher_id):
+        if not self.pending_pages.get(researcher_id) and not self.pending_papers.get(researcher_id):
+            self.researcher_done(researcher_id)
+
+    def researcher_done(self, researcher_id):
+        self.pending_papers.pop(researcher_id, None)
+        self.pending_pages.pop(researcher_id, None)
+        self.downloader.metrics.inc('researchers_done_total')
+        if self.on_researcher_done is not None:
+            self.on_researcher_done(researcher_id, self.papers.pop(researcher_id))
+
+    def is_complete(self, researcher_id, record):
+        """
+        Returns whether all list pages and, if details are fetched, all papers
+        of a researcher were crawled.
+        """
+        if researcher_id not in self.listed_researchers:
+            return False
+        return not self.fetch_details or all(id in record['papers'] for id in record['paper_ids'])
+
+    def checkpoint_to(self, writer):
+        """
+        Writes every researcher to `writer` as soon as they are done, if they
+        were crawled completely. Others are left out, so that a resumed run
+        crawls them again.
+        """
+        def write(researcher_id, record):
+            if self.is_complete(researcher_id, record):
+                writer.write(researcher_id, record)
+            else:
+                logging.warning('Not checkpointing researcher {}, some of their pages failed'.format(researcher_id))
+                self.downloader.metrics.inc('researchers_incomplete_total')
+        self.on_researcher_done = write
+
+    def page_parser(self):
+        return PubmedPageParser(self.paper_list_url_pattern.split('?')[0], raw_xml=self.raw_xml,
+                                keep_xml=self.downloader.use_cache())
+
+    async def parse_page(self, url, parsed):
+        result, errors = parsed or (None, 0)
+        if url in self.list_page_for_url:
+            if errors:
+                self.downloader.metrics.inc('parse_errors_total', errors, stage='paper_lists')
+            await self.parse_papers(url, result)
+        else:
+            if errors:
+                self.downloader.metrics.inc('parse_errors_total', errors, stage='paper_details')
+            await self.parse_details(url, result)
+
+    async def parse_papers(self, url, result):
+        # Researchers with the same name share their pages.
+        for researcher_id, start in self.list_page_for_url.pop(url):
+            self.parse_paper_list(url, result, researcher_id, start)
+
+    def parse_paper_list(self, url, result, researcher_id, start):
         try:
-            researcher_id = self.researcher_id_for_url[url]
-            paper_ids = json.loads(contents).get('esearchresult', {}).get('idlist', [])
-            self.papers[researcher_id]['paper_ids'] = paper_ids
-            print('Done parsing')
+            if result is None:
+                self.listed_researchers.discard(researcher_id)
+                return
+            if start == 0:
+                self.listed_researchers.add(researcher_id)
+                num_papers = min(int(result.get('count', 0)), self.max_papers)
+                for page_start in range(self.page_size, num_papers, self.page_size):
+                    self.schedule_list_page(researcher_id, page_start)
+            self.add_paper_ids(researcher_id, result.get('idlist', []))
         except Exception as ex:
+            self.listed_researchers.discard(researcher_id)
+            self.downloader.metrics.inc('parse_errors_total', stage='paper_lists')
             print('Failed to parse {}'.format(url))
             traceback.print_exc()
+        finally:
+            self.pending_list_pages -= 1
+            self.pending_pages[researcher_id] -= 1
+            if not self.pending_list_pages:
+                # No researcher can claim a fetched paper anymore.
+                self.fetched_paper_ids = set()
+                self.fetched_papers = OrderedDict()
+                self.schedule_details(flush=True)
+                self.urls_ready.set()
+            self.maybe_done(researcher_id)
+
+    def add_list_page(self, researcher_id, start):
+        """
+        Registers a page of the list of papers of a researcher, and returns
+        its url if it has to be downloaded, or None if another researcher with
+        the same name already waits for it.
+        """
+        url = self.paper_list_url(self.papers[researcher_id]['researcher'], self.since.get(researcher_id), start)
+        waiters = self.list_page_for_url.setdefault(url, [])
+        waiters.append((researcher_id, start))
+        self.pending_list_pages += 1
+        self.pending_pages[researcher_id] = self.pending_pages.get(researcher_id, 0) + 1
+        return url if len(waiters) == 1 else None
+
+    def schedule_list_page(self, researcher_id, start):
+        url = self.add_list_page(researcher_id, start)
+        if url is not None:
+            self.enqueue(url)
+
+    def add_paper_ids(self, researcher_id, paper_ids):
+        """
+        Adds ids of papers found for a researcher and schedules details of the
+        ones that no other researcher has asked for yet.
+        """
+        papers = self.papers[researcher_id]
+        known = self.known_paper_ids.get(researcher_id, ())
+        for id in paper_ids:
+            if id in known or researcher_id in self.researcher_ids_for_paper.get(id, ()):
+                continue
+            papers['paper_ids'].append(id)
+            first = id not in self.researcher_ids_for_paper
+            self.researcher_ids_for_paper[id].add(researcher_id)
+            if not self.fetch_details:
+                continue
+            self.progress.total += 1
+            if id in papers['papers'] or id in self.failed_papers:
+                self.progress.update(1)
+            elif id in self.fetched_papers:
+                # Fetched for others before this list arrived.
+                papers['papers'][id] = self.fetched_papers[id]
+                self.fetched_papers.move_to_end(id)
+                self.progress.update(1)
+                self.downloader.metrics.inc('papers_shared_total')
+            elif id in self.fetched_paper_ids:
+                # Fetched before this list arrived and forgotten since.
+                # Refetches of single papers come from the cache, when it is
+                # enabled.
+                self.fetched_paper_ids.discard(id)
+                self.pending_papers.setdefault(researcher_id, set()).add(id)
+                self.unscheduled_papers.append(id)
+                self.downloader.metrics.inc('papers_refetched_total')
+            else:
+                self.pending_papers.setdefault(researcher_id, set()).add(id)
+                if first:
+                    self.unscheduled_papers.append(id)
+                else:
+                    # Already scheduled for another researcher.
+                    self.progress.update(1)
+                    self.downloader.metrics.inc('papers_shared_total')
+        self.progress.refresh()
+        self.schedule_details()
+
+    def schedule_details(self, flush=False):
+        """
+        Schedules details of unscheduled papers once there is a full batch of
+        them, or right away if `flush` is set.
+        """
+        while len(self.unscheduled_papers) >= self.batch_size or (flush and self.unscheduled_papers):
+            batch, self.unscheduled_papers = self.unscheduled_papers[:self.batch_size], self.unscheduled_papers[self.batch_size:]
+            for url in self.paper_details_urls(batch):
+                self.enqueue(url)
+
+    def enqueue(self, url):
+        self.scheduled_urls.append(url)
+        self.urls_ready.set()
+
+    async def urls(self, list_urls):
+        """
+        Yields urls scheduled while parsing earlier pages as soon as they are
+        scheduled, and then the given list urls, until all lists are parsed and
+        all papers scheduled.
+        """
+        list_urls = iter(list_urls)
+        while True:
+            while self.scheduled_urls:
+                if self.wait_until_ready is not None:
+                    await self.wait_until_ready()
+                yield self.scheduled_urls.popleft()
+            url = next(list_urls, None)
+            if url is not None:
+                if self.wait_until_ready is not None:
+                    await self.wait_until_ready()
+                yield url
+                continue
+            if not self.pending_list_pages:
+                return
+            self.urls_ready.clear()
+            await self.urls_ready.wait()
+
+    def paper_details_urls(self, paper_ids):
+        """
+        Returns urls that fetch details of the given papers. Papers that are
+        already cached are requested one by one, the rest is grouped into
+        batches of `batch_size` ids.
+        """
+        cached = [id for id in paper_ids if self.downloader.has_cache(self.paper_details_url([id]))]
+        cached_set = set(cached)
+        missing = [id for id in paper_ids if id not in cached_set]
+        batches = [[id] for id in cached] + [missing[i:i+self.batch_size] for i in range(0, len(missing), self.batch_size)]
+        urls = [self.paper_details_url(batch) for batch in batches]
+        self.paper_ids_for_url.update(zip(urls, batches))
+        return urls
+
+    def start_crawl(self, since=None, known_paper_ids=None):
+        self.since = since or {}
+        self.known_paper_ids = known_paper_ids or {}
+        # Researchers whose list of papers was downloaded and parsed.
+        self.listed_researchers = set()
+        self.list_page_for_url = {}
+        # Lists of papers added since a date grow between runs with the same
+        # date, incremental crawls always download them.
+        self.downloader.skip_cache = (lambda url: url in self.list_page_for_url) if since is not None else None
+        self.pending_list_pages = 0
+        self.pending_pages = {}
+        self.pending_papers = {}
+        self.researcher_ids_for_paper = defaultdict(set)
+        self.paper_ids_for_url = {}
+        self.unscheduled_papers = []
+        self.fetched_paper_ids = set()
+        self.fetched_papers = OrderedDict()
+        self.failed_papers = set()
+        self.scheduled_urls = deque()
+        self.urls_ready = asyncio.Event()
+        self.progress = tqdm(total=0, disable=not self.fetch_details)
 
     async def crawl_paper_details(self):
-        print(list(self.papers.values())[0]['paper_ids'])
-        total_num_papers = sum([len(papers['paper_ids']) for papers in self.papers.values()])
-        progress = tqdm(total=total_num_papers)
-        num_crawled = 0
-        for researcher_id, papers in self.papers.items():
-            paper_ids = papers['paper_ids']
-            paper_details_url = [PAPER_DETAILS_URL_PATTERN.format(
-                api_key = self.format_api_key(),
-                id = id) for id in paper_ids
-            ]
-            for id in paper_ids:
-                self.researcher_id_for_paper[id] = researcher_id
-            await self.downloader.download_all(paper_details_url, self.parse_details)
-            num_crawled += len(paper_ids)
-            progress.update(len(paper_ids))
-        progress.close()
-
-    async def crawl(self, researchers):
-        paper_urls = {id: PAPER_LIST_URL_PATTERN.format(
-            api_key=self.format_api_key(), **self.format_name(name))
-            for id, name in list(researchers.items())}
+        """
+        Downloads details of papers already listed in self.papers, of all
+        researchers in a single pass.
+        """
+        self.start_crawl()
+        # Lists of papers are given.
+        self.listed_researchers = set(self.papers.keys())
+        for researcher_id, papers in list(self.papers.items()):
+            paper_ids, papers['paper_ids'] = papers['paper_ids'], []
+            self.add_paper_ids(researcher_id, paper_ids)
+        self.schedule_details(flush=True)
+        for researcher_id in list(self.papers.keys()):
+            self.maybe_done(researcher_id)
+        await self.downloader.download_all(self.urls([]), self.parse_page, parser=self.page_parser())
+        self.progress.close()
+
+    async def crawl(self, researchers, since=None, known_paper_ids=None):
+        """
+        Lists papers of every researcher and downloads their details in a
+        single pass: details are requested as soon as the first page of ids
+        arrives, and further pages of prolific researchers are requested
+        alongside.
+
+        @param since dict from researcher id to a date in the YYYY/MM/DD
+            format, to only crawl papers added since then.
+        @param known_paper_ids dict from researcher id to ids of papers that
+            were crawled before and should be skipped.
+        """
         self.papers = {
-            id: {'researcher': researchers[id], 'papers': {}, 'paper_ids': []}
-            for id, url in paper_urls.items()
+            id: {'researcher': name, 'papers': {}, 'paper_ids': []}
+            for id, name in list(researchers.items())
         }
-        self.researcher_id_for_url = {url: id for id, url in paper_urls.items()}
-        self.researcher_id_for_paper = {}
-        await self.downloader.download_all(paper_urls.values(), self.parse_papers)
-        if self.fetch_details:
-            await self.crawl_paper_details()
+        self.start_crawl(since, known_paper_ids)
+        list_urls = []
+        for id in self.papers:
+            url = self.add_list_page(id, 0)
+            if url is not None:
+                list_urls.append(url)
+        async with self.downloader:
+            with self.downloader.metrics.stage('papers'):
+                await self.downloader.download_all(self.urls(list_urls), self.parse_page, parser=self.page_parser())
+        self.progress.close()
         print('Done')
         return self.papers
 
 
 async def main():
     crawler = PubmedCrawler()
+    metrics = Metrics()
     parser = argparse.ArgumentParser(description='Download pubmed paper titles for a set of researchers')
-    parser.add_argument('--in', dest='input', help='Path to a json file containing researchers whose papers should be downloaded', default='researchers.json')
-    parser.add_argument('--out', dest='output', help='Path to a json file where to store crawled papers', default='papers.json')
+    parser.add_argument('--in', dest='input', help='Path to a json or jsonl file containing researchers whose papers should be downloaded', default='researchers.json')
+    parser.add_argument('--out', dest='output', help='Path to a json file where to store crawled papers. If it ends with .jsonl, every researcher is appended to it as soon as their papers are crawled.', default='papers.json')
+    parser.add_argument('--resume', action='store_true', help='Skip researchers already present in the .jsonl output instead of overwriting it', default=False)
     crawler.register_options(parser)
+    metrics.register_options(parser)
     args = parser.parse_args()
+    if args.resume and not is_jsonl(args.output):
+        parser.error('--resume requires a .jsonl output')
     crawler.prepare(args)   
+    metrics.prepare(args)
+    crawler.downloader.metrics = metrics
     setup_logging()
-    with open(args.input, 'r') as input, open(args.output, 'w') as output:
-        researchers = json.load(input)
-        papers = await crawler.crawl(researchers)
-        json.dump(papers, output, )
+    researchers = load_records(args.input, value='name')
+    with metrics:
+        if is_jsonl(args.output):
+            with JsonlWriter(args.output, resume=args.resume) as writer:
+                researchers = {id: name for id, name in researchers.items() if id not in writer.done_ids}
+                crawler.checkpoint_to(writer)
+                await crawler.crawl(researchers)
+            return
+        with open(args.output, 'w') as output:
+            papers = await crawler.crawl(researchers)
+            json.dump(papers, output, )
 
 if __name__ == '__main__':
     asyncio.run(main(), debug=True)
@@ -0,0 +1,265 @@
+import unittest
+import asyncio
+import json
+import os
+
+from downloader import Downloader
+from downloader_test import HttpClientStub
+from pubmed_crawler import PubmedCrawler, PubmedPageParser, iter_articles, paper_record
+
+
+def article(paper_id, title):
+    return ('<PubmedArticle><MedlineCitation><PMID Version="1">{}</PMID>'
+            '<Article><ArticleTitle>{}</ArticleTitle></Article>'
+            '</MedlineCitation></PubmedArticle>').format(paper_id, title)
+
+def article_set(*articles):
+    return '<?xml version="1.0" ?><PubmedArticleSet>{}</PubmedArticleSet>'.format(''.join(articles))
+
+
+class ArgsStub:
+
+    downloader_cache = 'test_cache.sqlite'
+    cache_backend = 'sqlite'
+    cache_ttl = None
+    cache_max_mb = None
+    legacy_cache_dir = None
+    connections = 10
+    connections_per_host = 0
+    keepalive = 30
+    dns_cache_ttl = 300
+    parse_workers = 0
+    parse_executor = 'thread'
+    throttled_attempts = 0
+    qps = 10
+    max_in_flight = 10
+    burst = 1
+    api_key = None
+    fetch_details = True
+    batch_size = 2
+    page_size = 300
+    max_papers = 1000
+    raw_xml = False
+
+
+class WriterStub:
+
+    def __init__(self):
+        self.records = {}
+
+    def write(self, id, record):
+        self.records[id] = record
+
+
+class PubmedCrawlerTest(unittest.TestCase):
+
+    def create_crawler(self, fake_pages):
+        http_client = HttpClientStub()
+        http_client.fake_pages = fake_pages
+        crawler = PubmedCrawler()
+        crawler.downloader = Downloader(http_client_factory=lambda: http_client)
+        crawler.prepare(ArgsStub())
+        return crawler, http_client
+
+    def test_crawl_details_in_batches(self):
+        crawler, http_client = self.create_crawler({})
+        details_url = crawler.paper_details_url
+        http_client.fake_pages = {
+            details_url(['1', '2']): article_set(article('1', 'one'), article('2', 'two')),
+            details_url(['3']): article_set(article('3', 'three')),
+        }
+        crawler.papers = {
+            'a': {'researcher': 'A', 'papers': {}, 'paper_ids': ['1', '2', '3']},
+            'b': {'researcher': 'B', 'papers': {}, 'paper_ids': ['2']},
+        }
+
+        asyncio.run(crawler.crawl_paper_details())
+
+        self.assertEqual(http_client.get_calls(), [details_url(['1', '2']), details_url(['3'])])
+        self.assertEqual(set(crawler.papers['a']['papers'].keys()), {'1', '2', '3'})
+        self.assertEqual(set(crawler.papers['b']['papers'].keys()), {'2'})
+        self.assertEqual(crawler.papers['a']['papers']['2'], {'title': 'two', 'meshes': [], 'keywords': []})
+
+    def test_parse_in_process_pool(self):
+        crawler, http_client = self.create_crawler({})
+        args = ArgsStub()
+        args.parse_workers = 2
+        args.parse_executor = 'process'
+        crawler.prepare(args)
+        details_url = crawler.paper_details_url
+        http_client.fake_pages = {
+            crawler.paper_list_url('A, Anna'): json.dumps({'esearchresult': {'count': '3', 'idlist': ['1', '2', '3']}}),
+            details_url(['1', '2']): article_set(article('1', 'one'), article('2', 'two')),
+            details_url(['3']): 'not xml',
+        }
+
+        papers = asyncio.run(crawler.crawl({'a': 'A, Anna'}))
+
+        self.assertEqual(papers['a']['papers'], {
+            '1': {'title': 'one', 'meshes': [], 'keywords': []},
+            '2': {'title': 'two', 'meshes': [], 'keywords': []},
+        })
+        # Pages that fail to parse are treated like failed downloads.
+        self.assertEqual(crawler.failed_papers, {'3'})
+
+    def test_articles_that_parse_are_kept(self):
+        parser = PubmedPageParser('list')
+        broken_article = '<PubmedArticle><PMID>2</PMID></PubmedArticle>'
+
+        articles, errors = parser('details', article_set(article('1', 'one'), broken_article, article('3', 'three')))
+        self.assertEqual([id for id, paper, xml in articles], ['1', '3'])
+        self.assertEqual(errors, 1)
+
+        truncated = article_set(article('1', 'one'), article('2', 'two'))[:-40]
+        articles, errors = parser('details', truncated)
+        self.assertEqual([id for id, paper, xml in articles], ['1'])
+        self.assertEqual(errors, 1)
+
+    def test_paper_record(self):
+        contents = article_set(
+            '<PubmedArticle><MedlineCitation><PMID Version="1">1</PMID>'
+            '<Article><ArticleTitle>Aging in <i>C. elegans</i></ArticleTitle></Article>'
+            '<MeshHeadingList><MeshHeading><DescriptorName UI="D1">Aging</DescriptorName></MeshHeading>'
+            '<MeshHeading><DescriptorName UI="D2">Longevity</DescriptorName></MeshHeading></MeshHeadingList>'
+            '<KeywordList><Keyword>lifespan</Keyword></KeywordList>'
+            '</MedlineCitation></PubmedArticle>')
+
+        records = [paper_record(article) for article in iter_articles(contents)]
+
+        self.assertEqual(records, [{'title': 'Aging in C. elegans', 'meshes': ['Aging', 'Longevity'], 'keywords': ['lifespan']}])
+
+    def test_batches_are_cached_per_paper(self):
+        crawler, http_client = self.create_crawler({})
+        details_url = crawler.paper_details_url
+        http_client.fake_pages = {
+            details_url(['1', '2']): article_set(article('1', 'one'), article('2', 'two')),
+        }
+        crawler.papers = {'a': {'researcher': 'A', 'papers': {}, 'paper_ids': ['1', '2']}}
+        asyncio.run(crawler.crawl_paper_details())
+
+        self.assertEqual(crawler.paper_details_urls(['2', '3']), [details_url(['2']), details_url(['3'])])
+
+    def test_researchers_are_reported_when_done(self):
+        crawler, http_client = self.create_crawler({})
+        details_url = crawler.paper_details_url
+        http_client.fake_pages = {
+            details_url(['1', '2']): article_set(article('1', 'one'), article('2', 'two')),
+        }
+        crawler.papers = {
+            'a': {'researcher': 'A', 'papers': {}, 'paper_ids': ['1', '2']},
+            'b': {'researcher': 'B', 'papers': {}, 'paper_ids': ['3']},
+            'c': {'researcher': 'C', 'papers': {}, 'paper_ids': []},
+        }
+        done = {}
+        crawler.on_researcher_done = lambda id, record: done.update({id: record})
+
+        asyncio.run(crawler.crawl_paper_details())
+
+        # Paper 3 failed to download, its researcher is reported but would
+        # not be checkpointed.
+        self.assertEqual(set(done.keys()), {'a', 'b', 'c'})
+        self.assertEqual({id for id, record in done.items() if crawler.is_complete(id, record)}, {'a', 'c'})
+        self.assertEqual(set(done['a']['papers'].keys()), {'1', '2'})
+        self.assertEqual(done['b']['papers'], {})
+        self.assertEqual(crawler.papers, {})
+
+    def test_incomplete_researchers_are_not_checkpointed(self):
+        crawler, http_client = self.create_crawler({})
+        details_url = crawler.paper_details_url
+        http_client.fake_pages = {
+            crawler.paper_list_url('A, Anna'): json.dumps({'esearchresult': {'count': '2', 'idlist': ['1', '2']}}),
+            crawler.paper_list_url('B, Bob'): json.dumps({'esearchresult': {'count': '1', 'idlist': ['3']}}),
+            details_url(['1', '2']): article_set(article('1', 'one'), article('2', 'two')),
+        }
+        checkpoint = WriterStub()
+        crawler.checkpoint_to(checkpoint)
+
+        # Paper 3 and the whole list of C failed to download.
+        asyncio.run(crawler.crawl({'a': 'A, Anna', 'b': 'B, Bob', 'c': 'C, Carl'}))
+
+        self.assertEqual(set(checkpoint.records.keys()), {'a'})
+
+    def test_papers_fetched_before_a_list_are_reused(self):
+        list_page = lambda count, ids: json.dumps({'esearchresult': {'count': str(count), 'idlist': ids}})
+        for max_fetched_papers, fetches in [(1000, 1), (0, 2)]:
+            crawler, http_client = self.create_crawler({})
+            args = ArgsStub()
+            args.downloader_cache = None
+            args.max_in_flight = 1
+            args.batch_size = 1
+            crawler.prepare(args)
+            crawler.page_size = 1
+            crawler.max_fetched_papers = max_fetched_papers
+            details_url = crawler.paper_details_url
+            http_client.fake_pages = {
+                crawler.paper_list_url('A, Anna'): list_page(1, ['1']),
+                crawler.paper_list_url('B, Bob'): list_page(2, ['2']),
+                crawler.paper_list_url('B, Bob', start=1): list_page(2, ['1']),
+                details_url(['1']): article_set(article('1', 'one')),
+                details_url(['2']): article_set(article('2', 'two')),
+            }
+
+            papers = asyncio.run(crawler.crawl({'a': 'A, Anna', 'b': 'B, Bob'}))
+
+            self.assertEqual(set(papers['b']['papers'].keys()), {'1', '2'})
+            self.assertEqual(papers['b']['papers']['1'], papers['a']['papers']['1'])
+            # Paper 1 was fetched before the second page of B arrived. Its
+            # record is reused, unless too many papers were fetched meanwhile.
+            self.assertEqual(http_client.get_calls().count(details_url(['1'])), fetches)
+            self.assertEqual(crawler.fetched_papers, {})
+            self.assertEqual(crawler.fetched_paper_ids, set())
+
+    def test_researchers_with_the_same_name(self):
+        crawler, http_client = self.create_crawler({})
+        crawler.page_size = 2
+        list_page = lambda count, ids: json.dumps({'esearchresult': {'count': str(count), 'idlist': ids}})
+        details_url = crawler.paper_details_url
+        http_client.fake_pages = {
+            crawler.paper_list_url('A, Anna'): list_page(3, ['1', '2']),
+            crawler.paper_list_url('A, Anna', start=2): list_page(3, ['3']),
+            details_url(['1', '2']): article_set(article('1', 'one'), article('2', 'two')),
+            details_url(['3']): article_set(article('3', 'three')),
+        }
+
+        papers = asyncio.run(crawler.crawl({'a': 'A, Anna', 'b': 'A, Anna'}))
+
+        self.assertEqual(set(papers['a']['papers'].keys()), {'1', '2', '3'})
+        self.assertEqual(papers['b']['papers'], papers['a']['papers'])
+        # Both researchers share every page.
+        self.assertEqual(sorted(http_client.get_calls()), sorted(http_client.fake_pages.keys()))
+        self.assertEqual(crawler.listed_researchers, {'a', 'b'})
+
+    def test_paginated_paper_lists(self):
+        crawler, http_client = self.create_crawler({})
+        crawler.page_size = 2
+        crawler.max_papers = 5
+        list_page = lambda count, ids: json.dumps({'esearchresult': {'count': str(count), 'idlist': ids}})
+        details_url = crawler.paper_details_url
+        http_client.fake_pages = {
+            crawler.paper_list_url('A, Anna'): list_page(7, ['1', '2']),
+            crawler.paper_list_url('A, Anna', start=2): list_page(7, ['3', '4']),
+            crawler.paper_list_url('A, Anna', start=4): list_page(7, ['5']),
+            crawler.paper_list_url('B, Bob'): list_page(1, ['3']),
+            details_url(['1', '2']): article_set(article('1', 'one'), article('2', 'two')),
+            details_url(['3', '4']): article_set(article('3', 'three'), article('4', 'four')),
+            details_url(['5']): article_set(article('5', 'five')),
+        }
+
+        papers = asyncio.run(crawler.crawl({'a': 'A, Anna', 'b': 'B, Bob'}))
+
+        # The last page only asks for as many ids as are left under max_papers.
+        self.assertIn('retmax=1&', crawler.paper_list_url('A, Anna', start=4))
+        self.assertEqual(sorted(papers['a']['paper_ids']), ['1', '2', '3', '4', '5'])
+        self.assertEqual(set(papers['a']['papers'].keys()), {'1', '2', '3', '4', '5'})
+        self.assertEqual(papers['b']['papers'], {'3': {'title': 'three', 'meshes': [], 'keywords': []}})
+        # Every page and every paper was requested exactly once.
+        self.assertEqual(sorted(http_client.get_calls()), sorted(http_client.fake_pages.keys()))
+        self.assertEqual(crawler.listed_researchers, {'a', 'b'})
+
+    def tearDown(self):
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(ArgsStub.downloader_cache + suffix):
+                os.remove(ArgsStub.downloader_cache + suffix)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,31 +1,112 @@
 import argparse
-import json
 import traceback
+import multiprocessing
+from collections import deque, OrderedDict
 
 from tokenizer import Tokenizer
+from checkpoint import iter_records, create_writer
+from ngrams import NgramEncoder
+from metrics import Metrics
+from paper_columns import ColumnarWriter, is_columnar, default_vocabulary_path
+
+DEFAULT_CACHE_SIZE = 100000
 
 class PubmedProcessor:
 
-    def __init__(self, tokenizer):
+    def __init__(self, tokenizer, max_ngram=3, cache_size=DEFAULT_CACHE_SIZE):
+        """
+        @param cache_size number of recently processed papers to remember, by
+            pubmed id and contents. Papers co-authored by several researchers
+            are then processed once, and all researchers share the same info
+            object. Papers crawled with --raw_xml are not cached.
+        """
         self.tokenizer = tokenizer
+        self.max_ngram = max_ngram
+        self.cache_size = cache_size
+        self.processed_papers = OrderedDict()
+
+    def __getstate__(self):
+        # Workers start with an empty cache rather than a copy of this one.
+        state = dict(self.__dict__)
+        state['processed_papers'] = OrderedDict()
+        return state
 
     def extract_info(self, papers):
-        return {
-            res_id: {'researcher': res['researcher'], 'papers': self._extract_info_per_researcher(res['papers'])}
-            for res_id, res in papers.items()
-        }
+        return dict(self.extract_info_stream(papers.items()))
+
+    def extract_info_stream(self, researchers, workers=1):
+        """
+        Lazily processes (researcher_id, researcher) pairs and yields processed
+        pairs in the same order.
+
+        @param workers number of processes to shard researchers across. The
+            processor, including its tokenizer, is pickled into every worker.
+        """
+        if workers <= 1:
+            for res_id, res in researchers:
+                yield res_id, self.extract_info_per_researcher(res)
+            return
+        with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(self,)) as pool:
+            # Pool.imap would read the whole input ahead, keep only a few
+            # researchers per worker in flight instead.
+            pending = deque()
+            for res_id, res in researchers:
+                pending.append((res_id, pool.apply_async(_extract_info_in_worker, (res,))))
+                if len(pending) >= 2 * workers:
+                    res_id, result = pending.popleft()
+                    yield res_id, result.get()
+            while pending:
+                res_id, result = pending.popleft()
+                yield res_id, result.get()
+
+    def iter_paper_info(self, researchers):
+        """
+        Lazily yields processed info of every paper of (researcher_id,
+        researcher) pairs.
+        """
+        for res_id, res in researchers:
+            for paper in res['papers'].values():
+                yield self._extract_info_per_paper(paper)
+
+    def extract_info_per_researcher(self, res):
+        return {'researcher': res['researcher'], 'papers': self._extract_info_per_researcher(res['papers'])}
 
     def _compute_tokens_from_title(self, title):
         tokens = self.tokenizer(title)
-        token_pairs =  ['{} {}'.format(tokens[i], tokens[i+1]) for i in range(len(tokens)-1)]
-        token_triplets = ['{} {} {}'.format(*tokens[i:i+3]) for i in range(len(tokens)-2)]
-        tokens += token_pairs + token_triplets
-        return tokens
+        ngrams = [' '.join(tokens[i:i+n]) for n in range(2, self.max_ngram+1) for i in range(len(tokens)-n+1)]
+        return tokens + ngrams
 
     def _extract_info_per_researcher(self, papers: dict) -> dict:
-        return {paper_id: self._extract_info_per_paper(paper) for paper_id, paper in papers.items()}
+        return {paper_id: self._extract_info_per_shared_paper(paper_id, paper) for paper_id, paper in papers.items()}
+
+    def _extract_info_per_shared_paper(self, paper_id, paper):
+        if not self.cache_size or 'PubmedArticleSet' in paper:
+            return self._extract_info_per_paper(paper)
+        # Inputs that reuse an id for another paper must not get its info.
+        key = (paper_id, paper['title'], tuple(paper['meshes']), tuple(paper['keywords']))
+        info = self.processed_papers.get(key)
+        if info is not None:
+            self.processed_papers.move_to_end(key)
+            return info
+        info = self.processed_papers[key] = self._extract_info_per_paper(paper)
+        if len(self.processed_papers) > self.cache_size:
+            self.processed_papers.popitem(last=False)
+        return info
 
     def _extract_info_per_paper(self, paper):
+        if 'PubmedArticleSet' in paper:
+            return self._extract_info_per_raw_paper(paper)
+        return {
+            'title': self._compute_tokens_from_title(paper['title'].lower()),
+            'meshes': [mesh.lower() for mesh in paper['meshes']],
+            'other': [kw.lower() for kw in paper['keywords']],
+        }
+
+    def _extract_info_per_raw_paper(self, paper):
+        """
+        Extracts info from papers crawled with --raw_xml, stored as whole
+        xmltodict trees.
+        """
         info = {
          'title': [],
          'meshes': [],
@@ -55,21 +136,44 @@ class PubmedProcessor:
         return xml['#text'] if '#text' in xml else xml
 
 
+_worker_processor = None
+
+def _init_worker(processor):
+    global _worker_processor
+    _worker_processor = processor
+
+def _extract_info_in_worker(res):
+    return _worker_processor.extract_info_per_researcher(res)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Extract info from crawled pubmed database.')
-    parser.add_argument('--in', dest='input', help='Path to the json file containing crawled papers', default='papers.json')
-    parser.add_argument('--out', dest='output', help='Path to the csv file where to store found keywords', default='processed_papers.json')
+    parser.add_argument('--in', dest='input', help='Path to the json or jsonl file containing crawled papers', default='papers.json')
+    parser.add_argument('--out', dest='output', help='Path to the json or jsonl file where to store processed papers, or a .cols file to store them as memory-mappable token id columns', default='processed_papers.json')
+    parser.add_argument('--workers', type=int, help='Number of processes to tokenize papers with', default=1)
+    parser.add_argument('--ngrams', type=int, help='Store title phrases of up to this many tokens', default=3)
+    parser.add_argument('--paper_cache', type=int, help='Number of recently processed papers to remember, so that papers shared by several researchers are only tokenized once', default=DEFAULT_CACHE_SIZE)
+    parser.add_argument('--vocabulary', help='Store tokens as ids in this vocabulary file instead of storing strings. Title phrases are then computed by find_keywords.py. .cols output always uses a vocabulary, by default the .vocab file next to it.', default=None)
 
     tokenizer = Tokenizer()
     tokenizer.register_options(parser)
+    metrics = Metrics()
+    metrics.register_options(parser)
 
     args = parser.parse_args()
     tokenizer.prepare(args)
+    metrics.prepare(args)
 
-    processor = PubmedProcessor(tokenizer.tokenize)
+    if is_columnar(args.output) and not args.vocabulary:
+        args.vocabulary = default_vocabulary_path(args.output)
+    encoder = NgramEncoder() if args.vocabulary else None
+    processor = PubmedProcessor(tokenizer.tokenize, max_ngram=1 if encoder else args.ngrams, cache_size=args.paper_cache)
+    writer = ColumnarWriter(args.output) if is_columnar(args.output) else create_writer(args.output)
 
-    with open(args.input, 'r') as input, \
-         open(args.output, 'w') as output:
-        papers = json.load(input)
-        processed_papers = processor.extract_info(papers)
-        json.dump(processed_papers, output)
+    with metrics, metrics.stage('process'), writer as output:
+        for res_id, res in processor.extract_info_stream(iter_records(args.input), workers=args.workers):
+            output.write(res_id, encoder.encode_researcher(res) if encoder else res)
+            metrics.inc('researchers_processed_total')
+            metrics.inc('papers_processed_total', len(res['papers']))
+    if encoder:
+        encoder.save(args.vocabulary)
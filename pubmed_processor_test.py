@@ -0,0 +1,69 @@
+import unittest
+
+from pubmed_processor import PubmedProcessor
+from tokenizer import Tokenizer
+
+
+class ArgsStub:
+
+    ignored_tokens = 'ignored_tokens.txt'
+    allowed_chars = 'abcdefghijklmnopqrstuvwxyz0123456789'
+    intern_tokens = False
+
+
+def researcher(i):
+    return {
+        'researcher': 'Researcher, {}'.format(i),
+        'papers': {
+            '1': {'title': 'Oxidative stress in aging mice', 'meshes': ['Aging'], 'keywords': ['ROS']},
+        },
+    }
+
+
+class PubmedProcessorTest(unittest.TestCase):
+
+    def setUp(self):
+        tokenizer = Tokenizer()
+        tokenizer.prepare(ArgsStub())
+        self.processor = PubmedProcessor(tokenizer.tokenize)
+
+    def test_extract_info(self):
+        info = self.processor.extract_info({'1': researcher(1)})
+
+        self.assertEqual(info['1']['papers']['1'], {
+            'title': ['oxidative', 'stress', 'aging', 'mice',
+                      'oxidative stress', 'stress aging', 'aging mice',
+                      'oxidative stress aging', 'stress aging mice'],
+            'meshes': ['aging'],
+            'other': ['ros'],
+        })
+
+    def test_extract_info_with_workers(self):
+        papers = [(str(i), researcher(i)) for i in range(10)]
+
+        processed = list(self.processor.extract_info_stream(iter(papers), workers=2))
+
+        self.assertEqual(processed, list(self.processor.extract_info_stream(papers)))
+
+    def test_shared_papers_are_processed_once(self):
+        titles = []
+        def tokenize(title):
+            titles.append(title)
+            return title.split(' ')
+        processor = PubmedProcessor(tokenize)
+
+        info = processor.extract_info({'1': researcher(1), '2': researcher(2)})
+
+        self.assertEqual(len(titles), 1)
+        self.assertIs(info['1']['papers']['1'], info['2']['papers']['1'])
+
+    def test_reused_paper_ids_are_not_mixed_up(self):
+        other = researcher(2)
+        other['papers']['1'] = {'title': 'Autophagy', 'meshes': [], 'keywords': []}
+
+        info = self.processor.extract_info({'1': researcher(1), '2': other})
+
+        self.assertEqual(info['2']['papers']['1']['title'], ['autophagy'])
+
+if __name__ == '__main__':
+    unittest.main()
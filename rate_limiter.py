@@ -0,0 +1,90 @@
+import asyncio
+import time
+import logging
+from urllib.parse import urlparse
+
+MIN_RATE = 0.1
+DECREASE_FACTOR = 0.5
+INCREASE_STEP = 0.1
+DEFAULT_RETRY_AFTER = 1.0
+
+
+class TokenBucket:
+    """
+    Token bucket that hands out `rate` requests per second with bursts of up to
+    `burst` requests. It is implemented as a virtual schedule: every request
+    reserves the next free slot synchronously and then sleeps until it comes,
+    so no locks are needed and waiters are served in order.
+
+    The rate adapts AIMD-style: every throttled response halves it, every
+    successful one adds `INCREASE_STEP` back until `max_rate` is reached.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.next_slot = 0.0
+
+    def reserve(self):
+        """
+        Reserves a slot and returns the number of seconds to wait for it.
+        """
+        now = time.monotonic()
+        interval = 1 / self.rate
+        slot = max(now, self.next_slot - (self.burst - 1) * interval)
+        self.next_slot = max(self.next_slot, now) + interval
+        return slot - now
+
+    async def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def on_success(self):
+        self.rate = min(self.max_rate, self.rate + INCREASE_STEP)
+
+    def on_throttled(self, retry_after=None):
+        self.rate = max(MIN_RATE, self.rate * DECREASE_FACTOR)
+        pause = retry_after if retry_after is not None else DEFAULT_RETRY_AFTER
+        self.next_slot = max(self.next_slot, time.monotonic() + pause)
+
+
+class RateLimiter:
+    """
+    Keeps a separate token bucket for every host.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+
+    def bucket(self, url):
+        host = urlparse(url).netloc
+        if host not in self.buckets:
+            self.buckets[host] = TokenBucket(self.rate, self.burst)
+        return self.buckets[host]
+
+    async def acquire(self, url):
+        await self.bucket(url).acquire()
+
+    def on_success(self, url):
+        self.bucket(url).on_success()
+
+    def on_throttled(self, url, retry_after=None):
+        bucket = self.bucket(url)
+        bucket.on_throttled(retry_after)
+        logging.warning('Throttled by {}, reducing rate to {:.2f} requests per second'.format(
+            urlparse(url).netloc, bucket.rate))
+
+
+def parse_retry_after(value):
+    """
+    Returns the number of seconds from a Retry-After header. Http dates are
+    not supported and treated as a missing header.
+    """
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,87 @@
+import argparse
+import itertools
+import json
+import random
+
+FIRST_NAMES = ['Anna', 'Joao', 'Maria', 'David', 'Li', 'Sasha', 'Vadim', 'Cynthia', 'Linda', 'Thomas']
+SURNAMES = ['Smith', 'Magalhaes', 'Kenyon', 'Partridge', 'Gladyshev', 'Sinclair', 'Guarente', 'Melkonyan', 'Wang', 'Kim']
+MESH_TERMS = ['Aging', 'Animals', 'Humans', 'Mice', 'Longevity', 'Oxidative Stress', 'Caloric Restriction',
+              'Caenorhabditis elegans', 'Drosophila melanogaster', 'Cellular Senescence', 'Autophagy', 'Sirtuins',
+              'Insulin-Like Growth Factor I', 'Telomere', 'Mitochondria', 'Alzheimer Disease', 'Female', 'Male']
+KEYWORD_PROBABILITY = 0.3
+
+
+class CorpusGenerator(object):
+    """
+    Generates researchers and papers that look like the output of
+    whoswho_crawler.py and pubmed_crawler.py. Title words follow a Zipf
+    distribution over a synthetic vocabulary, and some titles contain phrases
+    from the keywords file, so that every stage of the pipeline has work to do.
+    """
+
+    def register_options(self, argparser):
+        argparser.add_argument('--researchers', dest='num_researchers', type=int, help='Number of researchers to generate', default=100)
+        argparser.add_argument('--papers', dest='papers_per_researcher', type=int, help='Average number of papers per researcher', default=50)
+        argparser.add_argument('--title_length', type=int, help='Average number of words in a title', default=12)
+        argparser.add_argument('--meshes', dest='meshes_per_paper', type=int, help='Average number of mesh headings per paper', default=6)
+        argparser.add_argument('--vocabulary_size', type=int, help='Number of distinct title words', default=20000)
+        argparser.add_argument('--seed', type=int, help='Random seed', default=0)
+
+    def prepare(self, args):
+        self.num_researchers = args.num_researchers
+        self.papers_per_researcher = args.papers_per_researcher
+        self.title_length = args.title_length
+        self.meshes_per_paper = args.meshes_per_paper
+        self.random = random.Random(args.seed)
+        self.vocabulary = ['word{}'.format(i) for i in range(args.vocabulary_size)]
+        self.cum_weights = list(itertools.accumulate(1 / (i + 1) for i in range(args.vocabulary_size)))
+        with open(args.aging_keywords, 'r') as keywords:
+            self.keywords = [k for k in keywords.read().split('\n') if k]
+
+    def researcher_name(self, id):
+        return '{}{}, {}'.format(self.random.choice(SURNAMES), id, self.random.choice(FIRST_NAMES))
+
+    def title(self):
+        length = max(1, int(self.random.expovariate(1 / self.title_length)))
+        words = self.random.choices(self.vocabulary, cum_weights=self.cum_weights, k=length)
+        if self.keywords and self.random.random() < KEYWORD_PROBABILITY:
+            words.insert(self.random.randrange(len(words) + 1), self.random.choice(self.keywords).capitalize())
+        return ' '.join(words).capitalize() + '.'
+
+    def paper(self):
+        num_meshes = min(len(MESH_TERMS), int(self.random.expovariate(1 / self.meshes_per_paper))) if self.meshes_per_paper else 0
+        return {
+            'title': self.title(),
+            'meshes': self.random.sample(MESH_TERMS, num_meshes),
+            'keywords': [],
+        }
+
+    def generate(self):
+        """
+        Returns (researchers, papers) in the formats of researchers.json and
+        papers.json.
+        """
+        researchers = {str(id): self.researcher_name(id) for id in range(self.num_researchers)}
+        papers = {}
+        paper_ids = itertools.count(10000000)
+        for id, name in researchers.items():
+            num_papers = int(self.random.expovariate(1 / self.papers_per_researcher)) if self.papers_per_researcher else 0
+            researcher_papers = {str(next(paper_ids)): self.paper() for _ in range(num_papers)}
+            papers[id] = {'researcher': name, 'papers': researcher_papers, 'paper_ids': list(researcher_papers.keys())}
+        return researchers, papers
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic corpus of researchers and their papers')
+    parser.add_argument('--researchers_out', help='Path to the json file where to store researchers', default='synthetic_researchers.json')
+    parser.add_argument('--papers_out', help='Path to the json file where to store papers', default='synthetic_papers.json')
+    parser.add_argument('--keywords', dest='aging_keywords', help='Keywords to sprinkle into titles', default='filtered_aging_keywords.txt')
+    generator = CorpusGenerator()
+    generator.register_options(parser)
+    args = parser.parse_args()
+    generator.prepare(args)
+    researchers, papers = generator.generate()
+    with open(args.researchers_out, 'w') as output:
+        json.dump(researchers, output)
+    with open(args.papers_out, 'w') as output:
+        json.dump(papers, output)
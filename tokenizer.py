@@ -1,6 +1,37 @@
 import re
+import sys
 import string
 
+
+class Vocabulary(object):
+    """
+    Assigns consecutive integer ids to tokens, so that repeated tokens can be
+    stored as small ints instead of separate strings.
+    """
+
+    def __init__(self, tokens=()):
+        self.ids = {}
+        self.tokens = []
+        for token in tokens:
+            self.id(token)
+
+    def id(self, token):
+        id = self.ids.get(token)
+        if id is None:
+            id = self.ids[token] = len(self.tokens)
+            self.tokens.append(token)
+        return id
+
+    def token(self, id):
+        return self.tokens[id]
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __contains__(self, token):
+        return token in self.ids
+
+
 class Tokenizer(object):
 
     def register_options(self, argparser):
@@ -12,22 +43,38 @@ class Tokenizer(object):
                                help='Characters that tokens consist of. Anything not in this list will be considered a delimiter.\n By default is set to "{}"'.format(default_allowed_chars),
                                default=default_allowed_chars
         )
+        argparser.add_argument('--intern', dest='intern_tokens', action='store_true', default=False,
+                               help='Intern tokens, so that repeated tokens share memory')
 
     def prepare(self, args):
         with open(args.ignored_tokens, 'r') as f:
             self.ignored_tokens = set(f.read().split('\n'))
         self.allowed_chars = args.allowed_chars
-        pattern = '[' + ''.join(['^'+c for c in self.allowed_chars])+ ']'
-        self.replace_chars_regex = re.compile(pattern)
-        self.remove_multi_spaces_regex = re.compile(' +')
+        self.intern_tokens = args.intern_tokens
+        chars = set(self.allowed_chars)
+        # Tokens used to be split with '[^a^b^c...]', which also kept '^' as a
+        # token character. Keep it, so that tokens stay the same.
+        if len(chars) > 1:
+            chars.add('^')
+        chars.discard(' ')
+        # Runs of delimiters and spaces separate tokens. Leading and trailing
+        # runs produce empty tokens, which are removed with the ignored tokens
+        # as long as the ignored tokens file contains an empty line.
+        self.split_regex = re.compile('[^{}]+'.format(''.join(re.escape(c) for c in sorted(chars))))
 
     def tokenize(self, text):
-        text = self.replace_chars_regex.sub(' ', text)
-        text = self.remove_multi_spaces_regex.sub(' ', text)
-        tokens = text.split(' ')
-        tokens = [token.lower() for token in tokens]    
-        tokens = [token
-                  for token in tokens
-                  if token not in self.ignored_tokens
-                  ]
+        ignored_tokens = self.ignored_tokens
+        tokens = [token for token in map(str.lower, self.split_regex.split(text)) if token not in ignored_tokens]
+        if self.intern_tokens:
+            tokens = list(map(sys.intern, tokens))
         return tokens
+
+    def tokenize_batch(self, texts):
+        return [self.tokenize(text) for text in texts]
+
+    def tokenize_ids(self, text, vocabulary):
+        """
+        Tokenizes text and returns ids of the tokens in the given vocabulary,
+        adding new tokens to it.
+        """
+        return [vocabulary.id(token) for token in self.tokenize(text)]
@@ -0,0 +1,64 @@
+import unittest
+import random
+import re
+import string
+
+from tokenizer import Tokenizer, Vocabulary
+
+
+class ArgsStub:
+
+    ignored_tokens = 'ignored_tokens.txt'
+    allowed_chars = string.ascii_letters + string.digits
+    intern_tokens = False
+
+
+def reference_tokenize(text, ignored_tokens, allowed_chars):
+    """
+    The original two-pass implementation, kept to verify that the tokenizer
+    produces exactly the same tokens.
+    """
+    text = re.sub('[' + ''.join(['^'+c for c in allowed_chars])+ ']', ' ', text)
+    text = re.sub(' +', ' ', text)
+    tokens = [token.lower() for token in text.split(' ')]
+    return [token for token in tokens if token not in ignored_tokens]
+
+
+class TokenizerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tokenizer = Tokenizer()
+        self.tokenizer.prepare(ArgsStub())
+
+    def test_same_tokens_as_reference(self):
+        with open(ArgsStub.ignored_tokens, 'r') as f:
+            ignored = f.read().split('\n')
+        alphabet = string.ascii_letters + string.digits + string.punctuation + ' \t\nßİé'
+        rand = random.Random(0)
+        texts = ['', ' ', 'Aging', ' Oxidative stress in C. elegans (a review) ', 'x^y', "Alzheimer's disease"]
+        texts += [' '.join(rand.choice(ignored) for _ in range(5)) for _ in range(200)]
+        texts += [''.join(rand.choice(alphabet) for _ in range(rand.randint(0, 40))) for _ in range(1000)]
+
+        for text in texts:
+            self.assertEqual(self.tokenizer.tokenize(text),
+                             reference_tokenize(text, set(ignored), ArgsStub.allowed_chars), text)
+        self.assertEqual(self.tokenizer.tokenize_batch(texts), [self.tokenizer.tokenize(text) for text in texts])
+
+    def test_intern(self):
+        self.tokenizer.intern_tokens = True
+
+        first, = self.tokenizer.tokenize(''.join(['longevity']))
+        second, = self.tokenizer.tokenize(''.join(['longev', 'ity']))
+
+        self.assertIs(first, second)
+
+    def test_tokenize_ids(self):
+        vocabulary = Vocabulary()
+
+        ids = self.tokenizer.tokenize_ids('Aging and aging mice', vocabulary)
+
+        self.assertEqual(ids, [0, 0, 1])
+        self.assertEqual([vocabulary.token(id) for id in ids], ['aging', 'aging', 'mice'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,6 +4,18 @@ import math
 import asyncio
 from lxml import html
 from downloader import Downloader
+from checkpoint import JsonlWriter, is_jsonl, read_jsonl
+from metrics import Metrics
+
+
+def parse_researcher_names(url, contents):
+    """
+    Returns names of researchers on a people page. Doesn't touch crawler
+    state, so it can run in the downloader's parse executor.
+    """
+    if contents is None:
+        return None
+    return [str(name) for name in html.fromstring(contents).xpath('//*[@id="content"]/div/div[2]/ul/li/h2/a/text()')]
 
 
 class WhoswhoCrawler(object):
@@ -13,45 +25,93 @@ class WhoswhoCrawler(object):
 
     def __init__(self, downloader=Downloader()):
         self.downloader=downloader
+        # Called with a dict of researchers of every page as soon as it is parsed.
+        self.on_page_done = None
 
     def register_options(self, argparser):
         self.downloader.register_options(argparser)
 
-    async def parse(self, url, contents):
-        if contents is None:
+    async def parse(self, url, names):
+        if names is None:
             return
-        print('Parsing {}'.format(url))
-        html_tree = html.fromstring(contents)
-        self.researchers_per_url[url] = html_tree.xpath('//*[@id="content"]/div/div[2]/ul/li/h2/a/text()')
+        print('Parsed {}'.format(url))
+        self.researchers_per_url[url] = names
+        if self.on_page_done is not None:
+            self.on_page_done(self.researchers_on_page(url))
+
+    def page_url(self, page_num):
+        return self.URL_PATTERN.format(page_num+1)
+
+    def researchers_on_page(self, url):
+        page_num = self.page_num_for_url[url]
+        return {
+            page_num*self.RESEARCHERS_PER_PAGE + id: name
+            for id, name in enumerate(self.researchers_per_url.get(url, []))
+        }
 
-    async def crawl(self, args, num_researchers):
+    async def crawl(self, args, num_researchers, done_pages=()):
+        """
+        @param done_pages numbers of pages that were already crawled and
+            should be skipped.
+        """
         self.researchers_per_url = {}
         self.downloader.prepare(args)
         num_pages = int(math.ceil(num_researchers / self.RESEARCHERS_PER_PAGE))
-        page_urls = [self.URL_PATTERN.format(page_num) for page_num in range(1, num_pages+1)]
-        await self.downloader.download_all(page_urls, self.parse)
+        self.page_num_for_url = {self.page_url(page_num): page_num for page_num in range(num_pages)}
+        page_urls = [url for url, page_num in self.page_num_for_url.items() if page_num not in done_pages]
+        with self.downloader.metrics.stage('whoswho'):
+            await self.downloader.download_all(page_urls, self.parse, parser=parse_researcher_names, stage='people')
         researchers_info = {
-            page_num*self.RESEARCHERS_PER_PAGE + id: name
-            for page_num, url in enumerate(page_urls)
-            for id, name in enumerate(self.researchers_per_url[url])
+            id: name
+            for url in page_urls
+            for id, name in self.researchers_on_page(url).items()
             }
         print('Parsed {} researchers'.format(len(researchers_info)))
         return researchers_info
 
 
-
+def complete_pages(records, researchers_per_page):
+    """
+    Returns numbers of pages all of whose researchers are among the given
+    jsonl records. Every record stores the number of researchers on its page,
+    so that a page cut short by a crash is crawled again.
+    """
+    written, sizes = {}, {}
+    for record in records:
+        page_num = int(record['id']) // researchers_per_page
+        written[page_num] = written.get(page_num, 0) + 1
+        sizes[page_num] = record.get('page_size')
+    return {page_num for page_num, count in written.items() if count == sizes[page_num]}
 
 
 async def main():
     crawler = WhoswhoCrawler()
     parser = argparse.ArgumentParser(description='Crawl reseachers')
-    parser.add_argument('--out', dest='output', help='Path to a json where to store crawled information', default='researchers.json')
+    parser.add_argument('--out', dest='output', help='Path to a json where to store crawled information. If it ends with .jsonl, researchers are appended to it page by page.', default='researchers.json')
     parser.add_argument('--num', type=int, dest='num_researchers', help='How many researchers to download', default=50)
+    parser.add_argument('--resume', action='store_true', help='Skip pages already present in the .jsonl output instead of overwriting it', default=False)
     crawler.register_options(parser)
+    metrics = Metrics()
+    metrics.register_options(parser)
     args = parser.parse_args()
-    researchers = await crawler.crawl(args, args.num_researchers)
-    with open(args.output, 'w') as output:
-        json.dump(researchers, output)
+    if args.resume and not is_jsonl(args.output):
+        parser.error('--resume requires a .jsonl output')
+    metrics.prepare(args)
+    crawler.downloader.metrics = metrics
+    with metrics:
+        if is_jsonl(args.output):
+            with JsonlWriter(args.output, resume=args.resume) as writer:
+                done_pages = complete_pages(read_jsonl(args.output), crawler.RESEARCHERS_PER_PAGE) if args.resume else set()
+                def write_page(researchers):
+                    for id, name in researchers.items():
+                        if str(id) not in writer.done_ids:
+                            writer.write(str(id), {'name': name, 'page_size': len(researchers)})
+                crawler.on_page_done = write_page
+                await crawler.crawl(args, args.num_researchers, done_pages)
+            return
+        researchers = await crawler.crawl(args, args.num_researchers)
+        with open(args.output, 'w') as output:
+            json.dump(researchers, output)
 
 if __name__ == '__main__':
     asyncio.run(main())
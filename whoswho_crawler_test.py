@@ -0,0 +1,21 @@
+import unittest
+
+from whoswho_crawler import complete_pages
+
+
+class WhoswhoCrawlerTest(unittest.TestCase):
+
+    def test_complete_pages(self):
+        records = [
+            # Page 0 was written completely, page 1 was cut short, and page 2
+            # is the last one and has fewer researchers.
+            {'id': '0', 'name': 'A', 'page_size': 2},
+            {'id': '1', 'name': 'B', 'page_size': 2},
+            {'id': '2', 'name': 'C', 'page_size': 2},
+            {'id': '4', 'name': 'E', 'page_size': 1},
+        ]
+
+        self.assertEqual(complete_pages(records, 2), {0, 2})
+
+if __name__ == '__main__':
+    unittest.main()